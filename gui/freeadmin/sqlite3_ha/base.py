@@ -1,7 +1,13 @@
 
+import atexit
+import functools
+import io
 import logging
 import os
+import queue
+import re
 import threading
+import time
 
 from django.db.backends.sqlite3 import base as sqlite3base
 from lockfile import LockFile, LockTimeout
@@ -15,6 +21,18 @@ IntegrityError = sqlite3base.IntegrityError
 execute_sync = False
 log = logging.getLogger('freeadmin.sqlite3_ha')
 
+# For how long the failover status is trusted before asking for it again
+FAILOVER_STATUS_TTL = 5
+# How long to wait before asking again for a failover status that could not be
+# determined, doubled after every consecutive failure up to FAILOVER_STATUS_TTL
+FAILOVER_STATUS_RETRY = 0.5
+# Number of distinct queries whose replication rules are kept around
+STATEMENT_CACHE_SIZE = 1024
+# How long to wait for queued statements to be replicated when exiting
+EXIT_FLUSH_TIMEOUT = 30
+
+RE_SAVEPOINT = re.compile(r'^(SAVEPOINT|ROLLBACK TO SAVEPOINT|RELEASE SAVEPOINT) (.+)$')
+
 
 """
 Mapping of tables to not to replicate to the remote side
@@ -53,6 +71,9 @@ class Journal(object):
     the remote side, either for it being offline or failed to execute.
 
     This should be used in a context and provides file locking by itself.
+
+    The journal file is a sequence of pickled lists of queries, new queries
+    are appended to it as a new list instead of rewriting the whole file.
     """
 
     JOURNAL_FILE = '/data/ha-journal'
@@ -66,12 +87,23 @@ class Journal(object):
         except OSError:
             return True
 
+    @classmethod
+    def append(cls, queries):
+        with cls() as j:
+            j.queries.extend(queries)
+
     def _get_queries(self):
-        try:
-            with open(self.JOURNAL_FILE, 'rb') as f:
-                self.queries = pickle.loads(f.read())
-        except (pickle.PickleError, EOFError):
-            self.queries = []
+        self.queries = []
+        with open(self.JOURNAL_FILE, 'rb') as f:
+            data = f.read()
+        f = io.BytesIO(data)
+        while f.tell() < len(data):
+            try:
+                self.queries.extend(pickle.load(f))
+            except (pickle.PickleError, EOFError, ValueError):
+                # Last append did not make it to disk entirely
+                log.warning('Ignoring truncated journal entry at offset %d', f.tell())
+                break
 
     def __enter__(self):
         self._lock = LockFile(self.JOURNAL_FILE)
@@ -84,52 +116,285 @@ class Journal(object):
         if not os.path.exists(self.JOURNAL_FILE):
             open(self.JOURNAL_FILE, 'a').close()
 
-        self._get_queries()
+        # Most of the time the journal is empty, spare reading it
+        if self.is_empty():
+            self.queries = []
+        else:
+            self._get_queries()
+        self._loaded = list(self.queries)
         return self
 
     def __exit__(self, typ, value, traceback):
 
-        with open(self.JOURNAL_FILE, 'wb+') as f:
-            if self.queries:
-                f.write(pickle.dumps(self.queries))
-
-        self._lock.release()
+        try:
+            loaded = len(self._loaded)
+            if self.queries[:loaded] == self._loaded:
+                if len(self.queries) > loaded:
+                    with open(self.JOURNAL_FILE, 'ab') as f:
+                        f.write(pickle.dumps(self.queries[loaded:]))
+            else:
+                with open(self.JOURNAL_FILE, 'wb+') as f:
+                    if self.queries:
+                        f.write(pickle.dumps(self.queries))
+        finally:
+            self._lock.release()
         if typ is not None:
             raise
 
 
-class RunSQLRemote(threading.Thread):
+class FailoverStatus(object):
     """
-    This is a thread responsible for running the queries on the remote side.
+    Failover status of this node as of at most `ttl` seconds ago, asking for
+    it is expensive.
 
-    The query will be appended to the Journal in case the Journal is not empty
-    or if it fails (e.g. remote side offline)
+    It is invalidated on failover events (middlewared `devd.carp` hook) and
+    every time the remote side can not be reached, so a node which just became
+    MASTER does not skip replicating its writes.
+
+    When it can not be determined the last known status is kept and asked for
+    again `retry` seconds later, doubling on every consecutive failure.
+    `failed` tells it was never determined.
     """
 
-    def __init__(self, *args, **kwargs):
-        self._sql = kwargs.pop('sql')
-        self._params = kwargs.pop('params')
-        super(RunSQLRemote, self).__init__(*args, **kwargs)
+    def __init__(self, ttl, retry=FAILOVER_STATUS_RETRY):
+        self.ttl = ttl
+        self.retry = retry
+        self.status = None
+        self.failed = False
+        self.failures = 0
+        self.expires = 0
+
+    def get(self):
+        now = time.monotonic()
+        if now < self.expires:
+            return self.status
 
-    def run(self):
-        from freenasUI.middleware.client import client, ClientException
         try:
-            with Journal() as f:
-                if f.queries:
-                    f.queries.append((self._sql, self._params))
+            status, ttl = self.query()
+        except Exception:
+            self.failed = self.status is None
+            self.expires = now + min(self.retry * 2 ** self.failures, self.ttl)
+            self.failures += 1
+        else:
+            self.status = status
+            self.failed = False
+            self.failures = 0
+            self.expires = now + ttl
+        return self.status
+
+    def query(self):
+        from freenasUI.middleware.notifier import notifier
+        if hasattr(notifier, 'failover_status'):
+            return notifier().failover_status(), self.ttl
+        # Not an HA system, this will not change
+        return None, float('inf')
+
+    def invalidate(self):
+        self.expires = 0
+
+
+failover_status = FailoverStatus(FAILOVER_STATUS_TTL)
+
+
+def remote_sql_batch(queries):
+    from freenasUI.middleware.client import client
+    with client as c:
+        c.call('failover.call_remote', 'datastore.sql_batch', [queries])
+
+
+class Replicator(object):
+    """
+    Runs the queries to replicate on the remote side, in the order they were
+    submitted, from a single thread.
+
+    Queries are submitted in batches, one per transaction. Everything queued by
+    the time the thread gets to it is sent with a single remote call, which
+    runs it within a transaction.
+
+    Queries go to the Journal instead in case the Journal is not empty and can
+    not be replayed, or if they fail (e.g. remote side offline).
+    """
+
+    def __init__(self, call_remote=remote_sql_batch, journal=Journal):
+        self.call_remote = call_remote
+        self.journal = journal
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, queries, wait=False):
+        done = threading.Event()
+        self._queue.put((queries, done))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqlite3_ha', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush, EXIT_FLUSH_TIMEOUT)
+        if wait:
+            done.wait()
+
+    def flush(self, timeout=None):
+        """
+        Wait for everything submitted so far to be replicated (or journaled).
+        """
+        done = threading.Event()
+        self._queue.put(([], done))
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batches = [self._queue.get()]
+            while True:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                queries = [query for batch, done in batches for query in batch]
+                if queries:
+                    self.send(queries)
+            finally:
+                for batch, done in batches:
+                    done.set()
+
+    def send(self, queries):
+        from freenasUI.middleware.client import ClientException
+        try:
+            with self.journal() as j:
+                if j.queries:
+                    # Replay the journal first, everything in one go
+                    self.call_remote(j.queries + queries)
+                    j.queries = []
                 else:
-                    with client as c:
-                        c.call('failover.call_remote', 'datastore.sql', [self._sql, self._params])
+                    self.call_remote(queries)
         except ClientException:
-            with Journal() as f:
-                f.queries.append((self._sql, self._params))
+            failover_status.invalidate()
+            self.journal.append(queries)
             return False
         except Exception as err:
-            log.error('Failed to run SQL remotely %s: %s', self._sql, err, exc_info=True)
+            log.error('Failed to run SQL remotely %s: %s', queries, err, exc_info=True)
             return False
         return True
 
 
+replicator = Replicator()
+
+
+def convert_query(query):
+    return sqlite3base.FORMAT_QMARK_REGEX.sub('?', query).replace(
+        '%%', '%'
+    )
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def replicated_statements(query):
+    """
+    Process the query, modify it if necessary based on NO_SYNC_MAP rules.
+
+    Returns the statements to run on the remote side as tuples of the SQL and
+    the indexes of the params it does not use anymore. This depends on the
+    query only and not on its params, so it is computed once per query.
+    """
+    statements = []
+
+    parse = sqlparse.parse(query)
+    for p in parse:
+
+        # Only care for DELETE, INSERT and UPDATE queries
+        if p.tokens[0].normalized not in ('DELETE', 'INSERT', 'UPDATE'):
+            continue
+
+        # Remember correspondent params to delete
+        delete_idx = []
+
+        if p.tokens[0].normalized == 'INSERT':
+
+            into = p.token_next_by(m=(sqlparse.tokens.Keyword, 'INTO'))
+            if not into:
+                continue
+
+            next_ = p.token_next(into[0])
+
+            if next_[1].value in NO_SYNC_MAP:
+                continue
+
+        elif p.tokens[0].normalized == 'DELETE':
+
+            from_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'FROM'))
+            if not from_:
+                continue
+
+            next_ = p.token_next(from_[0])
+
+            if next_[1].value in NO_SYNC_MAP:
+                continue
+
+        elif p.tokens[0].normalized == 'UPDATE':
+
+            name = p.token_next(0)[1].value
+            no_sync = NO_SYNC_MAP.get(name)
+            # Skip if table is in set to not to sync and has no attrs
+            if no_sync is None and name in NO_SYNC_MAP:
+                continue
+
+            set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
+            if not set_:
+                continue
+
+            next_ = p.token_next(set_[0])
+            if not next_:
+                continue
+
+            if no_sync is None:
+                lookup = []
+            else:
+
+                if 'fields' not in no_sync:
+                    continue
+
+                if issubclass(
+                    next_[1].__class__, sqlparse.sql.IdentifierList
+                ):
+                    lookup = list(next_[1].get_sublists())
+                elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
+                    lookup = [next_[1]]
+
+                # Get all placeholders from the query (%s or ?)
+                placeholders = [a for a in p.flatten() if a.value in ('%s', '?')]
+
+            for l in lookup:
+
+                if l.value not in no_sync['fields']:
+                    continue
+
+                # Remove placeholder from the params
+                try:
+                    delete_idx.append(placeholders.index(l.tokens[-1]))
+                except ValueError:
+                    pass
+
+                # If it is a list we must also remove the comma around it
+                t_index = l.parent.token_index(l)
+                prev_ = l.parent.token_prev(t_index)
+                next_ = l.parent.token_next(t_index)
+                if next_ and issubclass(
+                    next_[1].__class__, sqlparse.sql.Token
+                ) and next_[1].value == ',':
+                    del l.parent.tokens[next_[0]]
+                elif prev_ and issubclass(
+                    prev_[1].__class__, sqlparse.sql.Token
+                ) and prev_[1].value == ',':
+                    del l.parent.tokens[prev_[0]]
+                del l.parent.tokens[l.parent.token_index(l)]
+
+            delete_idx.sort(reverse=True)
+
+        statements.append((convert_query(str(p)), tuple(delete_idx)))
+
+    return tuple(statements)
+
+
 class DatabaseFeatures(sqlite3base.DatabaseFeatures):
     pass
 
@@ -140,8 +405,60 @@ class DatabaseOperations(sqlite3base.DatabaseOperations):
 
 class DatabaseWrapper(sqlite3base.DatabaseWrapper):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Queries to replicate once the transaction they were run in is committed
+        self.ha_queries = []
+        self.ha_journal = []
+        self.ha_savepoints = {}
+
     def create_cursor(self):
-        return self.connection.cursor(factory=HASQLiteCursorWrapper)
+        cursor = self.connection.cursor(factory=HASQLiteCursorWrapper)
+        cursor.db = self
+        return cursor
+
+    def ha_replicate(self, queries, journal=False):
+        if self.connection.in_transaction:
+            if journal:
+                self.ha_journal.extend(queries)
+            else:
+                self.ha_queries.extend(queries)
+        elif journal:
+            Journal.append(queries)
+        else:
+            replicator.submit(queries, wait=execute_sync)
+
+    def ha_savepoint(self, query):
+        match = RE_SAVEPOINT.match(query)
+        if not match:
+            return
+        statement, sid = match.groups()
+        if statement == 'SAVEPOINT':
+            self.ha_savepoints[sid] = (len(self.ha_queries), len(self.ha_journal))
+        elif statement == 'ROLLBACK TO SAVEPOINT':
+            if sid in self.ha_savepoints:
+                queries, journal = self.ha_savepoints[sid]
+                del self.ha_queries[queries:]
+                del self.ha_journal[journal:]
+        else:
+            self.ha_savepoints.pop(sid, None)
+
+    def _commit(self):
+        rv = super()._commit()
+        queries, self.ha_queries = self.ha_queries, []
+        journal, self.ha_journal = self.ha_journal, []
+        self.ha_savepoints = {}
+        if journal:
+            Journal.append(journal)
+        if queries:
+            replicator.submit(queries, wait=execute_sync)
+        return rv
+
+    def _rollback(self):
+        self.ha_queries = []
+        self.ha_journal = []
+        self.ha_savepoints = {}
+        return super()._rollback()
 
     def dump(self):
         """
@@ -244,138 +561,48 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
 
 class HASQLiteCursorWrapper(Database.Cursor):
 
+    db = None
+
     def execute_passive(self, query, params=None):
         """
         Process the query, modify it if necessary based on NO_SYNC_MAP rules
         and execute it on the remote side.
         """
-        global execute_sync
-
         # Skip SELECT queries
         if query.lower().startswith('select'):
             return
 
-        try:
-            # FIXME: This is extremely time-consuming (failover.status)
-            from freenasUI.middleware.notifier import notifier
-            if not (
-                hasattr(notifier, 'failover_status') and
-                notifier().failover_status() == 'MASTER'
-            ):
-                return
-        except:
+        status = failover_status.get()
+        if status != 'MASTER' and not failover_status.failed:
             return
 
-        parse = sqlparse.parse(query)
-        for p in parse:
-
-            # Only care for DELETE, INSERT and UPDATE queries
-            if p.tokens[0].normalized not in ('DELETE', 'INSERT', 'UPDATE'):
-                continue
-
+        queries = []
+        for sql, delete_idx in replicated_statements(query):
             cparams = list(params)
-            if p.tokens[0].normalized == 'INSERT':
-
-                into = p.token_next_by(m=(sqlparse.tokens.Keyword, 'INTO'))
-                if not into:
-                    continue
-
-                next_ = p.token_next(into[0])
-
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
-
-            elif p.tokens[0].normalized == 'DELETE':
-
-                from_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'FROM'))
-                if not from_:
-                    continue
-
-                next_ = p.token_next(from_[0])
-
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
-
-            elif p.tokens[0].normalized == 'UPDATE':
-
-                name = p.token_next(0)[1].value
-                no_sync = NO_SYNC_MAP.get(name)
-                # Skip if table is in set to not to sync and has no attrs
-                if no_sync is None and name in NO_SYNC_MAP:
-                    continue
-
-                set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
-                if not set_:
-                    continue
-
-                next_ = p.token_next(set_[0])
-                if not next_:
-                    continue
-
-                if no_sync is None:
-                    lookup = []
-                else:
-
-                    if 'fields' not in no_sync:
-                        continue
-
-                    if issubclass(
-                        next_[1].__class__, sqlparse.sql.IdentifierList
-                    ):
-                        lookup = list(next_[1].get_sublists())
-                    elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
-                        lookup = [next_[1]]
-
-                    # Get all placeholders from the query (%s or ?)
-                    placeholders = [a for a in p.flatten() if a.value in ('%s', '?')]
-
-                # Remember correspondent cparams to delete
-                delete_idx = []
-
-                for l in lookup:
-
-                    if l.value not in no_sync['fields']:
-                        continue
-
-                    # Remove placeholder from the params
-                    try:
-                        idx = placeholders.index(l.tokens[-1])
-                        if cparams:
-                            delete_idx.append(idx)
-                    except ValueError:
-                        pass
-
-                    # If it is a list we must also remove the comma around it
-                    t_index = l.parent.token_index(l)
-                    prev_ = l.parent.token_prev(t_index)
-                    next_ = l.parent.token_next(t_index)
-                    if next_ and issubclass(
-                        next_[1].__class__, sqlparse.sql.Token
-                    ) and next_[1].value == ',':
-                        del l.parent.tokens[next_[0]]
-                    elif prev_ and issubclass(
-                        prev_[1].__class__, sqlparse.sql.Token
-                    ) and prev_[1].value == ',':
-                        del l.parent.tokens[prev_[0]]
-                    del l.parent.tokens[l.parent.token_index(l)]
-
-                delete_idx.sort(reverse=True)
+            if cparams:
                 for i in delete_idx:
                     del cparams[i]
+            queries.append((sql, cparams))
 
-            if params is not None:
-                sql = self.convert_query(str(p))
-            else:
-                sql = str(p)
-            # Actually try to run the query on the remote side within a thread
-            rsr = RunSQLRemote(sql=sql, params=cparams)
-            rsr.start()
-            if execute_sync:
-                rsr.join()
+        if not queries:
+            return
+
+        # Failover status is unknown, journal the queries to be replayed
+        # instead of losing them in case this node is the MASTER
+        journal = status != 'MASTER'
+
+        if self.db is not None:
+            self.db.ha_replicate(queries, journal=journal)
+        elif journal:
+            Journal.append(queries)
+        else:
+            replicator.submit(queries, wait=execute_sync)
 
     def execute(self, query, params=None):
 
         if params is None:
+            if self.db is not None:
+                self.db.ha_savepoint(query)
             return super().execute(query)
         query = self.convert_query(query)
         execute = super().execute(query, params)
@@ -407,6 +634,4 @@ class HASQLiteCursorWrapper(Database.Cursor):
         return super().executemany(query, param_list)
 
     def convert_query(self, query):
-        return sqlite3base.FORMAT_QMARK_REGEX.sub('?', query).replace(
-            '%%', '%'
-        )
+        return convert_query(query)
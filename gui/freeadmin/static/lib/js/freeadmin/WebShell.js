@@ -38,6 +38,7 @@ define([
     qtime: 100,
     retry: 0,
     cy: 0,
+    full: true,
     kb: [],
     connections: [],
     sizeChange: true,
@@ -64,6 +65,7 @@ define([
       lang.mixin(this, kwArgs);
 
       this.sid = ""+Math.round(Math.random()*1000000000);
+      this.lines = [];
       this.qtimer = new timing.Timer(1);
       this.qtimer.onTick = lang.hitch(this, this.update);
     },
@@ -206,6 +208,7 @@ define([
             shell: this.shell,
             w: this.width,
             h: this.height,
+            f: this.full ? 1 : 0,
             k: send
           },
           headers: {
@@ -229,10 +232,12 @@ define([
           }
 
           me.retry = 0;
+          me.full = false;
           cy = data.substring(45, 48);
-          html = data.substring(52);
+          var full = data.substring(53, 54) == "1";
+          html = data.substring(58);
           if(html.length > 0) {
-            me._content.innerHTML = html;
+            me.draw(html, full);
             me.handler('curs', cy);
             qtime = 100;
           } else {
@@ -247,6 +252,8 @@ define([
 
         }, function(req) {
 
+          // Lines changed meanwhile may have been lost
+          me.full = true;
           if (req.response.status == 400) {
             me.handler('disc',0);
           } else {
@@ -261,6 +268,21 @@ define([
 
       }
     },
+    draw: function(html, full) {
+      // Every line is prefixed with its number, only changed lines are sent
+      if(full) {
+        this._content.innerHTML = "";
+        this.lines = [];
+      }
+      var rows = html.split("\n");
+      for(var i = 0; i < rows.length - 1; i++) {
+        var y = parseInt(rows[i].substring(0, 3), 10);
+        if(!this.lines[y]) {
+          this.lines[y] = domConst.create("span", null, this._content);
+        }
+        this.lines[y].innerHTML = rows[i].substring(3) + "\n";
+      }
+    },
     queue: function (s) {
       this.kb.unshift(s);
       this.qtime=100;
@@ -1239,6 +1239,7 @@ def terminal(request):
     jid = request.POST.get("jid", 0)
     shell = request.POST.get("shell", "")
     k = request.POST.get("k")
+    full = request.POST.get("f") == "1"
     w = int(request.POST.get("w", 80))
     h = int(request.POST.get("h", 24))
 
@@ -1261,7 +1262,7 @@ def terminal(request):
                 )
             time.sleep(0.002)
             content_data = '<?xml version="1.0" encoding="UTF-8"?>' + \
-                multiplex.proc_dump(sid)
+                multiplex.proc_dump(sid, full)
             response = HttpResponse(content_data, content_type='text/xml')
             return response
         else:
@@ -29,10 +29,13 @@
 from xmlrpc.server import SimpleXMLRPCDispatcher
 import array
 import fcntl
+import html
+import itertools
 import logging
 import logging.config
 import os
 import pty
+import re
 import signal
 import select
 import struct
@@ -58,6 +61,11 @@ from freenasUI.settings import LOGGING
 log = logging.getLogger('tools.webshell')
 logging.config.dictConfig(LOGGING)
 
+# Runs of bytes that decode to themselves
+RE_ASCII = re.compile(rb'[\x00-\x7f]+')
+# Runs of characters that are only echoed, one cell each
+RE_PRINTABLE = re.compile('[\x20-\x7e]+')
+
 
 class XMLRPCHandler(socketserver.BaseRequestHandler):
 
@@ -311,8 +319,10 @@ class Terminal:
         self.vt100_parse_param = ""
         # Buffers
         self.vt100_out = ""
-        # Caches
-        self.dump_cache = ""
+        # Lines as last dumped
+        self.dump_lines = []
+        self.dump_inverse = False
+        self.dump_cy = -1
         # Invoke other resets
         self.reset_screen()
         self.reset_soft()
@@ -355,6 +365,8 @@ class Terminal:
         # Screen
         self.screen = array.array('i', [self.attr | 0x20] * self.w * self.h)
         self.screen2 = array.array('i', [self.attr | 0x20] * self.w * self.h)
+        # Lines changed since the last dump
+        self.dirty = bytearray(b'\x01' * self.h)
         # Scroll parameters
         self.scroll_area_y0 = 0
         self.scroll_area_y1 = self.h
@@ -366,36 +378,51 @@ class Terminal:
 
     # UTF-8 functions
     def utf8_decode(self, d):
+        o = []
+        i = 0
+        n = len(d)
+        while i < n:
+            # Fast path, ASCII outside of a multibyte sequence
+            if self.utf8_units_count == 0:
+                m = RE_ASCII.match(d, i)
+                if m:
+                    o.append(m.group().decode('ascii'))
+                    i = m.end()
+                    continue
+            o.append(self.utf8_decode_char(d[i]))
+            i += 1
+        return ''.join(o)
+
+    def utf8_decode_char(self, char):
         o = ''
-        for char in d:
-            if self.utf8_units_count != self.utf8_units_received:
-                self.utf8_units_received += 1
-                if (char & 0xc0) == 0x80:
-                    self.utf8_char = (self.utf8_char << 6) | (char & 0x3f)
-                    if self.utf8_units_count == self.utf8_units_received:
-                        if self.utf8_char < 0x10000:
-                            o += chr(self.utf8_char)
-                        self.utf8_units_count = self.utf8_units_received = 0
-                else:
-                    o += '?'
-                    while self.utf8_units_received:
-                        o += '?'
-                        self.utf8_units_received -= 1
-                    self.utf8_units_count = 0
+        if self.utf8_units_count != self.utf8_units_received:
+            self.utf8_units_received += 1
+            if (char & 0xc0) == 0x80:
+                self.utf8_char = (self.utf8_char << 6) | (char & 0x3f)
+                if self.utf8_units_count == self.utf8_units_received:
+                    if self.utf8_char < 0x10000:
+                        o += chr(self.utf8_char)
+                    self.utf8_units_count = self.utf8_units_received = 0
             else:
-                if (char & 0x80) == 0x00:
-                    o += chr(char)
-                elif (char & 0xe0) == 0xc0:
-                    self.utf8_units_count = 1
-                    self.utf8_char = char & 0x1f
-                elif (char & 0xf0) == 0xe0:
-                    self.utf8_units_count = 2
-                    self.utf8_char = char & 0x0f
-                elif (char & 0xf8) == 0xf0:
-                    self.utf8_units_count = 3
-                    self.utf8_char = char & 0x07
-                else:
+                o += '?'
+                while self.utf8_units_received:
                     o += '?'
+                    self.utf8_units_received -= 1
+                self.utf8_units_count = 0
+        else:
+            if (char & 0x80) == 0x00:
+                o += chr(char)
+            elif (char & 0xe0) == 0xc0:
+                self.utf8_units_count = 1
+                self.utf8_char = char & 0x1f
+            elif (char & 0xf0) == 0xe0:
+                self.utf8_units_count = 2
+                self.utf8_char = char & 0x0f
+            elif (char & 0xf8) == 0xf0:
+                self.utf8_units_count = 3
+                self.utf8_char = char & 0x07
+            else:
+                o += '?'
         return o
 
     def utf8_charwidth(self, char):
@@ -411,6 +438,10 @@ class Terminal:
     def poke(self, y, x, s):
         pos = self.w * y + x
         self.screen[pos:pos + len(s)] = s
+        if s:
+            y0 = pos // self.w
+            y1 = min(self.h, (pos + len(s) - 1) // self.w + 1)
+            self.dirty[y0:y1] = b'\x01' * (y1 - y0)
 
     def fill(self, y0, x0, y1, x1, char):
         n = self.w * (y1 - y0 - 1) + (x1 - x0)
@@ -459,6 +490,14 @@ class Terminal:
             lx += 1
         return wx, lx
 
+    def cursor_line_prefix_width(self):
+        # Width of the characters left of the cursor
+        x = min(self.cx, self.w)
+        if x == 0:
+            return 0
+        pos = self.cy * self.w
+        return x + sum(1 for d in self.screen[pos:pos + x] if d & 0xffff >= 0x2e80)
+
     def cursor_up(self, n=1):
         self.cy = max(self.scroll_area_y0, self.cy - n)
 
@@ -545,6 +584,33 @@ class Terminal:
         self.poke(self.cy, self.cx, array.array('i', [self.attr | char]))
         self.cursor_set_x(self.cx + 1)
 
+    def dumb_echo_run(self, s):
+        """
+        Echo a run of printable ASCII characters, filling the line in one go
+        instead of one character at a time.
+
+        Same as calling `dumb_echo` for each of them, as long as insert mode
+        and the graphical character set are off.
+        """
+        i = 0
+        n = len(s)
+        while i < n:
+            room = self.w - self.cursor_line_prefix_width()
+            if room <= 0:
+                if not self.vt100_mode_autowrap:
+                    # The rest overwrites the last column, leave it to dumb_echo
+                    for c in s[i:]:
+                        self.dumb_echo(ord(c))
+                    break
+                self.ctrl_CR()
+                self.ctrl_LF()
+                continue
+            chunk = s[i:i + room].encode('ascii')
+            self.poke(self.cy, self.cx, array.array('i', [self.attr | c for c in chunk]))
+            self.cx += len(chunk)
+            i += len(chunk)
+        self.vt100_lastchar = ord(s[-1])
+
     # VT100 CTRL, ESC, CSI handlers
     def vt100_charset_update(self):
         self.vt100_charset_is_graphical = (
@@ -605,6 +671,7 @@ class Terminal:
                 if ((state and not self.vt100_mode_alt_screen) or
                         (not state and self.vt100_mode_alt_screen)):
                     self.screen, self.screen2 = self.screen2, self.screen
+                    self.dirty = bytearray(b'\x01' * self.h)
                     self.vt100_saved, self.vt100_saved2 = self.vt100_saved2, \
                         self.vt100_saved
                 self.vt100_mode_alt_screen = state
@@ -1153,8 +1220,23 @@ class Terminal:
 
     def write(self, d):
         d = self.utf8_decode(d)
-        for c in d:
-            char = ord(c)
+        i = 0
+        n = len(d)
+        while i < n:
+            # Fast path, plain text outside of a control sequence
+            if not (
+                self.vt100_parse_state or
+                self.vt100_mode_insert or
+                self.vt100_charset_is_single_shift or
+                self.vt100_charset_is_graphical
+            ):
+                m = RE_PRINTABLE.match(d, i)
+                if m:
+                    self.dumb_echo_run(m.group())
+                    i = m.end()
+                    continue
+            char = ord(d[i])
+            i += 1
             if self.vt100_write(char):
                 continue
             if self.dumb_write(char):
@@ -1188,63 +1270,87 @@ class Terminal:
                     o += chr(10)
         return o
 
-    def dump(self):
-        dump = ""
-        attr_ = -1
-        cx, cy = min(self.cx, self.w - 1), self.cy
-        for y in range(0, self.h):
+    def dump_attr(self, attr):
+        bg = attr & 0x000f
+        fg = (attr & 0x00f0) >> 4
+        # Inverse
+        inv = attr & 0x0200
+        inv2 = self.vt100_mode_inverse
+        if (inv and not inv2) or (inv2 and not inv):
+            fg, bg = bg, fg
+        # Concealed
+        if attr & 0x0400:
+            fg = 0xc
+        # Underline
+        if attr & 0x0100:
+            ul = ' ul'
+        else:
+            ul = ''
+        return '<span class="shell_f%x shell_b%x%s">' % (fg, bg, ul)
+
+    def dump_line(self, y, cx):
+        line = self.screen[y * self.w:(y + 1) * self.w]
+        # Cursor
+        if cx is not None:
+            d = line[cx]
+            line[cx] = ((d >> 16) & 0xfff0 | 0x000c) << 16 | d & 0xffff
+        chars = [chr(d & 0xffff) for d in line]
+        if max(chars) >= '\u2e80':
+            # Wide characters that do not fit in the line are not shown
             wx = 0
-            for x in range(0, self.w):
-                d = self.screen[y * self.w + x]
-                char = d & 0xffff
-                attr = d >> 16
-                # Cursor
-                if cy == y and cx == x and self.vt100_mode_cursor:
-                    attr = attr & 0xfff0 | 0x000c
-                # Attributes
-                if attr != attr_:
-                    if attr_ != -1:
-                        dump += '</span>'
-                    bg = attr & 0x000f
-                    fg = (attr & 0x00f0) >> 4
-                    # Inverse
-                    inv = attr & 0x0200
-                    inv2 = self.vt100_mode_inverse
-                    if (inv and not inv2) or (inv2 and not inv):
-                        fg, bg = bg, fg
-                    # Concealed
-                    if attr & 0x0400:
-                        fg = 0xc
-                    # Underline
-                    if attr & 0x0100:
-                        ul = ' ul'
-                    else:
-                        ul = ''
-                    dump += '<span class="shell_f%x shell_b%x%s">' % (
-                        fg,
-                        bg,
-                        ul)
-                    attr_ = attr
-                # Escape HTML characters
-                if char == 38:
-                    dump += '&amp;'
-                elif char == 60:
-                    dump += '&lt;'
-                elif char == 62:
-                    dump += '&gt;'
-                else:
-                    wx += self.utf8_charwidth(char)
-                    if wx <= self.w:
-                        dump += chr(char)
-            dump += "\n"
-        # Encode in UTF-8
-        dump += '</span>'
-        # Cache dump
-        if self.dump_cache == dump:
+            for x, char in enumerate(chars):
+                if char not in '&<>':
+                    wx += self.utf8_charwidth(ord(char))
+                    if wx > self.w:
+                        chars[x] = ''
+        dump = []
+        x = 0
+        for attr, cells in itertools.groupby([d >> 16 for d in line]):
+            n = len(list(cells))
+            dump.append(self.dump_attr(attr))
+            dump.append(html.escape(''.join(chars[x:x + n]), quote=False))
+            dump.append('</span>')
+            x += n
+        return ''.join(dump)
+
+    def dump(self, full=False):
+        """
+        Screen lines changed since the last dump, as HTML.
+
+        Every line is prefixed with its number and ends with a newline, the
+        whole screen is dumped (and flagged so) if `full` is set or the screen
+        size changed. Returns an empty string if nothing changed.
+        """
+        cx, cy = min(self.cx, self.w - 1), self.cy
+        if not self.vt100_mode_cursor:
+            cx = None
+        if full or len(self.dump_lines) != self.h:
+            full = True
+            self.dump_lines = [None] * self.h
+            self.dump_inverse = self.vt100_mode_inverse
+            self.dirty = bytearray(b'\x01' * self.h)
+        elif self.dump_inverse != self.vt100_mode_inverse:
+            self.dump_inverse = self.vt100_mode_inverse
+            self.dirty = bytearray(b'\x01' * self.h)
+        # Lines the cursor moved from and to
+        for y in (self.dump_cy, cy):
+            if 0 <= y < self.h:
+                self.dirty[y] = 1
+        self.dump_cy = cy
+
+        dump = []
+        y = self.dirty.find(1)
+        while y != -1:
+            line = self.dump_line(y, cx if y == cy else None)
+            if line != self.dump_lines[y]:
+                self.dump_lines[y] = line
+                dump.append('%03d%s\n' % (y, line))
+            y = self.dirty.find(1, y + 1)
+        self.dirty = bytearray(self.h)
+
+        if not dump:
             return ''
-        else:
-            self.dump_cache = dump
-            return '<c cy="%03d" />' % cy + dump
+        return '<c cy="%03d" f="%d" />' % (cy, full) + ''.join(dump)
 
 
 class SynchronizedMethod:
@@ -1469,10 +1575,10 @@ class Multiplex:
         return True
 
     # Dump terminal output
-    def proc_dump(self, sid):
+    def proc_dump(self, sid, full=False):
         if sid not in self.session:
             return False
-        return self.session[sid]['term'].dump()
+        return self.session[sid]['term'].dump(full)
 
     # Get alive sessions, bury timed out ones
     def proc_getalive(self):
@@ -3,6 +3,7 @@ import enum
 import json
 import logging
 import os
+import time
 
 from middlewared.alert.schedule import IntervalSchedule
 
@@ -178,8 +179,13 @@ class AlertSource:
     failover_related = False
     run_on_backup_node = True
 
+    # Seconds a single check may take before it is reported as failed
+    run_timeout = 30
+
     def __init__(self, middleware):
         self.middleware = middleware
+        # CPU time spent by the last check, for sources that can measure it
+        self.cpu_time = None
 
     @property
     def name(self):
@@ -200,7 +206,14 @@ class FilePresenceAlertSource(AlertSource):
 
 class ThreadedAlertSource(AlertSource):
     async def check(self):
-        return await self.middleware.run_in_thread(self.check_sync)
+        return await self.middleware.run_in_thread(self.__check_sync)
+
+    def __check_sync(self):
+        start = time.thread_time()
+        try:
+            return self.check_sync()
+        finally:
+            self.cpu_time = time.thread_time() - start
 
     def check_sync(self):
         raise NotImplementedError
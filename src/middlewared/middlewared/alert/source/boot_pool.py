@@ -12,7 +12,7 @@ class BootPoolStatusAlertClass(AlertClass):
 
 class BootPoolStatusAlertSource(AlertSource):
     async def check(self):
-        pool = await self.middleware.call("zfs.pool.query", [["id", "=", "freenas-boot"]])
+        pool = await self.middleware.call("zfs.cache.query", "POOL", [["id", "=", "freenas-boot"]])
         if not pool:
             return
         pool = pool[0]
@@ -12,6 +12,7 @@ import ctypes
 import errno
 import os
 import pickle
+import queue
 import socket
 import ssl
 import sys
@@ -46,6 +47,8 @@ class Event(TEvent):
 
 
 CALL_TIMEOUT = int(os.environ.get('CALL_TIMEOUT', 60))
+# Maximum number of chunks of a streamed call the server sends ahead of the consumer
+STREAM_WINDOW = 4
 
 
 class WSClient(WebSocketClient):
@@ -230,6 +233,9 @@ class Call(object):
         self.type = None
         self.extra = None
         self.py_exception = None
+        self.cursor = None
+        # Queue of `result_chunk` items, only set for streamed calls
+        self.chunks = None
 
 
 class Job(object):
@@ -329,6 +335,8 @@ class Client(object):
         self._jobs_lock = Lock()
         self._jobs_watching = False
         self._pings = {}
+        # The connection may be shared by threads, a message must not be interleaved with another one
+        self._send_lock = Lock()
         self._py_exceptions = py_exceptions
         self._event_callbacks = {}
         if uri is None:
@@ -362,7 +370,9 @@ class Client(object):
             raise
 
     def _send(self, data):
-        self._ws.send(json.dumps(data))
+        data = json.dumps(data)
+        with self._send_lock:
+            self._ws.send(data)
 
     def _recv(self, message):
         _id = message.get('id')
@@ -375,10 +385,17 @@ class Client(object):
             ping_event = self._pings.get(_id)
             if ping_event:
                 ping_event.set()
+        elif _id is not None and msg == 'result_chunk':
+            call = self._calls.get(_id)
+            if call and call.chunks is not None:
+                # Never blocks, the server does not send more than STREAM_WINDOW
+                # chunks the consumer has not acknowledged
+                call.chunks.put(message['result'])
         elif _id is not None and msg == 'result':
             call = self._calls.get(_id)
             if call:
                 call.result = message.get('result')
+                call.cursor = message.get('cursor')
                 if 'error' in message:
                     call.errno = message['error'].get('error')
                     call.error = message['error'].get('reason')
@@ -391,6 +408,8 @@ class Client(object):
                             call.py_exception
                         ))
                 call.returned.set()
+                if call.chunks is not None:
+                    call.chunks.put(None)
                 self._unregister_call(call)
         elif msg in ('added', 'changed', 'removed'):
             if self._event_callbacks:
@@ -423,12 +442,24 @@ class Client(object):
 
     def on_close(self, code, reason=None):
         self._closed.set()
+        # Do not let pending calls wait for a reply that will never come
+        for call in list(self._calls.values()):
+            call.errno = errno.ECONNABORTED
+            call.error = 'Connection closed'
+            call.returned.set()
+            if call.chunks is not None:
+                call.chunks.put(None)
+            self._unregister_call(call)
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
 
     def _register_call(self, call):
         self._calls[call.id] = call
 
     def _unregister_call(self, call):
-        self._calls.pop(call.id, None)
+        return self._calls.pop(call.id, None) is not None
 
     def _jobs_callback(self, mtype, **message):
         """
@@ -495,6 +526,59 @@ class Client(object):
 
         return c.result
 
+    def stream(self, method, filters=None, options=None, timeout=CALL_TIMEOUT):
+        """
+        Iterate over the result of a filterable `method` as it is received.
+
+        Items are sent by the server in chunks (`stream` query option) so that
+        neither side needs to hold the whole result in memory, each chunk being
+        acknowledged once consumed.
+        `timeout` applies to the wait for each chunk.
+        """
+        options = dict(options or {})
+        if options.get('count') or options.get('get'):
+            raise ValueError('count and get query options return a single value, use call() instead')
+        options['stream'] = True
+        options['stream_window'] = STREAM_WINDOW
+
+        c = Call(method, [filters or [], options])
+        c.chunks = queue.Queue()
+        self._register_call(c)
+        try:
+            self._send({
+                'msg': 'method',
+                'method': c.method,
+                'id': c.id,
+                'params': c.params,
+            })
+
+            received = 0
+            while True:
+                try:
+                    chunk = c.chunks.get(timeout=timeout)
+                except queue.Empty:
+                    raise CallTimeout("Call timeout")
+                if chunk is None:
+                    break
+                received += len(chunk)
+                yield from chunk
+                self._send({'msg': 'stream_ack', 'id': c.id, 'chunks': 1})
+        finally:
+            if self._unregister_call(c) and not self.closed:
+                # Consumer stopped early, tell the server to stop sending chunks
+                self._send({'msg': 'stream_ack', 'id': c.id, 'cancel': True})
+
+        if c.errno:
+            if c.py_exception:
+                raise c.py_exception
+            if c.trace and c.type == 'VALIDATION':
+                raise ValidationErrors(c.extra)
+            raise ClientException(c.error, c.errno, c.trace, c.extra)
+
+        # Result of a streamed call is the number of items sent
+        if c.result != received:
+            raise ClientException(f'{method} did not return a list of items')
+
     def subscribe(self, name, callback):
         ready = Event()
         _id = str(uuid.uuid4())
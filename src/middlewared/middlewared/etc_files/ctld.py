@@ -1,48 +1,130 @@
 #!/usr/local/bin/python
 from middlewared.client.utils import Struct
+from middlewared.utils.io import write_if_changed
+from collections import defaultdict, OrderedDict
 import contextlib
 import logging
 import os
+import re
 import sysctl
 
 logger = logging.getLogger(__name__)
 
 
-# NOTE
-# Normally global variables are a bad idea, and this is no
-# exception, however it was the best choice given that the
-# alternatives were duplicating a lot of code or doing
-# even more modifications to this script. Ideally you'd
-# instantiate a config object (or two)...
-
 # This file has plain text CHAP users and passwords in it, and is
 # the config file used by CTL.
 ctl_config = '/etc/ctl.conf'
-cf_contents = []
 # This file has the CHAP usernames and passwords replaced with
 # REDACTED.  It is consumed by freenas-debug.  We generate both
 # files every time the system determines a new config file
 # needs to be created from the database.
 ctl_config_shadow = '/etc/ctl.conf.shadow'
-cf_contents_shadow = []
-
-
-def addline(line, plaintextonly=False, shadowonly=False):
-    # Add "line" to both the shadow and plaintext config files
-    # The plaintextonly and shadowonly switches allow adding
-    # to only one of the files.  This is used in the one place
-    # that the shadow file diverges from the plain text file:
-    # CHAP passwords
-    if plaintextonly == shadowonly:
-        cf_contents.append(line)
-        cf_contents_shadow.append(line)
-    elif plaintextonly:
-        cf_contents.append(line)
-    elif shadowonly:
-        cf_contents_shadow.append(line)
-
 
-def auth_group_config(auth_tag=None, auth_list=None, auth_type=None, initiator=None):
+# Top level statement of ctl.conf, e.g. `lun "name" {` or `isns-server "host"`
+RE_SECTION = re.compile(r'^([a-z-]+) "([^"]*)"( \{)?$')
+
+
+class CtlConfig(object):
+    """
+    Lines of ctl.conf and of its shadow copy, grouped by the top level section (auth-group, portal-group, lun,
+    target...) they belong to so that two generations can be compared section by section.
+    """
+
+    def __init__(self):
+        self.sections = OrderedDict()
+        self.current = None
+
+    def section(self, kind, name):
+        key = (kind, name)
+        # ctld would refuse a duplicate section, keep it anyway so the file shows the problem
+        n = 1
+        while key in self.sections:
+            key = (kind, name, n)
+            n += 1
+        self.current = self.sections[key] = ([], [])
+
+    def addline(self, line, plaintextonly=False, shadowonly=False):
+        # Add "line" to both the shadow and plaintext config files
+        # The plaintextonly and shadowonly switches allow adding
+        # to only one of the files.  This is used in the one place
+        # that the shadow file diverges from the plain text file:
+        # CHAP passwords
+        contents, contents_shadow = self.current
+        if plaintextonly == shadowonly:
+            contents.append(line)
+            contents_shadow.append(line)
+        elif plaintextonly:
+            contents.append(line)
+        elif shadowonly:
+            contents_shadow.append(line)
+
+    def contents(self):
+        return ''.join(line for contents, shadow in self.sections.values() for line in contents)
+
+    def contents_shadow(self):
+        return ''.join(line for contents, shadow in self.sections.values() for line in shadow)
+
+    def section_texts(self):
+        return {key[:2]: ''.join(contents).strip() for key, (contents, shadow) in self.sections.items()}
+
+
+def parse_sections(text):
+    """
+    Split a ctl.conf generated by `CtlConfig` back into its top level sections.
+    """
+    sections = {}
+    key = None
+    lines = []
+    for line in text.splitlines():
+        if key is None:
+            m = RE_SECTION.match(line)
+            if not m:
+                continue
+            key = (m.group(1), m.group(2))
+            lines = [line]
+            if not m.group(3):
+                sections[key] = line
+                key = None
+        else:
+            lines.append(line)
+            if line == '}':
+                sections[key] = '\n'.join(lines)
+                key = None
+    return sections
+
+
+def diff_sections(old, new):
+    """
+    Structural difference between two sets of sections, as `(kind, name)` keys.
+    """
+    return {
+        'added': [key for key in new if key not in old],
+        'removed': [key for key in old if key not in new],
+        'changed': [key for key, text in new.items() if key in old and old[key] != text],
+    }
+
+
+def group_by(rows, field):
+    # Foreign keys are serialized as the related row
+    groups = defaultdict(list)
+    for row in rows:
+        value = row[field]
+        if isinstance(value, dict):
+            value = value['id']
+        groups[value].append(row)
+    return groups
+
+
+def split_list(value):
+    sep = '\n'
+    if ',' in value:
+        sep = ','
+    elif ' ' in value:
+        sep = ' '
+    return [x for x in value.strip('\n').split(sep) if x != 'ALL' and x != '']
+
+
+def auth_group_config(config, auth_tag=None, auth_list=None, auth_type=None, initiator=None):
     # First prepare all the lists, filtering out garpage.
     if auth_list is None:
         auth_list = []
@@ -50,101 +132,92 @@ def auth_group_config(auth_tag=None, auth_list=None, auth_type=None, initiator=N
     inets = []
     if initiator:
         if initiator.iscsi_target_initiator_initiators:
-            sep = '\n'
-            if ',' in initiator.iscsi_target_initiator_initiators:
-                sep = ','
-            elif ' ' in initiator.iscsi_target_initiator_initiators:
-                sep = ' '
-            inames = initiator.iscsi_target_initiator_initiators.strip('\n').split(sep)
-            inames = [x for x in inames if x != 'ALL' and x != '']
+            inames = split_list(initiator.iscsi_target_initiator_initiators)
         if initiator.iscsi_target_initiator_auth_network:
-            sep = '\n'
-            if ',' in initiator.iscsi_target_initiator_auth_network:
-                sep = ','
-            elif ' ' in initiator.iscsi_target_initiator_auth_network:
-                sep = ' '
-            inets = initiator.iscsi_target_initiator_auth_network.strip('\n').split(sep)
-            inets = [x for x in inets if x != 'ALL' and x != '']
+            inets = split_list(initiator.iscsi_target_initiator_auth_network)
 
     # If nothing left after filtering, then we are done.
     if not inames and not inets and not auth_list and (auth_type == 'None' or auth_type == 'auto'):
         return False
 
     # There are some real paremeters, so write the auth group.
-    addline('auth-group "%s" {\n' % auth_tag)
+    config.section('auth-group', auth_tag)
+    config.addline('auth-group "%s" {\n' % auth_tag)
     for name in inames:
-        addline('\tinitiator-name "%s"\n' % name.lstrip())
+        config.addline('\tinitiator-name "%s"\n' % name.lstrip())
     for name in inets:
-        addline('\tinitiator-portal "%s"\n' % name.lstrip())
+        config.addline('\tinitiator-portal "%s"\n' % name.lstrip())
     # It is an error to mix CHAP and Mutual CHAP in the same auth group
     # But not in istgt, so we need to catch this and do something.
     # For now just skip over doing something that would cause ctld to bomb
     for auth in auth_list:
         if auth.iscsi_target_auth_peeruser and auth_type != 'CHAP':
             auth_type = 'Mutual'
-            addline('\tchap-mutual "%s" "%s" "%s" "%s"\n' % (
+            config.addline('\tchap-mutual "%s" "%s" "%s" "%s"\n' % (
                 auth.iscsi_target_auth_user,
                 auth.iscsi_target_auth_secret,
                 auth.iscsi_target_auth_peeruser,
                 auth.iscsi_target_auth_peersecret,
             ), plaintextonly=True)
-            addline('\tchap-mutual "REDACTED" "REDACTED" "REDACTED" "REDACTED"\n', shadowonly=True)
+            config.addline('\tchap-mutual "REDACTED" "REDACTED" "REDACTED" "REDACTED"\n', shadowonly=True)
         elif auth_type != 'Mutual':
             auth_type = 'CHAP'
-            addline('\tchap "%s" "%s"\n' % (
+            config.addline('\tchap "%s" "%s"\n' % (
                 auth.iscsi_target_auth_user,
                 auth.iscsi_target_auth_secret,
             ), plaintextonly=True)
-            addline('\tchap "REDACTED" "REDACTED"\n', shadowonly=True)
+            config.addline('\tchap "REDACTED" "REDACTED"\n', shadowonly=True)
     if not auth_list and (auth_type == 'None' or auth_type == 'auto'):
-        addline('\tauth-type "none"\n')
-    addline('}\n\n')
+        config.addline('\tauth-type "none"\n')
+    config.addline('}\n\n')
     return True
 
 
-def main(middleware):
-    """Use the middleware to generate a config file. We'll build the
-    config file as a series of lines, and once that is done write it
-    out in one go"""
+def generate(middleware):
+    """Use the middleware to generate the config. Every table is loaded
+    upfront with a single query and the sections are built from in-memory
+    indexes, so the number of queries does not grow with the number of
+    portals, targets or extents."""
 
-    cf_contents.clear()
-    cf_contents_shadow.clear()
+    config = CtlConfig()
 
     gconf = Struct(middleware.call_sync('datastore.query', 'services.iSCSITargetGlobalConfiguration',
                                         None, {'get': True}))
     if gconf.iscsi_alua:
         node = middleware.call_sync('failover.node')
+        interfaces = middleware.call_sync('datastore.query', 'network.Interfaces')
+        aliases = middleware.call_sync('datastore.query', 'network.Alias')
+
+    auth_credentials = defaultdict(list)
+    for auth in middleware.call_sync('datastore.query', 'services.iSCSITargetAuthCredential'):
+        auth_credentials[auth['iscsi_target_auth_tag']].append(Struct(auth))
 
     if gconf.iscsi_isns_servers:
         for server in gconf.iscsi_isns_servers.split():
-            addline('isns-server "%s"\n\n' % server)
+            config.section('isns-server', server)
+            config.addline('isns-server "%s"\n\n' % server)
 
     # Generate the portal-group section
-    addline('portal-group "default" {\n}\n\n')
+    config.section('portal-group', 'default')
+    config.addline('portal-group "default" {\n}\n\n')
+    portal_ips = group_by(middleware.call_sync('datastore.query', 'services.iSCSITargetPortalIP'),
+                          'iscsi_target_portalip_portal')
     for pg in middleware.call_sync('datastore.query', 'services.iSCSITargetPortal'):
         pg = Struct(pg)
         # Prepare auth group for the portal group
         if pg.iscsi_target_portal_discoveryauthgroup:
-            auth_list = [
-                Struct(i)
-                for i in middleware.call_sync('datastore.query', 'services.iSCSITargetAuthCredential',
-                                              [('iscsi_target_auth_tag', '=',
-                                                pg.iscsi_target_portal_discoveryauthgroup)])
-            ]
+            auth_list = auth_credentials[pg.iscsi_target_portal_discoveryauthgroup]
         else:
             auth_list = []
         agname = 'ag4pg%d' % pg.iscsi_target_portal_tag
-        if not auth_group_config(auth_tag=agname,
+        if not auth_group_config(config,
+                                 auth_tag=agname,
                                  auth_list=auth_list,
                                  auth_type=pg.iscsi_target_portal_discoveryauthmethod):
             agname = 'no-authentication'
 
         # Prepare IPs to listen on for all portal groups.
-        portals = [
-            Struct(i)
-            for i in middleware.call_sync('datastore.query', 'services.iSCSITargetPortalIP',
-                                          [('iscsi_target_portalip_portal', '=', pg.id)])
-        ]
+        portals = [Struct(i) for i in portal_ips[pg.id]]
         listen = []
         listenA = []
         listenB = []
@@ -161,14 +234,14 @@ def main(middleware):
                     found = True
                     break
                 if not found:
-                    for net in middleware.call_sync('datastore.query', 'network.Interfaces'):
+                    for net in interfaces:
                         if net['int_vip'] == address and net['int_ipv4address'] and net['int_ipv4address_b']:
                             listenA.append('%s:%s' % (net['int_ipv4address'], portal.iscsi_target_portalip_port))
                             listenB.append('%s:%s' % (net['int_ipv4address_b'], portal.iscsi_target_portalip_port))
                             found = True
                             break
                 if not found:
-                    for alias in middleware.call_sync('datastore.query', 'network.Alias'):
+                    for alias in aliases:
                         if alias['alias_vip'] == address and alias['alias_v4address'] and alias['alias_v4address_b']:
                             listenA.append('%s:%s' % (alias['alias_v4address'], portal.iscsi_target_portalip_port))
                             listenB.append('%s:%s' % (alias['alias_v4address_b'], portal.iscsi_target_portalip_port))
@@ -179,41 +252,64 @@ def main(middleware):
 
         if gconf.iscsi_alua:
             # Two portal groups for ALUA HA case.
-            addline('portal-group "pg%dA" {\n' % pg.iscsi_target_portal_tag)
-            addline('\ttag "0x%04x"\n' % pg.iscsi_target_portal_tag)
-            addline('\tdiscovery-filter "portal-name"\n')
-            addline('\tdiscovery-auth-group "%s"\n' % agname)
+            config.section('portal-group', 'pg%dA' % pg.iscsi_target_portal_tag)
+            config.addline('portal-group "pg%dA" {\n' % pg.iscsi_target_portal_tag)
+            config.addline('\ttag "0x%04x"\n' % pg.iscsi_target_portal_tag)
+            config.addline('\tdiscovery-filter "portal-name"\n')
+            config.addline('\tdiscovery-auth-group "%s"\n' % agname)
             for i in listenA:
-                addline('\tlisten "%s"\n' % i)
+                config.addline('\tlisten "%s"\n' % i)
             if node != 'A':
-                addline('\tforeign\n')
-            addline('}\n')
-            addline('portal-group "pg%dB" {\n' % pg.iscsi_target_portal_tag)
-            addline('\ttag "0x%04x"\n' % (pg.iscsi_target_portal_tag + 0x8000))
-            addline('\tdiscovery-filter "portal-name"\n')
-            addline('\tdiscovery-auth-group "%s"\n' % agname)
+                config.addline('\tforeign\n')
+            config.addline('}\n')
+            config.section('portal-group', 'pg%dB' % pg.iscsi_target_portal_tag)
+            config.addline('portal-group "pg%dB" {\n' % pg.iscsi_target_portal_tag)
+            config.addline('\ttag "0x%04x"\n' % (pg.iscsi_target_portal_tag + 0x8000))
+            config.addline('\tdiscovery-filter "portal-name"\n')
+            config.addline('\tdiscovery-auth-group "%s"\n' % agname)
             for i in listenB:
-                addline('\tlisten "%s"\n' % i)
+                config.addline('\tlisten "%s"\n' % i)
             if node != 'B':
-                addline('\tforeign\n')
-            addline('}\n\n')
+                config.addline('\tforeign\n')
+            config.addline('}\n\n')
         else:
             # One portal group for non-HA and CARP HA cases.
-            addline('portal-group "pg%d" {\n' % pg.iscsi_target_portal_tag)
-            addline('\ttag "0x%04x"\n' % pg.iscsi_target_portal_tag)
-            addline('\tdiscovery-filter "portal-name"\n')
-            addline('\tdiscovery-auth-group "%s"\n' % agname)
+            config.section('portal-group', 'pg%d' % pg.iscsi_target_portal_tag)
+            config.addline('portal-group "pg%d" {\n' % pg.iscsi_target_portal_tag)
+            config.addline('\ttag "0x%04x"\n' % pg.iscsi_target_portal_tag)
+            config.addline('\tdiscovery-filter "portal-name"\n')
+            config.addline('\tdiscovery-auth-group "%s"\n' % agname)
             for i in listen:
-                addline('\tlisten "%s"\n' % i)
-            addline('\toption "ha_shared" "on"\n')
-            addline('}\n\n')
+                config.addline('\tlisten "%s"\n' % i)
+            config.addline('\toption "ha_shared" "on"\n')
+            config.addline('}\n\n')
 
     # Cache zpool threshold
     poolthreshold = {}
     zpoollist = middleware.call_sync('notifier.zpool_list')
+    is_freenas = middleware.call_sync('notifier.is_freenas')
+
+    extents = middleware.call_sync('datastore.query', 'services.iSCSITargetExtent')
+
+    # Disks backing extents and their devices, the first of each identifier wins like in a query
+    # ordered by expire time
+    disks = {}
+    disk_identifiers = [e['iscsi_target_extent_path'] for e in extents
+                        if e['iscsi_target_extent_type'] == 'Disk' and e['iscsi_target_extent_path']]
+    if disk_identifiers:
+        for disk in middleware.call_sync('datastore.query', 'storage.Disk',
+                                         [('disk_identifier', 'in', disk_identifiers)],
+                                         {'order_by': ['disk_expiretime']}):
+            disks.setdefault(disk['disk_identifier'], Struct(disk))
+        devices = middleware.call_sync('disk.identifiers_to_devices', [
+            disk.disk_identifier for disk in disks.values() if not disk.disk_multipath_name
+        ])
+
+    # All zvols at once, only if some of them need their size
+    zfslist = None
 
     # Generate the LUN section
-    for extent in middleware.call_sync('datastore.query', 'services.iSCSITargetExtent'):
+    for extent in extents:
         extent = Struct(extent)
         path = extent.iscsi_target_extent_path
         if not path:
@@ -223,16 +319,13 @@ def main(middleware):
         poolname = None
         lunthreshold = None
         if extent.iscsi_target_extent_type == 'Disk':
-            disk = middleware.call_sync('datastore.query', 'storage.Disk',
-                                        [('disk_identifier', '=', path)],
-                                        {'order_by': ['disk_expiretime']})
-            if not disk:
+            disk = disks.get(path)
+            if disk is None:
                 continue
-            disk = Struct(disk[0])
             if disk.disk_multipath_name:
                 path = '/dev/multipath/%s' % disk.disk_multipath_name
             else:
-                path = '/dev/%s' % middleware.call_sync('disk.identifier_to_device', disk.disk_identifier)
+                path = '/dev/%s' % devices[disk.disk_identifier]
         else:
             if not path.startswith('/mnt'):
                 poolname = path.split('/', 2)[1]
@@ -245,8 +338,9 @@ def main(middleware):
                         )
                 if extent.iscsi_target_extent_avail_threshold:
                     zvolname = path.split('/', 1)[1]
-                    zfslist = middleware.call_sync('notifier.zfs_list', zvolname, False, False, False, ['volume'])
-                    if zfslist:
+                    if zfslist is None:
+                        zfslist = middleware.call_sync('notifier.zfs_list', '', False, False, False, ['volume'])
+                    if zvolname in zfslist:
                         lunthreshold = int(zfslist[zvolname]['volsize'] *
                                            (extent.iscsi_target_extent_avail_threshold / 100.0))
                 path = '/dev/' + path
@@ -258,74 +352,79 @@ def main(middleware):
                                            (extent.iscsi_target_extent_avail_threshold / 100.0))
                     except OSError:
                         pass
-        addline('lun "%s" {\n' % extent.iscsi_target_extent_name)
-        addline('\tctl-lun "%d"\n' % (extent.id - 1))
+        config.section('lun', extent.iscsi_target_extent_name)
+        config.addline('lun "%s" {\n' % extent.iscsi_target_extent_name)
+        config.addline('\tctl-lun "%d"\n' % (extent.id - 1))
         size = extent.iscsi_target_extent_filesize
-        addline('\tpath "%s"\n' % path)
-        addline('\tblocksize "%s"\n' % extent.iscsi_target_extent_blocksize)
+        config.addline('\tpath "%s"\n' % path)
+        config.addline('\tblocksize "%s"\n' % extent.iscsi_target_extent_blocksize)
         if extent.iscsi_target_extent_pblocksize:
-            addline('\toption "pblocksize" "0"\n')
-        addline('\tserial "%s"\n' % (extent.iscsi_target_extent_serial, ))
+            config.addline('\toption "pblocksize" "0"\n')
+        config.addline('\tserial "%s"\n' % (extent.iscsi_target_extent_serial, ))
         padded_serial = extent.iscsi_target_extent_serial
         if not extent.iscsi_target_extent_xen:
             for i in range(31 - len(extent.iscsi_target_extent_serial)):
                 padded_serial += ' '
-        addline('\tdevice-id "iSCSI Disk      %s"\n' % padded_serial)
+        config.addline('\tdevice-id "iSCSI Disk      %s"\n' % padded_serial)
         if size != '0':
             if size.endswith('B'):
                 size = size.strip('B')
-            addline('\t\tsize "%s"\n' % size)
+            config.addline('\t\tsize "%s"\n' % size)
 
         # We can't change the vendor name of existing
         # LUNs without angering VMWare, but we can
         # use the right names going forward.
         if extent.iscsi_target_extent_legacy is True:
-            addline('\toption "vendor" "FreeBSD"\n')
+            config.addline('\toption "vendor" "FreeBSD"\n')
         else:
-            if middleware.call_sync('notifier.is_freenas'):
-                addline('\toption "vendor" "FreeNAS"\n')
+            if is_freenas:
+                config.addline('\toption "vendor" "FreeNAS"\n')
             else:
-                addline('\toption "vendor" "TrueNAS"\n')
+                config.addline('\toption "vendor" "TrueNAS"\n')
 
-        addline('\toption "product" "iSCSI Disk"\n')
-        addline('\toption "revision" "0123"\n')
-        addline('\toption "naa" "%s"\n' % extent.iscsi_target_extent_naa)
+        config.addline('\toption "product" "iSCSI Disk"\n')
+        config.addline('\toption "revision" "0123"\n')
+        config.addline('\toption "naa" "%s"\n' % extent.iscsi_target_extent_naa)
         if extent.iscsi_target_extent_insecure_tpc:
-            addline('\toption "insecure_tpc" "on"\n')
+            config.addline('\toption "insecure_tpc" "on"\n')
             if lunthreshold:
-                addline('\toption "avail-threshold" "%s"\n' % lunthreshold)
+                config.addline('\toption "avail-threshold" "%s"\n' % lunthreshold)
         if poolname is not None and poolname in poolthreshold:
-            addline('\toption "pool-avail-threshold" "%s"\n' % poolthreshold[poolname])
+            config.addline('\toption "pool-avail-threshold" "%s"\n' % poolthreshold[poolname])
         if extent.iscsi_target_extent_rpm == 'Unknown':
-            addline('\toption "rpm" "0"\n')
+            config.addline('\toption "rpm" "0"\n')
         elif extent.iscsi_target_extent_rpm == 'SSD':
-            addline('\toption "rpm" "1"\n')
+            config.addline('\toption "rpm" "1"\n')
         else:
-            addline('\toption "rpm" "%s"\n' % extent.iscsi_target_extent_rpm)
+            config.addline('\toption "rpm" "%s"\n' % extent.iscsi_target_extent_rpm)
         if extent.iscsi_target_extent_ro:
-            addline('\toption "readonly" "on"\n')
-        addline('}\n')
-        addline('\n')
+            config.addline('\toption "readonly" "on"\n')
+        config.addline('}\n')
+        config.addline('\n')
 
     # Generate the target section
     target_basename = gconf.iscsi_basename
+    target_groups = group_by(middleware.call_sync('datastore.query', 'services.iscsitargetgroups'), 'iscsi_target')
+    fc_ports = group_by(middleware.call_sync('datastore.query', 'services.fibrechanneltotarget'), 'fc_target')
+    target_extents = group_by(
+        middleware.call_sync('datastore.query', 'services.iscsitargettoextent', None,
+                             {'extra': {'select': {'null_first': 'iscsi_lunid IS NULL'}},
+                              'order_by': ['null_first', 'iscsi_lunid']}),
+        'iscsi_target',
+    )
     for target in middleware.call_sync('datastore.query', 'services.iSCSITarget'):
         target = Struct(target)
+        groups = [Struct(grp) for grp in target_groups[target.id]]
 
         authgroups = {}
-        for grp in middleware.call_sync('datastore.query', 'services.iscsitargetgroups',
-                                        [('iscsi_target', '=', target.id)]):
-            grp = Struct(grp)
+        for grp in groups:
             if grp.iscsi_target_authgroup:
-                auth_list = [
-                    Struct(i)
-                    for i in middleware.call_sync('datastore.query', 'services.iSCSITargetAuthCredential',
-                                                  [('iscsi_target_auth_tag', '=', grp.iscsi_target_authgroup)])
-                ]
+                auth_list = auth_credentials[grp.iscsi_target_authgroup]
             else:
                 auth_list = []
             agname = 'ag4tg%d_%d' % (target.id, grp.id)
-            if auth_group_config(auth_tag=agname,
+            if auth_group_config(config,
+                                 auth_tag=agname,
                                  auth_list=auth_list,
                                  auth_type=grp.iscsi_target_authtype,
                                  initiator=grp.iscsi_target_initiatorgroup):
@@ -333,65 +432,74 @@ def main(middleware):
         if (target.iscsi_target_name.startswith('iqn.') or
                 target.iscsi_target_name.startswith('eui.') or
                 target.iscsi_target_name.startswith('naa.')):
-            addline('target "%s" {\n' % target.iscsi_target_name)
+            name = target.iscsi_target_name
         else:
-            addline('target "%s:%s" {\n' % (target_basename, target.iscsi_target_name))
+            name = '%s:%s' % (target_basename, target.iscsi_target_name)
+        config.section('target', name)
+        config.addline('target "%s" {\n' % name)
         if target.iscsi_target_alias:
-            addline('\talias "%s"\n' % target.iscsi_target_alias)
+            config.addline('\talias "%s"\n' % target.iscsi_target_alias)
         elif target.iscsi_target_name:
-            addline('\talias "%s"\n' % target.iscsi_target_name)
+            config.addline('\talias "%s"\n' % target.iscsi_target_name)
 
-        for fctt in middleware.call_sync('datastore.query', 'services.fibrechanneltotarget',
-                                         [('fc_target', '=', target.id)]):
-            fctt = Struct(fctt)
-            addline('\tport "%s"\n' % fctt.fc_port)
+        for fctt in fc_ports[target.id]:
+            config.addline('\tport "%s"\n' % fctt['fc_port'])
 
-        for grp in middleware.call_sync('datastore.query', 'services.iscsitargetgroups',
-                                        [('iscsi_target', '=', target.id)]):
-            grp = Struct(grp)
+        for grp in groups:
             agname = authgroups.get(grp.id) or 'no-authentication'
             if gconf.iscsi_alua:
-                addline('\tportal-group "pg%dA" "%s"\n' % (grp.iscsi_target_portalgroup.iscsi_target_portal_tag,
-                                                           agname))
-                addline('\tportal-group "pg%dB" "%s"\n' % (grp.iscsi_target_portalgroup.iscsi_target_portal_tag,
-                                                           agname))
+                config.addline('\tportal-group "pg%dA" "%s"\n' % (
+                    grp.iscsi_target_portalgroup.iscsi_target_portal_tag, agname))
+                config.addline('\tportal-group "pg%dB" "%s"\n' % (
+                    grp.iscsi_target_portalgroup.iscsi_target_portal_tag, agname))
             else:
-                addline('\tportal-group "pg%d" "%s"\n' % (grp.iscsi_target_portalgroup.iscsi_target_portal_tag,
-                                                          agname))
-        addline('\n')
-        used_lunids = [
-            o['iscsi_lunid']
-            for o in middleware.call_sync('datastore.query', 'services.iscsitargettoextent',
-                                          [('iscsi_target', '=', target.id),
-                                           ('iscsi_lunid', '!=', None)])
-        ]
+                config.addline('\tportal-group "pg%d" "%s"\n' % (
+                    grp.iscsi_target_portalgroup.iscsi_target_portal_tag, agname))
+        config.addline('\n')
+        used_lunids = {o['iscsi_lunid'] for o in target_extents[target.id] if o['iscsi_lunid'] is not None}
         cur_lunid = 0
-        for t2e in middleware.call_sync('datastore.query', 'services.iscsitargettoextent',
-                                        [('iscsi_target', '=', target.id)],
-                                        {'extra': {'select': {'null_first': 'iscsi_lunid IS NULL'}},
-                                         'order_by': ['null_first', 'iscsi_lunid']}):
+        for t2e in target_extents[target.id]:
             t2e = Struct(t2e)
 
             if t2e.iscsi_lunid is None:
                 while cur_lunid in used_lunids:
                     cur_lunid += 1
-                addline('\tlun "%s" "%s"\n' % (cur_lunid,
-                                               t2e.iscsi_extent.iscsi_target_extent_name))
+                config.addline('\tlun "%s" "%s"\n' % (cur_lunid,
+                                                      t2e.iscsi_extent.iscsi_target_extent_name))
                 cur_lunid += 1
             else:
-                addline('\tlun "%s" "%s"\n' % (t2e.iscsi_lunid,
-                                               t2e.iscsi_extent.iscsi_target_extent_name))
-        addline('}\n\n')
+                config.addline('\tlun "%s" "%s"\n' % (t2e.iscsi_lunid,
+                                                      t2e.iscsi_extent.iscsi_target_extent_name))
+        config.addline('}\n\n')
+
+    return config
+
+
+def main(middleware):
+    """Generate the config files, writing them only if they changed.
+    Returns the structural difference with the previous config."""
+
+    config = generate(middleware)
+
+    try:
+        with open(ctl_config) as f:
+            old = parse_sections(f.read())
+    except FileNotFoundError:
+        old = {}
+    diff = diff_sections(old, config.section_texts())
 
     # Write out the CTL config file
-    with open(os.open(ctl_config, os.O_CREAT | os.O_WRONLY, 0o600), 'w') as fh:
-        for line in cf_contents:
-            fh.write(line)
+    write_if_changed(ctl_config, config.contents(), mode=0o600)
 
     # Write out the CTL config file with redacted CHAP passwords
-    with open(os.open(ctl_config_shadow, os.O_CREAT | os.O_WRONLY, 0o600), 'w') as fh:
-        for line in cf_contents_shadow:
-            fh.write(line)
+    write_if_changed(ctl_config_shadow, config.contents_shadow(), mode=0o600)
+
+    if any(diff.values()):
+        logger.debug('ctl.conf changes: %s', ', '.join(
+            f'{change} {kind} "{name}"' for change, keys in diff.items() for kind, name in keys
+        ))
+
+    return diff
 
 
 def set_ctl_ha_peer(middleware):
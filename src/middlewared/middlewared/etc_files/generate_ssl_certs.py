@@ -22,7 +22,6 @@ def write_certificates(certs):
 
 
 async def render(service, middleware):
-    certs = await middleware.call('certificate.query')
-    certs.extend((await middleware.call('certificateauthority.query')))
+    certs = await middleware.call('certificate.query') + await middleware.call('certificateauthority.query')
 
     await middleware.run_in_thread(write_certificates, certs)
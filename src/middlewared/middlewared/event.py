@@ -1,6 +1,8 @@
 import asyncio
 import threading
 
+from .client import ejson as json
+
 
 class Events(object):
 
@@ -20,6 +22,45 @@ class Events(object):
             yield k, {'description': v}
 
 
+class EncodedEvent(object):
+    """
+    Event message for websocket clients, encoded once for all of them.
+    """
+
+    def __init__(self, name, event_type, kwargs):
+        event = {
+            'msg': event_type.lower(),
+            'collection': name,
+        }
+        kwargs = kwargs.copy()
+        if 'id' in kwargs:
+            event['id'] = kwargs.pop('id')
+        if event_type in ('ADDED', 'CHANGED'):
+            if 'fields' in kwargs:
+                event['fields'] = kwargs.pop('fields')
+        if event_type == 'CHANGED':
+            if 'cleared' in kwargs:
+                event['cleared'] = kwargs.pop('cleared')
+        if kwargs:
+            event['extra'] = kwargs
+        self.message = json.dumps(event)
+
+        # Events of the same id are kept in order, a CHANGED event only setting fields
+        # can replace a queued one of its id setting no other fields
+        self.key = (name, event['id']) if 'id' in event else None
+        fields = event.get('fields')
+        if (
+            event_type == 'CHANGED' and isinstance(fields, dict) and
+            event.keys() <= {'msg', 'collection', 'id', 'fields'}
+        ):
+            self.fields = set(fields)
+        else:
+            self.fields = None
+
+    def replaces(self, queued):
+        return self.fields is not None and queued.fields is not None and self.fields >= queued.fields
+
+
 class EventSource(object):
 
     def __init__(self, middleware, app, ident, name, arg):
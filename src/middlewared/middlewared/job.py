@@ -1,20 +1,34 @@
 import asyncio
-from collections import OrderedDict
+from collections import defaultdict, deque, OrderedDict
 import copy
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import enum
+import heapq
+import itertools
 import logging
 import os
+import sqlite3
 import sys
 import time
 import traceback
 import threading
 
+from middlewared.client import ejson as json
 from middlewared.service_exception import CallError, ValidationError, ValidationErrors
 from middlewared.pipe import Pipes
 
 logger = logging.getLogger(__name__)
 
+JOBS_LEDGER_PATH = '/var/db/middlewared/jobs.db'
+# Number of finished jobs kept in the ledger
+JOBS_LEDGER_MAXLEN = 10000
+# Ledger records (JSON encoded) larger than this do not keep the job result
+JOBS_LEDGER_RECORD_MAXLEN = 65536
+# Number of finished jobs also kept in memory, older ones are only found in the ledger
+JOBS_FINISHED_MAXLEN = 100
+# Number of most recent finished jobs returned by a query without filters nor limit
+JOBS_QUERY_DEFAULT_LIMIT = 1000
+
 
 class State(enum.Enum):
     WAITING = 1
@@ -30,23 +44,22 @@ class JobSharedLock(object):
     Each job method can specify a lock which will be shared
     among all calls for that job and only one job can run at a time
     for this lock.
+
+    Jobs waiting for the lock are kept in FIFO order in `jobs`, only the
+    first one of them is offered to the scheduler at a time.
     """
 
     def __init__(self, queue, name):
         self.queue = queue
         self.name = name
-        self.jobs = []
+        self.jobs = deque()
+        # First job of `jobs` is in the ready queue or waiting for its method limit
+        self.scheduled = False
         self.semaphore = asyncio.Semaphore()
 
     def add_job(self, job):
         self.jobs.append(job)
 
-    def get_jobs(self):
-        return self.jobs
-
-    def remove_job(self, job):
-        self.jobs.remove(job)
-
     def locked(self):
         return self.semaphore.locked()
 
@@ -58,11 +71,25 @@ class JobSharedLock(object):
 
 
 class JobsQueue(object):
+    """
+    Jobs scheduler.
+
+    Jobs ready to run are kept in a heap ordered by priority and arrival.
+    A job with a lock only enters it once it is the first one waiting for
+    that lock and the lock is free, and a job whose method is already
+    running `max_concurrency` times waits aside until one of them finishes,
+    so picking the next job never scans the jobs that can not run.
+    """
 
-    def __init__(self, middleware):
+    def __init__(self, middleware, ledger_path=JOBS_LEDGER_PATH):
         self.middleware = middleware
-        self.deque = JobsDeque()
-        self.queue = []
+        self.ledger = JobsLedger(ledger_path)
+        # Keep numbering after the jobs we already have a record of
+        self.deque = JobsDeque(count=self.ledger.last_id())
+
+        # Heap of (-priority, sequence, job) ready to run
+        self.ready = []
+        self.sequence = itertools.count()
 
         # Event responsible for the job queue schedule loop.
         # This event is set and a new job is potentially ready to run
@@ -71,6 +98,11 @@ class JobsQueue(object):
         # Shared lock (JobSharedLock) dict
         self.job_locks = {}
 
+        # Jobs waiting for a running slot of their method
+        self.method_waiting = defaultdict(deque)
+        self.method_stats = defaultdict(lambda: {'running': 0, 'dispatched': 0, 'wait_total': 0, 'wait_max': 0})
+        self.queued_at = {}
+
         self.middleware.event_register('core.get_jobs', 'Updates on job changes.')
 
     def __getitem__(self, item):
@@ -84,25 +116,96 @@ class JobsQueue(object):
 
     def add(self, job):
         if job.options["lock_queue_size"] is not None:
-            lock = self.get_lock(job)
-            queued_jobs = [another_job for another_job in self.queue if self.get_lock(another_job) is lock]
-            if len(queued_jobs) >= job.options["lock_queue_size"]:
-                return queued_jobs[-1]
+            # Only look the lock up, a job that is not queued must not leave one behind
+            lock = self.job_locks.get(job.get_lock_name())
+            if lock is not None and lock.jobs and len(lock.jobs) >= job.options["lock_queue_size"]:
+                return lock.jobs[-1]
 
         self.deque.add(job)
-        self.queue.append(job)
+        self.queued_at[job.id] = time.monotonic()
+
+        lock = self.get_lock(job)
+        if lock is None:
+            self._push(job)
+        else:
+            lock.add_job(job)
+            self._schedule_lock(lock)
 
         if not job.options["transient"]:
             self.middleware.send_event('core.get_jobs', 'ADDED', id=job.id, fields=job.__encode__())
 
-        # A job has been added to the queue, let the queue scheduler run
-        self.queue_event.set()
-
         return job
 
     def remove(self, job_id):
         self.deque.remove(job_id)
 
+    def finish(self, job):
+        """
+        Record a finished `job` in the ledger, it may now be evicted from memory.
+        """
+        self.deque.finish(job.id)
+        asyncio.ensure_future(self.middleware.run_in_thread(self.ledger.add, job.__encode__()))
+
+    def query(self, filters=None, options=None):
+        """
+        Encoded jobs in memory along with finished jobs from the ledger, unfiltered.
+
+        Filters on ledger columns are pushed down to the ledger, as well as the
+        limit when results are ordered by id. Without filters nor limit only the
+        `JOBS_QUERY_DEFAULT_LIMIT` most recent jobs of the ledger are returned.
+        """
+        options = options or {}
+        jobs = {job_id: job.__encode__() for job_id, job in list(self.deque.all().items())}
+
+        limit = None
+        desc = options.get('order_by') == ['-id']
+        if options.get('limit') and not options.get('count') and options.get('order_by') in (None, [], ['id'], ['-id']):
+            # Jobs in memory may shadow ledger rows, fetch enough to fill the page anyway
+            limit = options.get('offset', 0) + options['limit'] + len(jobs)
+        elif not filters and not options.get('limit') and not options.get('count'):
+            # The ledger may hold many more, only the most recent ones are returned
+            limit = JOBS_QUERY_DEFAULT_LIMIT
+            desc = True
+
+        for record in self.ledger.query(filters, desc=desc, limit=limit):
+            jobs.setdefault(record['id'], record)
+        return sorted(jobs.values(), key=lambda job: job['id'])
+
+    def stats(self):
+        """
+        Queue depth, running jobs and time spent waiting to run per method and lock.
+        """
+        waiting = {id(job): job for _, _, job in self.ready}
+        for jobs in self.method_waiting.values():
+            waiting.update((id(job), job) for job in jobs)
+        for lock in self.job_locks.values():
+            waiting.update((id(job), job) for job in lock.jobs)
+
+        queued = defaultdict(int)
+        for job in waiting.values():
+            queued[job.method_name] += 1
+
+        methods = {}
+        for method in set(queued) | set(self.method_stats):
+            stats = self.method_stats[method]
+            methods[method] = {
+                'queued': queued[method],
+                'running': stats['running'],
+                'dispatched': stats['dispatched'],
+                'wait_avg': stats['wait_total'] / stats['dispatched'] if stats['dispatched'] else None,
+                'wait_max': stats['wait_max'],
+            }
+
+        return {
+            'queued': len(waiting),
+            'running': sum(i['running'] for i in methods.values()),
+            'methods': methods,
+            'locks': {
+                name: {'queued': len(lock.jobs), 'locked': lock.locked()}
+                for name, lock in self.job_locks.items()
+            },
+        }
+
     def get_lock(self, job):
         """
         Get a shared lock for a job
@@ -115,24 +218,38 @@ class JobsQueue(object):
         if lock is None:
             lock = JobSharedLock(self, name)
             self.job_locks[lock.name] = lock
-        lock.add_job(job)
         return lock
 
     def release_lock(self, job):
+        stats = self.method_stats[job.method_name]
+        stats['running'] -= 1
+        waiting = self.method_waiting.get(job.method_name)
+        if waiting:
+            self._push(waiting.popleft())
+            if not waiting:
+                self.method_waiting.pop(job.method_name)
+
         lock = job.get_lock()
         if not lock:
             return
-        # Remove job from lock list and release it so another job can use it
-        lock.remove_job(job)
+        # Release the lock so the next job waiting for it can be scheduled
         lock.release()
 
-        if len(lock.get_jobs()) == 0:
+        if lock.jobs:
+            self._schedule_lock(lock)
+        else:
             self.job_locks.pop(lock.name)
 
-        # Once a lock is released there could be another job in the queue
-        # waiting for the same lock
+    def _push(self, job):
+        heapq.heappush(self.ready, (-job.options.get('priority', 0), next(self.sequence), job))
+        # A job is ready, let the queue scheduler run
         self.queue_event.set()
 
+    def _schedule_lock(self, lock):
+        if not lock.scheduled and not lock.locked() and lock.jobs:
+            lock.scheduled = True
+            self._push(lock.jobs[0])
+
     async def __next__(self):
         """
         This is a blocking method.
@@ -141,29 +258,30 @@ class JobsQueue(object):
         while True:
             # Awaits a new event to look for a job
             await self.queue_event.wait()
-            found = None
-            for job in self.queue:
-                try:
-                    lock = self.get_lock(job)
-                except Exception:
-                    logger.error('Failed to get lock for %r', job, exc_info=True)
-                    lock = None
-                # Get job in the queue if it has no lock or its not locked
-                if lock is None or not lock.locked():
-                    found = job
-                    if lock:
-                        await job.set_lock(lock)
-                    break
-            if found:
-                # Unlocked job found to run
-                self.queue.remove(found)
-                # If there are no more jobs in the queue, clear the event
-                if len(self.queue) == 0:
-                    self.queue_event.clear()
-                return found
-            else:
-                # No jobs available to run, clear the event
-                self.queue_event.clear()
+            while self.ready:
+                job = heapq.heappop(self.ready)[2]
+
+                stats = self.method_stats[job.method_name]
+                limit = job.options.get('max_concurrency')
+                if limit is not None and stats['running'] >= limit:
+                    self.method_waiting[job.method_name].append(job)
+                    continue
+
+                lock = self.job_locks.get(job.get_lock_name())
+                if lock is not None:
+                    lock.jobs.popleft()
+                    lock.scheduled = False
+                    await job.set_lock(lock)
+
+                wait = time.monotonic() - self.queued_at.pop(job.id, time.monotonic())
+                stats['running'] += 1
+                stats['dispatched'] += 1
+                stats['wait_total'] += wait
+                stats['wait_max'] = max(stats['wait_max'], wait)
+                return job
+
+            # No jobs available to run, clear the event
+            self.queue_event.clear()
 
     async def run(self):
         while True:
@@ -173,14 +291,17 @@ class JobsQueue(object):
 
 class JobsDeque(object):
     """
-    A jobs deque to do not keep more than `maxlen` in memory
-    with a `id` assigner.
+    Jobs kept in memory with a `id` assigner.
+
+    Jobs waiting or running are kept along with the last `finished_maxlen` ones
+    to finish, older ones are evicted in the order they finished.
     """
 
-    def __init__(self, maxlen=1000):
-        self.maxlen = maxlen
-        self.count = 0
+    def __init__(self, finished_maxlen=JOBS_FINISHED_MAXLEN, count=0):
+        self.finished_maxlen = finished_maxlen
+        self.count = count
         self.__dict = OrderedDict()
+        self.__finished = deque()
 
     def __getitem__(self, item):
         return self.__dict[item]
@@ -194,20 +315,171 @@ class JobsDeque(object):
     def add(self, job):
         self.count += 1
         job.set_id(self.count)
-        if len(self.__dict) > self.maxlen:
-            for old_job_id, old_job in self.__dict.items():
-                if old_job.state in (State.SUCCESS, State.FAILED, State.ABORTED):
-                    self.remove(old_job_id)
-                    break
-            else:
-                logger.warning("There are %d jobs waiting or running", len(self.__dict))
         self.__dict[job.id] = job
 
+    def finish(self, job_id):
+        self.__finished.append(job_id)
+        while len(self.__finished) > self.finished_maxlen:
+            old_job_id = self.__finished.popleft()
+            # Transient jobs are removed as soon as they finish
+            if old_job_id in self.__dict:
+                self.remove(old_job_id)
+
     def remove(self, job_id):
         self.__dict[job_id].cleanup()
         del self.__dict[job_id]
 
 
+class JobsLedger(object):
+    """
+    Append-only SQLite record of finished jobs so their history is kept
+    out of memory and across middlewared restarts.
+
+    Records are encoded jobs without the columns used for filtering, which are
+    indexed, nor the logs path since logs are removed along with the job.
+    """
+
+    COLUMNS = {'id', 'method', 'state', 'time_started', 'time_finished'}
+    OPERATORS = {'=': '=', '!=': '!=', '>': '>', '>=': '>=', '<': '<', '<=': '<=', 'in': 'IN', 'nin': 'NOT IN'}
+
+    def __init__(self, path, maxlen=JOBS_LEDGER_MAXLEN):
+        self.path = path
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        try:
+            if path != ':memory:':
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = self._connect(path)
+        except (OSError, sqlite3.Error):
+            logger.warning('Failed to open jobs ledger %r, job history will not persist', path, exc_info=True)
+            self.conn = self._connect(':memory:')
+
+    def _connect(self, path):
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                method TEXT NOT NULL,
+                state TEXT NOT NULL,
+                time_started REAL,
+                time_finished REAL,
+                record TEXT NOT NULL
+            )
+        """)
+        for column in ('method', 'state', 'time_finished'):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS jobs_{column} ON jobs ({column})')
+        return conn
+
+    @staticmethod
+    def _timestamp(value):
+        # Same interpretation as the JSON encoder: naive datetimes are UTC
+        if value is None:
+            return None
+        if value.tzinfo:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return (value - datetime(1970, 1, 1)).total_seconds()
+
+    @staticmethod
+    def _datetime(value):
+        if value is None:
+            return None
+        return datetime(1970, 1, 1) + timedelta(seconds=value)
+
+    def last_id(self):
+        with self.lock:
+            return self.conn.execute('SELECT MAX(id) FROM jobs').fetchone()[0] or 0
+
+    def add(self, record):
+        slim = {k: v for k, v in record.items() if k not in self.COLUMNS and k != 'logs_path'}
+        try:
+            data = json.dumps(slim)
+        except TypeError:
+            logger.warning('Job %d result is not serializable', record['id'], exc_info=True)
+            data = json.dumps(dict(slim, result=None))
+        if len(data) > JOBS_LEDGER_RECORD_MAXLEN and slim['result'] is not None:
+            logger.debug('Job %d result is too large to be kept', record['id'])
+            data = json.dumps(dict(slim, result=None))
+
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                (record['id'], record['method'], record['state'], self._timestamp(record['time_started']),
+                 self._timestamp(record['time_finished']), data),
+            )
+            if record['id'] % 100 == 0:
+                self.conn.execute('DELETE FROM jobs WHERE id <= ?', (record['id'] - self.maxlen,))
+
+    def _where(self, filters):
+        """
+        SQL for the top level filters on ledger columns, others are ignored
+        and need to be applied to the result.
+        """
+        where = []
+        params = []
+        complete = True
+        for f in filters or []:
+            if len(f) != 3 or f[0] not in self.COLUMNS or f[1] not in self.OPERATORS:
+                complete = False
+                continue
+            name, op, value = f
+            if name.startswith('time_'):
+                convert = self._timestamp
+                if not all(isinstance(v, datetime) for v in (value if op in ('in', 'nin') else [value])):
+                    complete = False
+                    continue
+            else:
+                convert = None
+            if op in ('in', 'nin'):
+                values = [convert(v) if convert else v for v in value]
+                if not values:
+                    complete = False
+                    continue
+                where.append(f'{name} {self.OPERATORS[op]} ({", ".join("?" * len(values))})')
+                params.extend(values)
+            elif value is None:
+                if op not in ('=', '!='):
+                    complete = False
+                    continue
+                where.append(f'{name} IS {"NOT " if op == "!=" else ""}NULL')
+            else:
+                where.append(f'{name} {self.OPERATORS[op]} ?')
+                params.append(convert(value) if convert else value)
+        return where, params, complete
+
+    def query(self, filters=None, desc=False, limit=None):
+        """
+        Records matching `filters` ordered by id. `limit` only applies when
+        all of `filters` could be run in SQL.
+        """
+        where, params, complete = self._where(filters)
+        sql = 'SELECT id, method, state, time_started, time_finished, record FROM jobs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY id DESC' if desc else ' ORDER BY id'
+        if limit and complete:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+
+        records = []
+        for id, method, state, time_started, time_finished, data in rows:
+            record = json.loads(data)
+            record.update({
+                'id': id,
+                'method': method,
+                'state': state,
+                'logs_path': None,
+                'time_started': self._datetime(time_started),
+                'time_finished': self._datetime(time_finished),
+            })
+            records.append(record)
+        return records
+
+
 class Job(object):
     """
     Represents a long running call, methods marked with @job decorator
@@ -361,6 +633,7 @@ class Job(object):
             if self.options['transient']:
                 queue.remove(self.id)
             else:
+                queue.finish(self)
                 self.middleware.send_event('core.get_jobs', 'CHANGED', id=self.id, fields=self.__encode__())
 
     async def __run_body(self):
@@ -1,26 +1,30 @@
 from .apidocs import app as apidocs_app
 from .client import ejson as json
-from .event import EventSource, Events
+from .event import EncodedEvent, EventSource, Events
 from .job import Job, JobsQueue
-from .pipe import Pipes, Pipe
+from .pipe import Pipes, Pipe, PipeReader
 from .restful import RESTfulAPI
 from .schema import Error as SchemaError
 from .service import CallError, CallException, ValidationError, ValidationErrors
-from .utils import start_daemon_thread, LoadPluginsMixin
+from .utils import (
+    start_daemon_thread, LoadPluginsMixin, decode_query_cursor, encode_query_cursor, query_fingerprint,
+)
 from .utils.debug import get_threads_stacks
 from .utils.lock import SoftHardSemaphore, SoftHardSemaphoreLimit
+from .utils.threadpool import IoThreadPoolExecutor
 from .webui_auth import WebUIAuth
-from .worker import main_worker, worker_init
+from .worker import main_worker, worker_init, worker_ready
 from aiohttp import web
 from aiohttp.web_exceptions import HTTPPermanentRedirect
 from aiohttp.web_middlewares import normalize_path_middleware
 from aiohttp_wsgi import WSGIHandler
 from bsd.threading import set_thread_name
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import argparse
 import asyncio
 import binascii
+import codecs
 import concurrent.futures
 import concurrent.futures.process
 import errno
@@ -30,8 +34,7 @@ import linecache
 import multiprocessing
 import os
 import pickle
-import queue
-import select
+import psutil
 import setproctitle
 import signal
 import sys
@@ -43,6 +46,19 @@ import urllib.parse
 import uuid
 from . import logger
 
+QUERY_STREAM_CHUNK_SIZE = 500
+# Events without an id waiting to be sent to a client, the oldest are dropped when it falls further behind
+EVENTS_QUEUE_KEYLESS_MAXLEN = 1000
+# Size of the reads from job pipes and of the buffers between them and HTTP transfers
+FILE_TRANSFER_CHUNK_SIZE = 1048576
+PROCPOOL_SIZE = 5
+# Process pool is replaced by a new one once its workers have run that many calls between
+# them or one of them has grown past that many bytes of RSS (0 disables the limit)
+PROCPOOL_MAX_CALLS = 5000
+PROCPOOL_MAX_RSS = 512 * 1024 * 1024
+# Seconds between checks of the RSS of the process pool workers
+PROCPOOL_RSS_CHECK_INTERVAL = 60
+
 
 class Application(object):
 
@@ -70,6 +86,16 @@ class Application(object):
         self.__callbacks = defaultdict(list)
         self.__event_sources = {}
         self.__subscribed = {}
+        # Number of subscriptions to each event name, the client is in the middleware
+        # subscription index for the names it has any
+        self.__subscriptions = defaultdict(int)
+        # Events waiting to be sent, the last one queued for each id can be replaced by a newer one
+        self.__events = deque()
+        self.__events_pending = {}
+        self.__events_keyless = deque()
+        self.__events_task = None
+        # Chunks of each flow controlled streamed call the client is ready to receive
+        self.__streams = {}
 
     def register_callback(self, name, method):
         assert name in ('on_message', 'on_close')
@@ -159,11 +185,141 @@ class Application(object):
             }, **error_extra),
         })
 
+    def _prepare_query(self, message):
+        """
+        Handle the websocket specific `query-options` of filterable methods.
+
+        `cursor` is translated into an `offset` and `stream` is removed so the
+        method itself only ever sees regular pagination options.
+
+        Returns a dict describing how the result should be sent or None if
+        this is not a paginated/streamed query.
+        """
+        params = message.get('params') or []
+        if len(params) < 2 or not isinstance(params[1], dict):
+            return None
+        if not any(k in params[1] for k in ('cursor', 'stream', 'limit')):
+            return None
+        try:
+            methodobj = self.middleware._method_lookup(message['method'])[1]
+        except CallError:
+            return None
+        if not hasattr(methodobj, '_filterable'):
+            return None
+
+        filters, options = params[0], dict(params[1])
+        fingerprint = query_fingerprint(message['method'], filters, options)
+        cursor = options.pop('cursor', None)
+        if cursor is not None:
+            try:
+                options['offset'] = decode_query_cursor(fingerprint, cursor)
+            except ValueError as e:
+                raise ValidationError('query-options.cursor', str(e))
+        stream = options.pop('stream', False)
+        stream_window = options.pop('stream_window', 0)
+        message['params'] = [filters, options] + list(params[2:])
+        return {
+            'fingerprint': fingerprint,
+            'offset': options.get('offset') or 0,
+            'limit': options.get('limit') or 0,
+            'stream': stream,
+            'stream_window': stream_window,
+        }
+
+    async def _stream_result(self, message, result, window=0):
+        """
+        Send `result` as `result_chunk` messages of at most QUERY_STREAM_CHUNK_SIZE items.
+
+        Each chunk is awaited on the websocket so a slow client slows down the producer
+        instead of buffering the whole result in memory. With a `window` at most that
+        many chunks are sent ahead of the `stream_ack` messages of the client.
+        """
+        count = 0
+        credits = None
+        if window:
+            credits = self.__streams[message['id']] = asyncio.Semaphore(window)
+
+        async def send_chunk(chunk):
+            if credits is not None:
+                await credits.acquire()
+                if self.__streams.get(message['id']) is not credits:
+                    # Client stopped reading the stream
+                    return False
+            await self.response.send_str(json.dumps({
+                'id': message['id'],
+                'msg': 'result_chunk',
+                'result': chunk,
+            }))
+            return True
+
+        async def iter_chunks():
+            chunk = []
+            if isinstance(result, types.AsyncGeneratorType):
+                async for i in result:
+                    chunk.append(i)
+                    if len(chunk) == QUERY_STREAM_CHUNK_SIZE:
+                        yield chunk
+                        chunk = []
+            else:
+                for i in result:
+                    chunk.append(i)
+                    if len(chunk) == QUERY_STREAM_CHUNK_SIZE:
+                        yield chunk
+                        chunk = []
+            if chunk:
+                yield chunk
+
+        chunks = iter_chunks()
+        try:
+            async for chunk in chunks:
+                if not await send_chunk(chunk):
+                    break
+                count += len(chunk)
+        finally:
+            await chunks.aclose()
+            if self.__streams.get(message['id']) is credits:
+                self.__streams.pop(message['id'], None)
+        return count
+
+    def _stream_ack(self, message):
+        credits = self.__streams.get(message.get('id'))
+        if credits is None:
+            return
+        if message.get('cancel'):
+            self.__streams.pop(message['id'])
+            credits.release()
+            return
+        for i in range(message.get('chunks') or 1):
+            credits.release()
+
     async def call_method(self, message):
 
         try:
+            query = self._prepare_query(message)
             async with self._softhardsemaphore:
                 result = await self.middleware.call_method(self, message)
+
+            if query and isinstance(result, (list, types.GeneratorType, types.AsyncGeneratorType)):
+                if query['stream']:
+                    # Final result of a streamed query is the number of items sent
+                    result = count = await self._stream_result(message, result, query['stream_window'])
+                else:
+                    if isinstance(result, types.GeneratorType):
+                        result = list(result)
+                    elif isinstance(result, types.AsyncGeneratorType):
+                        result = [i async for i in result]
+                    count = len(result)
+                response = {
+                    'id': message['id'],
+                    'msg': 'result',
+                    'result': result,
+                }
+                # Full page returned, there may be more items to fetch
+                if query['limit'] and count == query['limit']:
+                    response['cursor'] = encode_query_cursor(query['fingerprint'], query['offset'] + count)
+                self._send(response)
+                return
+
             if isinstance(result, Job):
                 result = result.id
             elif isinstance(result, types.GeneratorType):
@@ -240,10 +396,14 @@ class Application(object):
                 'event_source': es,
                 'name': name,
             }
+            self.__subscription_add(name)
             # Start it after setting __event_sources or it can have a race condition
             start_daemon_thread(target=es.process)
         else:
+            if ident in self.__subscribed:
+                self.__subscription_remove(self.__subscribed[ident])
             self.__subscribed[ident] = name
+            self.__subscription_add(name)
 
         self._send({
             'msg': 'ready',
@@ -252,33 +412,76 @@ class Application(object):
 
     async def unsubscribe(self, ident):
         if ident in self.__subscribed:
-            self.__subscribed.pop(ident)
+            self.__subscription_remove(self.__subscribed.pop(ident))
         elif ident in self.__event_sources:
-            event_source = self.__event_sources[ident]['event_source']
-            await self.middleware.run_in_thread(event_source.cancel)
+            val = self.__event_sources.pop(ident)
+            self.__subscription_remove(val['name'])
+            await self.middleware.run_in_thread(val['event_source'].cancel)
+
+    def __subscription_add(self, name):
+        self.__subscriptions[name] += 1
+        if self.__subscriptions[name] == 1:
+            self.middleware.subscribe_wsclient(self, name)
+
+    def __subscription_remove(self, name):
+        self.__subscriptions[name] -= 1
+        if self.__subscriptions[name] == 0:
+            del self.__subscriptions[name]
+            self.middleware.unsubscribe_wsclient(self, name)
 
     def send_event(self, name, event_type, **kwargs):
-        if (
-            not any(i == name or i == '*' for i in self.__subscribed.values()) and
-            not any(i['name'] == name for i in self.__event_sources.values())
-        ):
+        """
+        Send an event to this client only, can be called from any thread.
+        """
+        if name not in self.__subscriptions and '*' not in self.__subscriptions:
             return
-        event = {
-            'msg': event_type.lower(),
-            'collection': name,
-        }
-        kwargs = kwargs.copy()
-        if 'id' in kwargs:
-            event['id'] = kwargs.pop('id')
-        if event_type in ('ADDED', 'CHANGED'):
-            if 'fields' in kwargs:
-                event['fields'] = kwargs.pop('fields')
-        if event_type == 'CHANGED':
-            if 'cleared' in kwargs:
-                event['cleared'] = kwargs.pop('cleared')
-        if kwargs:
-            event['extra'] = kwargs
-        self._send(event)
+        self.loop.call_soon_threadsafe(self._queue_event, EncodedEvent(name, event_type, kwargs))
+
+    def _queue_event(self, event):
+        """
+        Queue an event to be sent by the events task, must be called from the event loop.
+
+        A burst of CHANGED events of the same id is sent as the last one of them if
+        the client is slower than the events are sent. Events without an id can not be
+        replaced, only the last `EVENTS_QUEUE_KEYLESS_MAXLEN` of them are kept.
+        """
+        if event.key is not None:
+            queued = self.__events_pending.get(event.key)
+            if queued is not None and event.replaces(queued[0]):
+                queued[0] = event
+                return
+        # Mutable so the event can be replaced in place
+        queued = [event]
+        self.__events.append(queued)
+        if event.key is not None:
+            self.__events_pending[event.key] = queued
+        else:
+            self.__events_keyless.append(queued)
+            if len(self.__events_keyless) > EVENTS_QUEUE_KEYLESS_MAXLEN:
+                # Dropped in place, it is skipped when its turn comes
+                self.__events_keyless.popleft()[0] = None
+        if self.__events_task is None:
+            self.__events_task = asyncio.ensure_future(self.__send_events())
+
+    async def __send_events(self):
+        try:
+            while self.__events:
+                queued = self.__events.popleft()
+                event = queued[0]
+                if event is None:
+                    continue
+                if event.key is None:
+                    self.__events_keyless.popleft()
+                elif self.__events_pending.get(event.key) is queued:
+                    del self.__events_pending[event.key]
+                await self.response.send_str(event.message)
+        except Exception:
+            # Connection is closed, there is no one to send the remaining events to
+            self.__events.clear()
+            self.__events_pending.clear()
+            self.__events_keyless.clear()
+        finally:
+            self.__events_task = None
 
     def on_open(self):
         self.middleware.register_wsclient(self)
@@ -294,9 +497,19 @@ class Application(object):
         for ident, val in self.__event_sources.items():
             event_source = val['event_source']
             asyncio.ensure_future(self.middleware.run_in_thread(event_source.cancel))
+        self.__event_sources.clear()
+        self.__subscribed.clear()
+
+        for name in self.__subscriptions:
+            self.middleware.unsubscribe_wsclient(self, name)
+        self.__subscriptions.clear()
 
         self.middleware.unregister_wsclient(self)
 
+        for credits in self.__streams.values():
+            credits.release()
+        self.__streams.clear()
+
     async def on_message(self, message):
         # Run callbacks registered in plugins for on_message
         for method in self.__callbacks['on_message']:
@@ -342,6 +555,9 @@ class Application(object):
                 pong['id'] = message['id']
             self._send(pong)
             return
+        elif message['msg'] == 'stream_ack':
+            self._stream_ack(message)
+            return
 
         if not self.authenticated:
             self.send_error(message, errno.EACCES, 'Not authenticated')
@@ -355,22 +571,113 @@ class Application(object):
 
 class FileApplication(object):
 
-    def __init__(self, middleware, loop):
+    def __init__(self, middleware, loop, chunk_size=FILE_TRANSFER_CHUNK_SIZE):
         self.middleware = middleware
         self.loop = loop
+        self.chunk_size = chunk_size
         self.jobs = {}
+        self.file_locks = {}
 
     def register_job(self, job_id):
+        if job_id in self.jobs:
+            self.jobs[job_id].cancel()
         self.jobs[job_id] = self.middleware.loop.call_later(
             60, lambda: asyncio.ensure_future(self._cleanup_job(job_id)))
 
     async def _cleanup_job(self, job_id):
+        if job_id not in self.jobs:
+            return
         self.jobs[job_id].cancel()
         del self.jobs[job_id]
+        self.file_locks.pop(job_id, None)
 
         job = self.middleware.jobs[job_id]
         await job.pipes.close()
 
+    async def _read_pipe(self, pipe):
+        reader = PipeReader(self.loop, self.chunk_size)
+        await self.loop.connect_read_pipe(lambda: reader, pipe)
+        return reader
+
+    async def _write_pipe(self, pipe):
+        transport, protocol = await self.loop.connect_write_pipe(
+            lambda: asyncio.streams.FlowControlMixin(), pipe,
+        )
+        transport.set_write_buffer_limits(high=self.chunk_size)
+        return asyncio.StreamWriter(transport, protocol, None, self.loop)
+
+    async def _sendfile(self, request, resp, f, offset, count):
+        if hasattr(self.loop, 'sendfile'):
+            await self.loop.sendfile(request.transport, f, offset, count)
+        else:
+            while count > 0:
+                read = await self.middleware.run_in_thread(os.pread, f.fileno(), min(count, self.chunk_size), offset)
+                if read == b'':
+                    break
+                await resp.write(read)
+                offset += len(read)
+                count -= len(read)
+
+    async def _download_file(self, request, job_id, f, filename):
+        """
+        Send the job output that is a regular file, honoring a `Range` header
+        so that interrupted downloads can be resumed.
+        """
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Accept-Ranges': 'bytes',
+        }
+        size = os.fstat(f.fileno()).st_size
+
+        try:
+            http_range = request.http_range
+        except ValueError:
+            http_range = None
+        if http_range is None:
+            headers['Content-Range'] = f'bytes */{size}'
+            return web.Response(status=416, headers=headers)
+
+        start, stop = http_range.start, http_range.stop
+        if start is None and stop is None:
+            status = 200
+            start, stop = 0, size
+        else:
+            status = 206
+            if start is None:
+                start = 0
+            elif start < 0:
+                start, stop = max(size + start, 0), None
+            if stop is None or stop > size:
+                stop = size
+            if start >= stop:
+                headers['Content-Range'] = f'bytes */{size}'
+                return web.Response(status=416, headers=headers)
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+
+        resp = web.StreamResponse(status=status, headers=headers)
+        resp.content_length = stop - start
+
+        # Transfers share the file offset
+        lock = self.file_locks.setdefault(job_id, asyncio.Lock())
+        complete = False
+        try:
+            async with lock:
+                await resp.prepare(request)
+                # Headers have to be on the wire before the file, not with its first chunk
+                await resp.drain()
+                await self._sendfile(request, resp, f, start, stop - start)
+            complete = stop == size
+        finally:
+            # Give some more time to resume an interrupted download
+            if complete:
+                await self._cleanup_job(job_id)
+            elif job_id in self.jobs:
+                self.register_job(job_id)
+
+        await resp.write_eof()
+        return resp
+
     async def download(self, request):
         path = request.path.split('/')
         if not request.path[-1].isdigit():
@@ -411,23 +718,37 @@ class FileApplication(object):
             resp.set_status(410)
             return resp
 
+        output = job.pipes.output
+        reader = None
+        if output.file is None:
+            try:
+                reader = await self._read_pipe(output.r)
+                # The job may provide a file instead, closing the pipe
+                read = await reader.read()
+            except Exception:
+                if reader is not None:
+                    reader.transport.close()
+                await self._cleanup_job(job_id)
+                raise
+        if output.file is not None:
+            if reader is not None:
+                reader.transport.close()
+            return await self._download_file(request, job_id, output.file, filename)
+
         resp = web.StreamResponse(status=200, reason='OK', headers={
             'Content-Type': 'application/octet-stream',
             'Content-Disposition': f'attachment; filename="{filename}"',
             'Transfer-Encoding': 'chunked',
         })
-        await resp.prepare(request)
-
-        def do_copy():
-            while True:
-                read = job.pipes.output.r.read(1048576)
-                if read == b'':
-                    break
-                asyncio.run_coroutine_threadsafe(resp.write(read), loop=self.loop).result()
 
         try:
-            await self.middleware.run_in_thread(do_copy)
+            await resp.prepare(request)
+            while read != b'':
+                await resp.write(read)
+                read = await reader.read()
         finally:
+            # Pipe has to be detached from the event loop before it is closed, e.g. if the client went away
+            reader.transport.close()
             await self._cleanup_job(job_id)
 
         await resp.drain()
@@ -493,23 +814,20 @@ class FileApplication(object):
             resp.set_status(405)
             return resp
 
-        def copy():
-            while True:
-                read = asyncio.run_coroutine_threadsafe(
-                    filepart.read_chunk(1048576),
-                    loop=self.loop,
-                ).result()
-                if read == b'':
-                    break
-                job.pipes.input.w.write(read)
-
         try:
             job = await self.middleware.call(data['method'], *(data.get('params') or []),
                                              pipes=Pipes(input=self.middleware.pipe()))
+            writer = await self._write_pipe(job.pipes.input.w)
             try:
-                await self.middleware.run_in_thread(copy)
+                while True:
+                    read = await filepart.read_chunk(self.chunk_size)
+                    if read == b'':
+                        break
+                    writer.write(read)
+                    await writer.drain()
             finally:
-                await self.middleware.run_in_thread(job.pipes.input.w.close)
+                # Remaining buffered data is written before the pipe is closed
+                writer.close()
         except CallError as e:
             if e.errno == CallError.ENOMETHOD:
                 status_code = 422
@@ -529,108 +847,183 @@ class FileApplication(object):
         return resp
 
 
-class ShellWorkerThread(threading.Thread):
+class ShellWorker(object):
     """
-    Worker thread responsible for forking and running the shell
-    and spawning the reader and writer threads.
+    Forks the shell in a pty and relays it to and from the websocket within
+    the event loop.
+
+    Output is read when the pty is readable, as much as is available, and sent
+    as a single frame. Nothing is read until that frame has been sent, so a
+    slow websocket eventually blocks the shell writing to the pty.
+    The shell is reaped by the child watcher when SIGCHLD is received.
     """
 
-    def __init__(self, ws, input_queue, loop, jail=None):
+    READ_SIZE = 65536
+
+    def __init__(self, middleware, ws, loop, jail=None):
+        self.middleware = middleware
         self.ws = ws
-        self.input_queue = input_queue
         self.loop = loop
-        self.shell_pid = None
         self.jail = jail
-        self._die = False
-        super(ShellWorkerThread, self).__init__(daemon=True)
+        self.shell_pid = None
+        self.master_fd = None
+        # Multibyte characters may be split across reads
+        self.decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        self.input = bytearray()
+        self.exited = asyncio.Event()
+        self.relay_task = None
+        self._waiter = None
+
+    async def start(self):
+        # Forking a process as big as middlewared takes a while, do not hold the event loop meanwhile
+        self.shell_pid, self.master_fd = await self.middleware.run_in_thread(self._fork)
+        os.set_blocking(self.master_fd, False)
+        asyncio.get_child_watcher().add_child_handler(self.shell_pid, self._on_exit)
+        self.relay_task = asyncio.ensure_future(self.relay())
+
+    def _fork(self):
+        pid, master_fd = os.forkpty()
+        if pid == 0:
+            try:
+                for i in range(3, 1024):
+                    if i == master_fd:
+                        continue
+                    try:
+                        os.close(i)
+                    except Exception:
+                        pass
+                os.chdir('/root')
+                cmd = [
+                    '/usr/bin/login', '-fp', 'root',
+                ]
 
-    def run(self):
+                if self.jail is not None:
+                    cmd = [
+                        '/usr/local/bin/iocage',
+                        'console',
+                        '-f',
+                        self.jail
+                    ]
+                os.execve(cmd[0], cmd, {
+                    'TERM': 'xterm',
+                    'HOME': '/root',
+                    'LANG': 'en_US.UTF-8',
+                    'PATH': '/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/sbin:/usr/local/bin:/root/bin',
+                })
+            except BaseException:
+                # The child must never get back to running middlewared code
+                os._exit(1)
+        return pid, master_fd
 
-        self.shell_pid, master_fd = os.forkpty()
-        if self.shell_pid == 0:
-            for i in range(3, 1024):
-                if i == master_fd:
-                    continue
-                try:
-                    os.close(i)
-                except Exception:
-                    pass
-            os.chdir('/root')
-            cmd = [
-                '/usr/bin/login', '-fp', 'root',
-            ]
+    def _on_exit(self, pid, returncode):
+        self.loop.call_soon_threadsafe(self._exit)
 
-            if self.jail is not None:
-                cmd = [
-                    '/usr/local/bin/iocage',
-                    'console',
-                    '-f',
-                    self.jail
-                ]
-            os.execve(cmd[0], cmd, {
-                'TERM': 'xterm',
-                'HOME': '/root',
-                'LANG': 'en_US.UTF-8',
-                'PATH': '/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/sbin:/usr/local/bin:/root/bin',
-            })
+    def _exit(self):
+        self.exited.set()
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def read(self):
+        """
+        Read the output available, an empty bytes once the shell is gone.
+        """
+        while True:
+            try:
+                return os.read(self.master_fd, self.READ_SIZE)
+            except BlockingIOError:
+                pass
+            except OSError:
+                # EIO once the slave side is closed
+                return b''
 
-        def reader():
-            """
-            Reader thread for reading from pty file descriptor
-            and forwarding it to the websocket.
-            """
+            # Shell exited and all of its output has been read
+            if self.exited.is_set():
+                return b''
+
+            self._waiter = self.loop.create_future()
+            self.loop.add_reader(self.master_fd, self._wakeup)
+            try:
+                await self._waiter
+            finally:
+                self.loop.remove_reader(self.master_fd)
+                self._waiter = None
+
+    async def relay(self):
+        try:
             while True:
-                read = os.read(master_fd, 1024)
+                read = await self.read()
                 if read == b'':
                     break
-                asyncio.run_coroutine_threadsafe(
-                    self.ws.send_str(read.decode('utf8')), loop=self.loop
-                ).result()
-
-        def writer():
-            """
-            Writer thread for reading from input_queue and write to
-            the shell pty file descriptor.
-            """
-            while True:
-                try:
-                    get = self.input_queue.get(timeout=1)
-                    os.write(master_fd, get)
-                except queue.Empty:
-                    # If we timeout waiting in input query lets make sure
-                    # the shell process is still alive
-                    try:
-                        os.kill(self.shell_pid, 0)
-                    except ProcessLookupError:
-                        break
-
-        t_reader = threading.Thread(target=reader, daemon=True)
-        t_reader.start()
+                data = self.decoder.decode(read)
+                if data:
+                    await self.ws.send_str(data)
+            data = self.decoder.decode(b'', final=True)
+            if data:
+                await self.ws.send_str(data)
+        finally:
+            self.loop.remove_writer(self.master_fd)
+            os.close(self.master_fd)
+            self.master_fd = None
+        await self.ws.close()
 
-        t_writer = threading.Thread(target=writer, daemon=True)
-        t_writer.start()
+    def write(self, data):
+        """
+        Write websocket input to the shell, what the pty can not take right
+        away is written once it is writable.
+        """
+        if self.master_fd is None:
+            return
+        pending = bool(self.input)
+        self.input.extend(data)
+        if not pending:
+            self._write()
 
-        # Wait for shell to exit
-        while True:
-            try:
-                pid, rv = os.waitpid(self.shell_pid, os.WNOHANG)
-            except ChildProcessError:
-                break
-            if self._die:
-                return
-            if pid <= 0:
-                time.sleep(1)
+    def _write(self):
+        try:
+            written = os.write(self.master_fd, self.input)
+        except BlockingIOError:
+            written = 0
+        except OSError:
+            # Shell is gone
+            written = len(self.input)
+        del self.input[:written]
+        if self.input:
+            self.loop.add_writer(self.master_fd, self._write)
+        else:
+            self.loop.remove_writer(self.master_fd)
 
-        t_reader.join()
-        t_writer.join()
-        asyncio.run_coroutine_threadsafe(self.ws.close(), self.loop)
+    async def kill(self):
+        # If connection has been closed lets make sure shell is killed
+        if self.shell_pid and not self.exited.is_set():
+            for signum in (signal.SIGTERM, signal.SIGKILL):
+                try:
+                    os.kill(self.shell_pid, signum)
+                except ProcessLookupError:
+                    break
+                # If process has not died in 2 seconds, try the big gun
+                try:
+                    await asyncio.wait_for(self.exited.wait(), 2)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # If process has not died even with the big gun
+                # There is nothing else we can do, leave it be
+                asyncio.get_child_watcher().remove_child_handler(self.shell_pid)
+                self._exit()
 
-    def die(self):
-        self._die = True
+        if self.relay_task:
+            try:
+                await self.relay_task
+            except Exception:
+                pass
 
 
 class ShellConnectionData(object):
-    t_worker = None
+    worker = None
 
 
 class ShellApplication(object):
@@ -647,22 +1040,20 @@ class ShellApplication(object):
         try:
             await self.run(ws, request, conndata)
         except Exception:
-            if conndata.t_worker:
-                await self.worker_kill(conndata.t_worker)
+            if conndata.worker:
+                await conndata.worker.kill()
         finally:
             return ws
 
     async def run(self, ws, request, conndata):
 
-        # Each connection will have its own input queue
-        input_queue = queue.Queue()
         authenticated = False
 
         async for msg in ws:
             if authenticated:
-                # Add content of every message received in input queue
+                # Write content of every message received to the shell
                 try:
-                    input_queue.put(msg.data.encode())
+                    conndata.worker.write(msg.data.encode())
                 except UnicodeEncodeError:
                     # Should we handle Encode error?
                     # xterm.js seems to operate with the websocket in text mode,
@@ -694,47 +1085,18 @@ class ShellApplication(object):
                 })
 
                 jail = data.get('jail')
-                conndata.t_worker = ShellWorkerThread(ws=ws, input_queue=input_queue, loop=asyncio.get_event_loop(), jail=jail)
-                conndata.t_worker.start()
+                conndata.worker = ShellWorker(self.middleware, ws=ws, loop=asyncio.get_event_loop(), jail=jail)
+                await conndata.worker.start()
 
         # If connection was not authenticated, return earlier
         if not authenticated:
             return ws
 
-        if conndata.t_worker:
-            asyncio.ensure_future(self.worker_kill(conndata.t_worker))
+        if conndata.worker:
+            asyncio.ensure_future(conndata.worker.kill())
 
         return ws
 
-    async def worker_kill(self, t_worker):
-        # If connection has been closed lets make sure shell is killed
-        if t_worker.shell_pid:
-
-            try:
-                kqueue = select.kqueue()
-                kevent = select.kevent(t_worker.shell_pid, select.KQ_FILTER_PROC, select.KQ_EV_ADD | select.KQ_EV_ENABLE, select.KQ_NOTE_EXIT)
-                kqueue.control([kevent], 0)
-
-                os.kill(t_worker.shell_pid, signal.SIGTERM)
-
-                # If process has not died in 2 seconds, try the big gun
-                events = await self.middleware.run_in_thread(kqueue.control, None, 1, 2)
-                if not events:
-                    os.kill(t_worker.shell_pid, signal.SIGKILL)
-
-                    # If process has not died even with the big gun
-                    # There is nothing else we can do, leave it be and
-                    # release the worker thread
-                    events = await self.middleware.run_in_thread(kqueue.control, None, 1, 2)
-                    if not events:
-                        t_worker.die()
-            except ProcessLookupError:
-                pass
-
-        # Wait thread join in yet another thread to avoid event loop blockage
-        # There may be a simpler/better way to do this?
-        await self.middleware.run_in_thread(t_worker.join)
-
 
 class Middleware(LoadPluginsMixin):
 
@@ -742,7 +1104,7 @@ class Middleware(LoadPluginsMixin):
 
     def __init__(
         self, loop_debug=False, loop_monitor=True, overlay_dirs=None, debug_level=None,
-        log_handler=None, startup_seq_path=None,
+        log_handler=None, startup_seq_path=None, procpool_size=PROCPOOL_SIZE,
     ):
         super().__init__(overlay_dirs)
         self.logger = logger.Logger('middlewared', debug_level).getLogger()
@@ -763,8 +1125,19 @@ class Middleware(LoadPluginsMixin):
             initializer=lambda: set_thread_name('threadpool_ws'),
             max_workers=10,
         )
-        self.__init_procpool()
+        self.io_executor = IoThreadPoolExecutor(
+            name='io_thread',
+            core_size=10,
+            initializer=lambda: set_thread_name('io_thread'),
+        )
+        self.procpool_size = procpool_size
+        # Created once plugins are loaded, workers only load the modules they need
+        self.__procpool = None
+        self.__procpool_calls = 0
+        self.__procpool_pids = set()
         self.__wsclients = {}
+        # Websocket clients subscribed to each event name, `*` for every event
+        self.__wsclients_subscriptions = defaultdict(set)
         self.__events = Events()
         self.__event_sources = {}
         self.__event_subs = defaultdict(list)
@@ -801,6 +1174,9 @@ class Middleware(LoadPluginsMixin):
             on_modules_loaded=on_modules_loaded,
         )
 
+        # Workers are spawned and load their plugins while the setup functions run
+        self.__init_procpool()
+
         # TODO: Rework it when we have order defined for setup functions
         def sort_key(plugin__function):
             plugin, function = plugin__function
@@ -946,6 +1322,16 @@ class Middleware(LoadPluginsMixin):
     def unregister_wsclient(self, client):
         self.__wsclients.pop(client.session_id)
 
+    def subscribe_wsclient(self, client, name):
+        self.__wsclients_subscriptions[name].add(client)
+
+    def unsubscribe_wsclient(self, client, name):
+        clients = self.__wsclients_subscriptions.get(name)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.__wsclients_subscriptions[name]
+
     def register_hook(self, name, method, sync=True):
         """
         Register a hook under `name`.
@@ -999,7 +1385,7 @@ class Middleware(LoadPluginsMixin):
     async def _run_in_conn_threadpool(self, method, *args, **kwargs):
         """
         Threads to handle websocket connection are gated on `__threadpool`.
-        Any other calls should use `run_in_thread` as that launches its own thread
+        Any other calls should use `run_in_thread` as that never waits for a busy thread
         and does not cause deadlock waiting another thread to finish in the pool
         (which could happen on the stack call, e.g.
            service.foo calls something in using the thread pool and something also
@@ -1010,31 +1396,95 @@ class Middleware(LoadPluginsMixin):
 
     def __init_procpool(self):
         self.__procpool = concurrent.futures.ProcessPoolExecutor(
-            max_workers=5,
+            max_workers=self.procpool_size,
             initializer=functools.partial(
-                worker_init, self.overlay_dirs, self.debug_level, self.log_handler
+                worker_init, self.overlay_dirs, self.debug_level, self.log_handler, self._process_pool_modules,
             ),
         )
+        self.__procpool_calls = 0
+        self.__procpool_pids = set()
+        asyncio.ensure_future(self.__prewarm_procpool(self.__procpool))
+
+    async def __prewarm_procpool(self, procpool):
+        start = time.monotonic()
+        pids = await asyncio.gather(*[
+            self.run_in_executor(procpool, worker_ready) for i in range(self.procpool_size)
+        ], return_exceptions=True)
+        errors = [pid for pid in pids if isinstance(pid, Exception)]
+        if errors:
+            self.logger.warning('Failed to start process pool workers: %r', errors[0])
+            return
+        if procpool is self.__procpool:
+            self.__procpool_pids = set(pids)
+        self.logger.debug(
+            'Process pool workers ready in %.2f seconds (%d modules)',
+            time.monotonic() - start, len(self._process_pool_modules),
+        )
+
+    def __recycle_procpool(self, reason):
+        procpool = self.__procpool
+        # Calls already submitted are still run by the old workers before they exit
+        self.logger.debug('Recycling process pool workers after %s', reason)
+        self.__init_procpool()
+        procpool.shutdown(wait=False)
+
+    def __procpool_rss(self, pids):
+        rss = {}
+        for pid in pids:
+            try:
+                rss[pid] = psutil.Process(pid).memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    def __call_procpool_rss_check(self):
+        self.__loop.create_task(self.__procpool_rss_check())
+
+    async def __procpool_rss_check(self):
+        try:
+            procpool = self.__procpool
+            rss = await self.run_in_thread(self.__procpool_rss, self.__procpool_pids)
+            if procpool is self.__procpool:
+                for pid, pid_rss in rss.items():
+                    if pid_rss > PROCPOOL_MAX_RSS:
+                        self.__recycle_procpool(f'worker {pid} RSS of {pid_rss} bytes')
+                        break
+        except Exception:
+            self.logger.warning('Failed to check process pool workers RSS', exc_info=True)
+
+        self.__loop.call_later(PROCPOOL_RSS_CHECK_INTERVAL, self.__call_procpool_rss_check)
 
     async def run_in_proc(self, method, *args, **kwargs):
         retries = 2
         for i in range(retries):
+            procpool = self.__procpool
             try:
-                return await self.run_in_executor(self.__procpool, method, *args, **kwargs)
+                result = await self.run_in_executor(procpool, method, *args, **kwargs)
             except concurrent.futures.process.BrokenProcessPool:
                 if i == retries - 1:
                     raise
-                self.__init_procpool()
+                if procpool is self.__procpool:
+                    self.__init_procpool()
+                continue
+
+            if procpool is self.__procpool:
+                self.__procpool_calls += 1
+                if PROCPOOL_MAX_CALLS and self.__procpool_calls >= PROCPOOL_MAX_CALLS:
+                    self.__recycle_procpool(f'{self.__procpool_calls} calls')
+            return result
 
     async def run_in_thread(self, method, *args, **kwargs):
-        executor = concurrent.futures.ThreadPoolExecutor(
-            max_workers=1,
-            initializer=lambda: set_thread_name('io_thread'),
-        )
-        try:
-            return await self.loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
-        finally:
-            executor.shutdown(wait=False)
+        return await self.loop.run_in_executor(self.io_executor, functools.partial(method, *args, **kwargs))
+
+    def threadpool_stats(self):
+        return {
+            'io': self.io_executor.stats(),
+            'connection': {
+                'max_workers': self.__threadpool._max_workers,
+                'threads': len(self.__threadpool._threads),
+                'queued': self.__threadpool._work_queue.qsize(),
+            },
+        }
 
     def pipe(self):
         return Pipe(self)
@@ -1204,11 +1654,25 @@ class Middleware(LoadPluginsMixin):
 
         self.logger.trace(f'Sending event {name!r}:{event_type!r}:{kwargs!r}')
 
-        for session_id, wsclient in list(self.__wsclients.items()):
-            try:
-                wsclient.send_event(name, event_type, **kwargs)
-            except Exception:
-                self.logger.warn('Failed to send event {} to {}'.format(name, session_id), exc_info=True)
+        # Encoded once in the calling thread for every subscribed client
+        if name in self.__wsclients_subscriptions or '*' in self.__wsclients_subscriptions:
+            event = EncodedEvent(name, event_type, kwargs)
+        else:
+            event = None
+
+        if threading.get_ident() == self.__thread_id:
+            self.__send_event(name, event_type, kwargs, event)
+        else:
+            self.loop.call_soon_threadsafe(self.__send_event, name, event_type, kwargs, event)
+
+    def __send_event(self, name, event_type, kwargs, event):
+        if event is not None:
+            wsclients = self.__wsclients_subscriptions.get(name, set()) | self.__wsclients_subscriptions.get('*', set())
+            for wsclient in wsclients:
+                try:
+                    wsclient._queue_event(event)
+                except Exception:
+                    self.logger.warn('Failed to send event {} to {}'.format(name, wsclient.session_id), exc_info=True)
 
         # Send event also for internally subscribed plugins
         for handler in self.__event_subs.get(name, []):
@@ -1315,9 +1779,8 @@ class Middleware(LoadPluginsMixin):
         asyncio.ensure_future(self.jobs.run())
 
         self.__setup_periodic_tasks()
-
-        # Start up middleware worker process pool
-        self.__procpool._start_queue_management_thread()
+        if PROCPOOL_MAX_RSS:
+            self.__loop.call_later(PROCPOOL_RSS_CHECK_INTERVAL, self.__call_procpool_rss_check)
 
         runner = web.AppRunner(app, handle_signals=False, access_log=None)
         self.__loop.run_until_complete(runner.setup())
@@ -1381,6 +1844,7 @@ def main():
         'console',
         'file',
     ], default='console')
+    parser.add_argument('--procpool-size', type=int, default=PROCPOOL_SIZE)
     args = parser.parse_args()
 
     pidpath = '/var/run/middlewared.pid'
@@ -1413,6 +1877,7 @@ def main():
         debug_level=args.debug_level,
         log_handler=args.log_handler,
         startup_seq_path=startup_seq_path,
+        procpool_size=args.procpool_size,
     ).run()
 
 
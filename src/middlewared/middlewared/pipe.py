@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 
@@ -25,7 +26,81 @@ class Pipe:
         r, w = os.pipe()
         self.r = os.fdopen(r, "rb")
         self.w = os.fdopen(w, "wb")
+        # Real file the output is read from instead of the pipe, see `send_file`
+        self.file = None
+
+    def send_file(self, f):
+        """
+        Provide the regular file `f` as the output instead of copying it to the pipe,
+        from its start. It can then be downloaded with sendfile(2) and by ranges.
+
+        The write end of the pipe is closed, `f` can be closed by the caller right away.
+        """
+        self.file = os.fdopen(os.dup(f.fileno()), "rb")
+        self.w.close()
 
     async def close(self):
         await self.middleware.run_in_thread(self.r.close)
         await self.middleware.run_in_thread(self.w.close)
+        if self.file is not None:
+            await self.middleware.run_in_thread(self.file.close)
+
+
+class PipeReader(asyncio.Protocol):
+    """
+    Protocol for reading a pipe attached to the event loop with `connect_read_pipe`, in chunks
+    of `chunk_size`. The pipe is not read while a full chunk is waiting to be consumed.
+    """
+
+    def __init__(self, loop, chunk_size):
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.transport = None
+        self.chunks = []
+        self.size = 0
+        self.eof = False
+        self.exc = None
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.transport.pause_reading()
+            self._wakeup()
+
+    def eof_received(self):
+        self.eof = True
+        self._wakeup()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.exc = exc
+        self._wakeup()
+
+    def _wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def read(self):
+        """
+        Read a chunk, possibly shorter at the end of the pipe, where an empty bytes is returned.
+        """
+        if self.size < self.chunk_size and not self.eof:
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        if self.exc is not None and not self.chunks:
+            raise self.exc
+
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        if not self.eof:
+            self.transport.resume_reading()
+        return data
@@ -9,6 +9,8 @@ import ntplib
 import pwd
 import socket
 import subprocess
+import threading
+import time
 
 from dns import resolver
 from ldap.controls import SimplePagedResultsControl
@@ -58,23 +60,101 @@ class SSL(enum.Enum):
     USETLS = 'start_tls'
 
 
+# How many servers found in SRV records are probed at the same time
+SRV_PROBE_CONCURRENCY = 8
+# For how long a server that could not be connected to is tried after the ones that could
+SRV_PROBE_FAILURE_PENALTY = 300
+
+
+class SRVCache(object):
+    """
+    SRV lookup results, kept for the TTL of the records, and the outcome of connecting to the servers they
+    point to. There is one instance shared by everything that looks up domain controllers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.probes = {}
+
+    def get(self, host):
+        with self.lock:
+            entry = self.records.get(host)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+        return None
+
+    def put(self, host, records, ttl):
+        with self.lock:
+            self.records[host] = (time.monotonic() + ttl, records)
+
+    def flush(self):
+        with self.lock:
+            self.records.clear()
+            self.probes.clear()
+
+    def probe_done(self, host, port, latency):
+        """
+        Record the time it took to connect to `host`, `latency` being None if it could not be connected to.
+        """
+        with self.lock:
+            average, failed_at = self.probes.get((host, port), (None, None))
+            if latency is None:
+                self.probes[(host, port)] = (average, time.monotonic())
+            else:
+                # Moving average so that a single slow connection does not demote a server for good
+                average = latency if average is None else average * 0.7 + latency * 0.3
+                self.probes[(host, port)] = (average, None)
+
+    def order(self, servers):
+        """
+        Sort `servers` by SRV priority and then by how well they responded to previous probes: servers that
+        recently failed go last, then faster ones first. Servers never probed keep their SRV order after them.
+        """
+        now = time.monotonic()
+        with self.lock:
+            probes = dict(self.probes)
+
+        def key(server):
+            average, failed_at = probes.get((server['host'], server['port']), (None, None))
+            failed = failed_at is not None and now - failed_at < SRV_PROBE_FAILURE_PENALTY
+            return (
+                server['priority'],
+                failed,
+                average if average is not None else float('inf'),
+                server['weight'],
+            )
+
+        return sorted(servers, key=key)
+
+
+srv_cache = SRVCache()
+
+
 class ActiveDirectory_DNS(object):
     def __init__(self, **kwargs):
         super(ActiveDirectory_DNS, self).__init__()
         self.ad = kwargs.get('conf')
         self.logger = kwargs.get('logger')
+        self.executor = kwargs.get('executor')
         return
 
     def _get_SRV_records(self, host, dns_timeout):
         """
         Set resolver timeout to 1/3 of the lifetime. The timeout defines
         how long to wait before moving on to the next nameserver in resolv.conf
+
+        Records are kept in `srv_cache` for as long as their TTL allows.
         """
         srv_records = []
 
         if not host:
             return srv_records
 
+        cached = srv_cache.get(host)
+        if cached is not None:
+            return cached
+
         r = resolver.Resolver()
         r.lifetime = dns_timeout
         r.timeout = r.lifetime / 3
@@ -83,13 +163,25 @@ class ActiveDirectory_DNS(object):
 
             answers = r.query(host, 'SRV')
             srv_records = sorted(
-                answers,
-                key=lambda a: (int(a.priority), int(a.weight))
+                [
+                    {
+                        'host': a.target.to_text(True),
+                        'port': int(a.port),
+                        'priority': int(a.priority),
+                        'weight': int(a.weight),
+                    }
+                    for a in answers
+                ],
+                key=lambda a: (a['priority'], a['weight'])
             )
 
         except Exception:
             srv_records = []
 
+        else:
+            if answers.rrset.ttl > 0:
+                srv_cache.put(host, srv_records, answers.rrset.ttl)
+
         return srv_records
 
     def port_is_listening(self, host, port, timeout=1):
@@ -111,6 +203,23 @@ class ActiveDirectory_DNS(object):
 
         return ret
 
+    def _probe(self, host, port, timeout):
+        """
+        Time it takes to connect to `host`, None if it can not be connected to.
+        """
+        start = time.monotonic()
+        try:
+            self.port_is_listening(host, port, timeout=timeout)
+        except CallError as e:
+            if self.ad['verbose_logging']:
+                self.logger.debug(f'Failed to connect to [{host}:{port}]: {e}')
+            latency = None
+        else:
+            latency = time.monotonic() - start
+
+        srv_cache.probe_done(host, port, latency)
+        return latency
+
     def _get_servers(self, srv_prefix):
         """
         We will first try fo find servers based on our AD site. If we don't find
@@ -139,10 +248,12 @@ class ActiveDirectory_DNS(object):
             host = f"{srv_prefix.value}{self.ad['domainname']}"
             servers = self._get_SRV_records(host, self.ad['dns_timeout'])
 
+        # Cached records are shared, do not change them
+        servers = [dict(server) for server in servers]
         if SSL(self.ad['ssl']) == SSL.USESSL:
             for server in servers:
-                if server.port == 389:
-                    server.port = 636
+                if server['port'] == 389:
+                    server['port'] = 636
 
         return servers
 
@@ -151,18 +262,29 @@ class ActiveDirectory_DNS(object):
         :get_n_working_servers: often only a few working servers are needed and not the whole
         list available on the domain. This takes the SRV record type and number of servers to get
         as arguments.
+
+        Servers are probed concurrently in order of preference (see `SRVCache.order`) and the first
+        `number` of them that can be connected to are returned, so unreachable servers cost at most
+        one connection timeout in total instead of one each.
         """
-        servers = self._get_servers(srv)
+        servers = srv_cache.order(self._get_servers(srv))
         found_servers = []
-        for server in servers:
-            if len(found_servers) == number:
-                break
-
-            host = server.target.to_text(True)
-            port = int(server.port)
-            if self.port_is_listening(host, port, timeout=1):
-                server_info = {'host': host, 'port': port}
-                found_servers.append(server_info)
+        futures = []
+        try:
+            for i, server in enumerate(servers):
+                # Keep at most SRV_PROBE_CONCURRENCY probes running ahead of the server being waited for
+                while len(futures) < min(i + SRV_PROBE_CONCURRENCY, len(servers)):
+                    probe = servers[len(futures)]
+                    futures.append(self.executor.submit(self._probe, probe['host'], probe['port'], 1))
+
+                if futures[i].result() is not None:
+                    found_servers.append({'host': server['host'], 'port': server['port']})
+                    if len(found_servers) == number:
+                        break
+        finally:
+            # Servers not needed any more are not probed, the ones being probed time out on their own
+            for future in futures:
+                future.cancel()
 
         if self.ad['verbose_logging']:
             self.logger.debug(f'Request for [{number}] of server type [{srv.name}] returned: {found_servers}')
@@ -706,6 +828,8 @@ class ActiveDirectoryService(ConfigService):
             new,
             {'prefix': 'ad_'}
         )
+        # Domain controllers looked up for the previous configuration may not apply any more
+        srv_cache.flush()
 
         start = False
         stop = False
@@ -870,6 +994,7 @@ class ActiveDirectoryService(ConfigService):
         ad = await self.config()
         await self.middleware.call('datastore.update', self._config.datastore, ad['id'], {'ad_enable': False})
         await self._set_state(DSStatus['LEAVING'])
+        srv_cache.flush()
         await self.middleware.call('etc.generate', 'hostname')
         await self.middleware.call('kerberos.stop')
         await self.middleware.call('etc.generate', 'smb')
@@ -884,7 +1009,7 @@ class ActiveDirectoryService(ConfigService):
         if ad is None:
             ad = self.middleware.call_sync('activedirectory.config')
 
-        dcs = ActiveDirectory_DNS(conf=ad, logger=self.logger).get_n_working_servers(SRV['DOMAINCONTROLLER'], 3)
+        dcs = ActiveDirectory_DNS(conf=ad, logger=self.logger, executor=self.middleware.io_executor).get_n_working_servers(SRV['DOMAINCONTROLLER'], 3)
         if not dcs:
             raise CallError('Failed to open LDAP socket to any DC in domain.')
 
@@ -907,7 +1032,7 @@ class ActiveDirectoryService(ConfigService):
         if not ad:
             ad = self.middleware.call_sync('activedirectory.config')
 
-        pdc = ActiveDirectory_DNS(conf=ad, logger=self.logger).get_n_working_servers(SRV['PDC'], 1)
+        pdc = ActiveDirectory_DNS(conf=ad, logger=self.logger, executor=self.middleware.io_executor).get_n_working_servers(SRV['PDC'], 1)
         c = ntplib.NTPClient()
         response = c.request(pdc[0]['host'])
         ntp_time = datetime.datetime.fromtimestamp(response.tx_time)
@@ -1019,7 +1144,7 @@ class ActiveDirectoryService(ConfigService):
         set_new_cache = True if not dcs else False
 
         if not dcs:
-            dcs = ActiveDirectory_DNS(conf=ad, logger=self.logger).get_n_working_servers(SRV['DOMAINCONTROLLER'], 3)
+            dcs = ActiveDirectory_DNS(conf=ad, logger=self.logger, executor=self.middleware.io_executor).get_n_working_servers(SRV['DOMAINCONTROLLER'], 3)
 
         if set_new_cache:
             self.middleware.call_sync('activedirectory._set_cached_srv_records', SRV['DOMAINCONTROLLER'], ad['site'], dcs)
@@ -1042,7 +1167,7 @@ class ActiveDirectoryService(ConfigService):
         single point of failure, fall back to relying on normal DNS queries in this case.
         """
         ad = self.middleware.call_sync('activedirectory.config')
-        AD_DNS = ActiveDirectory_DNS(conf=ad, logger=self.logger)
+        AD_DNS = ActiveDirectory_DNS(conf=ad, logger=self.logger, executor=self.middleware.io_executor)
         krb_kdc = AD_DNS.get_n_working_servers(SRV['KERBEROSDOMAINCONTROLLER'], 3)
         krb_admin_server = AD_DNS.get_n_working_servers(SRV['KERBEROS'], 3)
         krb_kpasswd_server = AD_DNS.get_n_working_servers(SRV['KPASSWD'], 3)
@@ -1070,7 +1195,7 @@ class ActiveDirectoryService(ConfigService):
             return
 
         ad = self.middleware.call_sync('activedirectory.config')
-        pdc = ActiveDirectory_DNS(conf=ad, logger=self.logger).get_n_working_servers(SRV['PDC'], 1)
+        pdc = ActiveDirectory_DNS(conf=ad, logger=self.logger, executor=self.middleware.io_executor).get_n_working_servers(SRV['PDC'], 1)
         self.middleware.call_sync('system.ntpserver.create', {'address': pdc[0]['host'], 'prefer': True})
 
     @private
@@ -1086,7 +1211,7 @@ class ActiveDirectoryService(ConfigService):
         set_new_cache = True if not dcs else False
 
         if not dcs:
-            dcs = ActiveDirectory_DNS(conf=ad, logger=self.logger).get_n_working_servers(SRV['DOMAINCONTROLLER'], 3)
+            dcs = ActiveDirectory_DNS(conf=ad, logger=self.logger, executor=self.middleware.io_executor).get_n_working_servers(SRV['DOMAINCONTROLLER'], 3)
         if not dcs:
             raise CallError('Failed to open LDAP socket to any DC in domain.')
 
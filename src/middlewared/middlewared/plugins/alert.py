@@ -1,4 +1,5 @@
-from collections import defaultdict, namedtuple
+import asyncio
+from collections import defaultdict, deque, namedtuple
 import copy
 from datetime import datetime
 import errno
@@ -28,7 +29,7 @@ from middlewared.service import (
     job, periodic, private,
 )
 from middlewared.service_exception import CallError
-from middlewared.utils import bisect, load_modules, load_classes
+from middlewared.utils import load_modules, load_classes
 
 POLICIES = ["IMMEDIATELY", "HOURLY", "DAILY", "NEVER"]
 DEFAULT_POLICY = "IMMEDIATELY"
@@ -36,6 +37,11 @@ DEFAULT_POLICY = "IMMEDIATELY"
 ALERT_SOURCES = {}
 ALERT_SERVICES_FACTORIES = {}
 
+# How many alert sources are checked at the same time
+ALERT_SOURCES_CONCURRENCY = 8
+# How many runs of each alert source are kept in its timing history
+ALERT_SOURCE_HISTORY_LEN = 20
+
 AlertSourceLock = namedtuple("AlertSourceLock", ["source_name", "expires_at"])
 
 
@@ -69,11 +75,11 @@ class AlertPolicy:
         self.last_key_value_alerts = {}
 
     def receive_alerts(self, now, alerts):
-        alerts = {alert.uuid: alert for alert in alerts}
         gone_alerts = []
         new_alerts = []
         key = self.key(now)
         if key != self.last_key_value:
+            alerts = {alert.uuid: alert for alert in alerts}
             gone_alerts = [alert for alert in self.last_key_value_alerts.values() if alert.uuid not in alerts]
             new_alerts = [alert for alert in alerts.values() if alert.uuid not in self.last_key_value_alerts]
 
@@ -83,12 +89,124 @@ class AlertPolicy:
         return gone_alerts, new_alerts
 
 
+def alert_identity(alert):
+    return alert.node, alert.source, alert.klass, alert.key
+
+
+class AlertStore:
+    """
+    Current alerts, indexed by their identity (node, source, class, key), by uuid and by source.
+
+    There can only be one alert with a given identity, a newer one replaces the older.
+    """
+
+    def __init__(self, alerts=None):
+        self.alerts = {}
+        self.by_uuid = {}
+        self.by_source = defaultdict(dict)
+        for alert in alerts or []:
+            self.add(alert)
+
+    def __iter__(self):
+        return iter(list(self.alerts.values()))
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def get(self, alert):
+        """
+        Alert with the same identity as `alert`.
+        """
+        return self.alerts.get(alert_identity(alert))
+
+    def get_by_uuid(self, uuid):
+        return self.by_uuid.get(uuid)
+
+    def source_alerts(self, source):
+        return list(self.by_source[source].values())
+
+    def add(self, alert):
+        identity = alert_identity(alert)
+        existing = self.alerts.get(identity)
+        if existing is not None:
+            self.remove(existing)
+        old = self.by_uuid.get(alert.uuid)
+        if old is not None:
+            self.remove(old)
+
+        self.alerts[identity] = alert
+        self.by_uuid[alert.uuid] = alert
+        self.by_source[alert.source][identity] = alert
+
+    def remove(self, alert):
+        identity = alert_identity(alert)
+        if self.alerts.get(identity) is not alert:
+            return
+
+        del self.alerts[identity]
+        if self.by_uuid.get(alert.uuid) is alert:
+            del self.by_uuid[alert.uuid]
+        source_alerts = self.by_source[alert.source]
+        del source_alerts[identity]
+        if not source_alerts:
+            del self.by_source[alert.source]
+
+    def replace(self, old_alerts, new_alerts):
+        for alert in old_alerts:
+            self.remove(alert)
+        for alert in new_alerts:
+            self.add(alert)
+
+    def replace_source(self, source, alerts):
+        """
+        Replace all alerts of `source` with `alerts`, touching only the ones that have changed.
+
+        Returns the lists of alerts that are gone and that are new.
+        """
+        current = self.by_source.get(source, {})
+        alerts = {alert_identity(alert): alert for alert in alerts}
+
+        gone_alerts = [alert for identity, alert in current.items() if identity not in alerts]
+        new_alerts = [alert for identity, alert in alerts.items() if identity not in current]
+        for alert in gone_alerts:
+            self.remove(alert)
+        for identity, alert in alerts.items():
+            if current.get(identity) is not alert:
+                self.add(alert)
+
+        return gone_alerts, new_alerts
+
+
+def cancel_reraised_alerts(gone_alerts, new_alerts):
+    """
+    Leave out gone alerts that were raised again with the same class and key (i.e. by another source or node),
+    along with the alerts that replaced them.
+    """
+    new_by_key = defaultdict(deque)
+    for alert in new_alerts:
+        new_by_key[(alert.klass, alert.key)].append(alert)
+
+    cancelled = set()
+    still_gone_alerts = []
+    for alert in gone_alerts:
+        reraised = new_by_key.get((alert.klass, alert.key))
+        if reraised:
+            cancelled.add(id(reraised.popleft()))
+        else:
+            still_gone_alerts.append(alert)
+
+    return still_gone_alerts, [alert for alert in new_alerts if id(alert) not in cancelled]
+
+
 class AlertService(Service):
     def __init__(self, middleware):
         super().__init__(middleware)
 
         self.blocked_sources = defaultdict(set)
         self.sources_locks = {}
+        # Checks that are still running, possibly after having timed out
+        self.sources_running = {}
+        self.sources_history = defaultdict(lambda: deque(maxlen=ALERT_SOURCE_HISTORY_LEN))
 
         self.blocked_failover_alerts_until = 0
 
@@ -117,7 +235,7 @@ class AlertService(Service):
                 for cls in load_classes(module, _AlertService, (ThreadedAlertService, ProThreadedAlertService)):
                     ALERT_SERVICES_FACTORIES[cls.name()] = cls
 
-        self.alerts = []
+        self.alerts = AlertStore()
         for alert in await self.middleware.call("datastore.query", "system.alert"):
             del alert["id"]
 
@@ -134,7 +252,7 @@ class AlertService(Service):
 
             alert = Alert(**alert)
 
-            self.alerts.append(alert)
+            self.alerts.add(alert)
 
         self.alert_source_last_run = defaultdict(lambda: datetime.min)
 
@@ -196,6 +314,30 @@ class AlertService(Service):
             for klass in sum([v["classes"] for v in await self.list_categories()], [])
         ]
 
+    @private
+    async def sources_stats(self):
+        """
+        Timing history of every alert source run on this node, slowest sources first.
+        """
+        now = time.monotonic()
+        stats = []
+        for name, alert_source in ALERT_SOURCES.items():
+            history = list(self.sources_history[name])
+            durations = [run["duration"] for run in history]
+            running = self.sources_running.get(name)
+            stats.append({
+                "name": name,
+                "timeout": alert_source.run_timeout,
+                "running_for": now - running.started_at if running is not None else None,
+                "last_run": history[-1] if history else None,
+                "average_duration": sum(durations) / len(durations) if durations else None,
+                "max_duration": max(durations) if durations else None,
+                "timeouts": len([run for run in history if run["timed_out"]]),
+                "history": history,
+            })
+
+        return sorted(stats, key=lambda source: source["average_duration"] or 0, reverse=True)
+
     @accepts()
     async def list(self):
         """
@@ -236,31 +378,24 @@ class AlertService(Service):
 
         return nodes
 
-    def __alert_by_uuid(self, uuid):
-        try:
-            return [a for a in self.alerts if a.uuid == uuid][0]
-        except IndexError:
-            return None
-
     @accepts(Str("uuid"))
     async def dismiss(self, uuid):
         """
         Dismiss `id` alert.
         """
 
-        alert = self.__alert_by_uuid(uuid)
+        alert = self.alerts.get_by_uuid(uuid)
         if alert is None:
             return
 
         if issubclass(alert.klass, DismissableAlertClass):
-            related_alerts, unrelated_alerts = bisect(lambda a: (a.node, a.klass) == (alert.node, alert.klass),
-                                                      self.alerts)
-            self.alerts = (
-                unrelated_alerts +
-                await alert.klass(self.middleware).dismiss(related_alerts, alert)
+            related_alerts = [a for a in self.alerts if (a.node, a.klass) == (alert.node, alert.klass)]
+            self.alerts.replace(
+                related_alerts,
+                await alert.klass(self.middleware).dismiss(related_alerts, alert),
             )
         elif issubclass(alert.klass, OneShotAlertClass) and not alert.klass.deleted_automatically:
-            self.alerts = [a for a in self.alerts if a.uuid != uuid]
+            self.alerts.remove(alert)
         else:
             alert.dismissed = True
 
@@ -270,7 +405,7 @@ class AlertService(Service):
         Restore `id` alert which had been dismissed.
         """
 
-        alert = self.__alert_by_uuid(uuid)
+        alert = self.alerts.get_by_uuid(uuid)
         if alert is None:
             return
 
@@ -296,39 +431,42 @@ class AlertService(Service):
     @job(lock="process_alerts", transient=True)
     async def send_alerts(self, job):
         classes = (await self.middleware.call("alertclasses.config"))["classes"]
+        alert_services_descs = await self.middleware.call("datastore.query", "system.alertservice",
+                                                          [["enabled", "=", True]])
 
-        now = datetime.now()
-        for policy_name, policy in self.policies.items():
-            gone_alerts, new_alerts = policy.receive_alerts(now, self.alerts)
+        alerts = list(self.alerts)
 
-            for alert_service_desc in await self.middleware.call("datastore.query", "system.alertservice",
-                                                                 [["enabled", "=", True]]):
-                service_gone_alerts = [
-                    alert for alert in gone_alerts
-                    if (
-                        AlertLevel[classes.get(alert.klass.name, {}).get("level", alert.klass.level.name)].value >=
-                        AlertLevel[alert_service_desc["level"]].value and
+        klass_settings = {}
 
-                        classes.get(alert.klass.name, {}).get("policy", DEFAULT_POLICY) == policy_name and
+        def settings(klass):
+            if klass not in klass_settings:
+                klass_settings[klass] = (
+                    AlertLevel[classes.get(klass.name, {}).get("level", klass.level.name)].value,
+                    classes.get(klass.name, {}).get("policy", DEFAULT_POLICY),
+                )
+            return klass_settings[klass]
 
-                        not (issubclass(alert.klass, OneShotAlertClass) and not alert.klass.deleted_automatically)
-                    )
-                ]
-                service_new_alerts = [
-                    alert for alert in new_alerts
-                    if (
-                        AlertLevel[classes.get(alert.klass.name, {}).get("level", alert.klass.level.name)].value >=
-                        AlertLevel[alert_service_desc["level"]].value and
-
-                        classes.get(alert.klass.name, {}).get("policy", DEFAULT_POLICY) == policy_name
-                    )
-                ]
-                for gone_alert in list(service_gone_alerts):
-                    for new_alert in service_new_alerts:
-                        if gone_alert.klass == new_alert.klass and gone_alert.key == new_alert.key:
-                            service_gone_alerts.remove(gone_alert)
-                            service_new_alerts.remove(new_alert)
-                            break
+        now = datetime.now()
+        for policy_name, policy in self.policies.items():
+            gone_alerts, new_alerts = policy.receive_alerts(now, alerts)
+            if not gone_alerts and not new_alerts:
+                continue
+
+            gone_alerts = [
+                alert for alert in gone_alerts
+                if (
+                    settings(alert.klass)[1] == policy_name and
+                    not (issubclass(alert.klass, OneShotAlertClass) and not alert.klass.deleted_automatically)
+                )
+            ]
+            policy_new_alerts = [alert for alert in new_alerts if settings(alert.klass)[1] == policy_name]
+
+            for alert_service_desc in alert_services_descs:
+                level = AlertLevel[alert_service_desc["level"]].value
+                service_gone_alerts, service_new_alerts = cancel_reraised_alerts(
+                    [alert for alert in gone_alerts if settings(alert.klass)[0] >= level],
+                    [alert for alert in policy_new_alerts if settings(alert.klass)[0] >= level],
+                )
 
                 if not service_gone_alerts and not service_new_alerts:
                     continue
@@ -345,9 +483,9 @@ class AlertService(Service):
                                       alert_service_desc["type"], alert_service_desc["attributes"], exc_info=True)
                     continue
 
-                if self.alerts or service_gone_alerts or service_new_alerts:
+                if alerts or service_gone_alerts or service_new_alerts:
                     try:
-                        await alert_service.send(self.alerts, service_gone_alerts, service_new_alerts)
+                        await alert_service.send(alerts, service_gone_alerts, service_new_alerts)
                     except Exception:
                         self.logger.error("Error in alert service %r", alert_service_desc["type"], exc_info=True)
 
@@ -431,6 +569,7 @@ class AlertService(Service):
             if source_lock.expires_at <= time.monotonic():
                 await self.unblock_source(k)
 
+        alert_sources = []
         for alert_source in ALERT_SOURCES.values():
             if not alert_source.schedule.should_run(datetime.utcnow(), self.alert_source_last_run[alert_source.name]):
                 continue
@@ -440,9 +579,31 @@ class AlertService(Service):
 
             self.alert_source_last_run[alert_source.name] = datetime.utcnow()
 
+            alert_sources.append(alert_source)
+
+        # Sources are checked concurrently, each bounded by its own timeout, but their results are merged in order
+        semaphore = asyncio.Semaphore(ALERT_SOURCES_CONCURRENCY)
+        results = await asyncio.gather(*[
+            self.__collect_source_alerts(alert_source, semaphore, master_node, backup_node, run_on_backup_node)
+            for alert_source in alert_sources
+        ], return_exceptions=True)
+
+        for alert_source, alerts in zip(alert_sources, results):
+            if isinstance(alerts, Exception):
+                self.logger.error("Unhandled exception running alert source %r", alert_source.name,
+                                  exc_info=alerts)
+                continue
+
+            for alert in alerts:
+                self.__handle_alert(alert)
+
+            self.alerts.replace_source(alert_source.name, alerts)
+
+    async def __collect_source_alerts(self, alert_source, semaphore, master_node, backup_node, run_on_backup_node):
+        async with semaphore:
             alerts_a = [alert
-                        for alert in self.alerts
-                        if alert.node == master_node and alert.source == alert_source.name]
+                        for alert in self.alerts.source_alerts(alert_source.name)
+                        if alert.node == master_node]
             locked = False
             if self.blocked_sources[alert_source.name]:
                 self.logger.debug("Not running alert source %r because it is blocked", alert_source.name)
@@ -461,8 +622,8 @@ class AlertService(Service):
             if run_on_backup_node and alert_source.run_on_backup_node:
                 try:
                     alerts_b = [alert
-                                for alert in self.alerts
-                                if alert.node == backup_node and alert.source == alert_source.name]
+                                for alert in self.alerts.source_alerts(alert_source.name)
+                                if alert.node == backup_node]
                     try:
                         if not locked:
                             alerts_b = await self.middleware.call("failover.call_remote", "alert.run_source",
@@ -499,23 +660,10 @@ class AlertService(Service):
             for alert in alerts_b:
                 alert.node = backup_node
 
-            for alert in alerts_a + alerts_b:
-                self.__handle_alert(alert)
-
-            self.alerts = (
-                [a for a in self.alerts if a.source != alert_source.name] +
-                alerts_a +
-                alerts_b
-            )
+            return alerts_a + alerts_b
 
     def __handle_alert(self, alert):
-        try:
-            existing_alert = [
-                a for a in self.alerts
-                if (a.node, a.source, a.klass, a.key) == (alert.node, alert.source, alert.klass, alert.key)
-            ][0]
-        except IndexError:
-            existing_alert = None
+        existing_alert = self.alerts.get(alert)
 
         if existing_alert is None:
             alert.uuid = self.__uuid()
@@ -561,10 +709,30 @@ class AlertService(Service):
     async def __run_source(self, source_name):
         alert_source = ALERT_SOURCES[source_name]
 
+        # A check that has timed out is left running (threads can not be cancelled) and is waited for again
+        # instead of starting another one next time
+        run = self.sources_running.get(source_name)
+        if run is None:
+            run = asyncio.ensure_future(self.__check_source(alert_source))
+            run.started_at = time.monotonic()
+            run.add_done_callback(lambda fut: self.__source_done(source_name, fut))
+            self.sources_running[source_name] = run
+
         try:
-            alerts = (await alert_source.check()) or []
+            alerts = (await asyncio.wait_for(asyncio.shield(run), alert_source.run_timeout)) or []
         except UnavailableException:
             raise
+        except asyncio.TimeoutError:
+            alerts = [
+                Alert(AlertSourceRunFailedAlertClass,
+                      args={
+                          "source_name": alert_source.name,
+                          "traceback": (f"Check has been running for {int(time.monotonic() - run.started_at)} "
+                                        f"seconds (timeout is {alert_source.run_timeout} seconds)"),
+                      },
+                      # Elapsed time changes every run, the alert must not be raised again because of it
+                      key=alert_source.name)
+            ]
         except Exception as e:
             if isinstance(e, CallError) and e.errno in [errno.ECONNREFUSED, errno.EHOSTDOWN, errno.ETIMEDOUT]:
                 alerts = [
@@ -591,6 +759,37 @@ class AlertService(Service):
 
         return alerts
 
+    async def __check_source(self, alert_source):
+        started_at = datetime.utcnow()
+        start = time.monotonic()
+        alert_source.cpu_time = None
+        result = "SUCCESS"
+        try:
+            return await alert_source.check()
+        except UnavailableException:
+            result = "UNAVAILABLE"
+            raise
+        except Exception:
+            result = "FAILED"
+            raise
+        finally:
+            duration = time.monotonic() - start
+            self.sources_history[alert_source.name].append({
+                "started_at": started_at,
+                "duration": duration,
+                "cpu_time": alert_source.cpu_time,
+                "timed_out": duration > alert_source.run_timeout,
+                "result": result,
+            })
+
+    def __source_done(self, source_name, fut):
+        if self.sources_running.get(source_name) is fut:
+            del self.sources_running[source_name]
+
+        # Retrieve the exception so that a check nobody waits for anymore is not reported as unhandled
+        if not fut.cancelled():
+            fut.exception()
+
     @periodic(3600)
     @private
     async def flush_alerts(self):
@@ -601,13 +800,30 @@ class AlertService(Service):
         ):
             return
 
-        await self.middleware.call("datastore.delete", "system.alert", [])
-
+        rows = {}
         for alert in self.alerts:
             d = alert.__dict__.copy()
             d["klass"] = d["klass"].name
             del d["mail"]
-            await self.middleware.call("datastore.insert", "system.alert", d)
+            rows[alert.uuid] = d
+
+        # Rows as they are now, the table may have been replicated from the other node (e.g. after a failover)
+        # since the last flush so row ids can not be remembered
+        flushed_alerts = {}
+        for row in await self.middleware.call("datastore.query", "system.alert"):
+            flushed_alerts[row["uuid"]] = (row.pop("id"), row)
+
+        # Deleted rows go first so that inserting an alert that took over their identity does not violate uniqueness
+        gone = [alert_id for alert_uuid, (alert_id, row) in flushed_alerts.items() if alert_uuid not in rows]
+        if gone:
+            await self.middleware.call("datastore.delete", "system.alert", [["id", "in", gone]])
+
+        for alert_uuid, d in rows.items():
+            flushed = flushed_alerts.get(alert_uuid)
+            if flushed is None:
+                await self.middleware.call("datastore.insert", "system.alert", d)
+            elif flushed[1] != d:
+                await self.middleware.call("datastore.update", "system.alert", flushed[0], d)
 
     @private
     @accepts(Str("klass"), Any("args", null=True))
@@ -632,7 +848,7 @@ class AlertService(Service):
 
         self.__handle_alert(alert)
 
-        self.alerts = [a for a in self.alerts if a.uuid != alert.uuid] + [alert]
+        self.alerts.add(alert)
 
         await self.middleware.call("alert.send_alerts")
 
@@ -648,11 +864,10 @@ class AlertService(Service):
         if not issubclass(klass, OneShotAlertClass):
             raise CallError(f"Alert class {klass!r} is not a one-shot alert source")
 
-        related_alerts, unrelated_alerts = bisect(lambda a: (a.node, a.klass) == (self.node, klass),
-                                                  self.alerts)
-        self.alerts = (
-            unrelated_alerts +
-            await klass(self.middleware).delete(related_alerts, query)
+        related_alerts = [a for a in self.alerts if (a.node, a.klass) == (self.node, klass)]
+        self.alerts.replace(
+            related_alerts,
+            await klass(self.middleware).delete(related_alerts, query),
         )
 
         await self.middleware.call("alert.send_alerts")
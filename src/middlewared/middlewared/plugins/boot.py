@@ -16,7 +16,7 @@ class BootService(Service):
         """
         Returns the current state of the boot pool, including all vdevs, properties and datasets.
         """
-        return await self.middleware.call('zfs.pool.query', [('name', '=', 'freenas-boot')], {'get': True})
+        return await self.middleware.call('zfs.cache.query', 'POOL', [('name', '=', 'freenas-boot')], {'get': True})
 
     @accepts()
     async def get_disks(self):
@@ -35,22 +35,48 @@ class ConfigService(Service):
         if options is None:
             options = {}
 
-        if not options.get('secretseed'):
-            bundle = False
-            filename = FREENAS_DATABASE
-        else:
-            bundle = True
-            filename = tempfile.mkstemp()[1]
-            os.chmod(filename, 0o600)
-            with tarfile.open(filename, 'w') as tar:
-                tar.add(FREENAS_DATABASE, arcname='freenas-v1.db')
-                tar.add('/data/pwenc_secret', arcname='pwenc_secret')
-
-        with open(filename, 'rb') as f:
-            await self.middleware.run_in_thread(shutil.copyfileobj, f, job.pipes.output.w)
+        # The file is read as it is downloaded (possibly resumed), send a consistent copy of the database
+        # instead of the live one
+        database = await self.middleware.run_in_thread(self.__database_snapshot)
+        try:
+            if not options.get('secretseed'):
+                filename = database
+            else:
+                filename = tempfile.mkstemp()[1]
+                os.chmod(filename, 0o600)
+                try:
+                    with tarfile.open(filename, 'w') as tar:
+                        tar.add(database, arcname='freenas-v1.db')
+                        tar.add('/data/pwenc_secret', arcname='pwenc_secret')
+                except Exception:
+                    os.remove(filename)
+                    raise
+
+            with open(filename, 'rb') as f:
+                job.pipes.output.send_file(f)
+
+            if filename != database:
+                os.remove(filename)
+        finally:
+            os.remove(database)
 
-        if bundle:
+    def __database_snapshot(self):
+        filename = tempfile.mkstemp()[1]
+        os.chmod(filename, 0o600)
+        try:
+            src = sqlite3.connect(FREENAS_DATABASE)
+            try:
+                dst = sqlite3.connect(filename)
+                try:
+                    src.backup(dst)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
+        except Exception:
             os.remove(filename)
+            raise
+        return filename
 
     @accepts()
     @job(pipes=["input"])
@@ -1,5 +1,5 @@
 from middlewared.service import CallError, Service, ValidationErrors
-from middlewared.schema import accepts, Any, Bool, Dict, List, Ref, Str
+from middlewared.schema import accepts, Any, Dict, List, Ref, Str
 from sqlite3 import OperationalError
 
 import os
@@ -15,7 +15,7 @@ if not apps.ready:
     django.setup()
 
 from django.apps import apps
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.db.models.fields.related import ForeignKey, ManyToManyField
 
@@ -25,7 +25,7 @@ from django.db.models.fields.related import ForeignKey, ManyToManyField
 from freenasUI.freeadmin.sqlite3_ha import base as sqlite3_ha_base
 sqlite3_ha_base.execute_sync = True
 
-from middlewared.utils import django_modelobj_serialize
+from middlewared.utils import django_model_prefetch, django_modelobj_serialize
 
 
 class DatastoreService(Service):
@@ -98,21 +98,8 @@ class DatastoreService(Service):
 
     @accepts(
         Str('name'),
-        List('query-filters', default=None, null=True, register=True),
-        Dict(
-            'query-options',
-            Str('extend', default=None, null=True),
-            Str('extend_context', default=None, null=True),
-            Str('prefix', default=None, null=True),
-            Dict('extra', additional_attrs=True),
-            List('order_by', default=[]),
-            List('select', default=[]),
-            Bool('count', default=False),
-            Bool('get', default=False),
-            default=None,
-            null=True,
-            register=True,
-        ),
+        Ref('query-filters'),
+        Ref('query-options'),
     )
     def query(self, name, filters=None, options=None):
         """Query for items in a given collection `name`.
@@ -132,6 +119,18 @@ class DatastoreService(Service):
 
         `[ ['username', '=', 'root' ] ]`
 
+        `offset` and `limit` options can be used to paginate the result, `limit` of 0 meaning no limit.
+
+        Over the websocket, filterable methods also accept:
+
+          - `cursor`: token returned in the `cursor` key of the previous page result message,
+            used instead of `offset` to fetch the next page.
+          - `stream`: send items in `result_chunk` messages before the final `result` message,
+            which then contains the number of items sent.
+          - `stream_window`: send at most that many `result_chunk` messages ahead of the
+            `{"msg": "stream_ack", "id": <call id>, "chunks": <count>}` messages of the client,
+            `{"msg": "stream_ack", "id": <call id>, "cancel": true}` stops the stream.
+
         .. examples(websocket)::
 
           Querying for username "root" and returning a single item:
@@ -178,6 +177,18 @@ class DatastoreService(Service):
         if options.get('count') is True:
             return qs.count()
 
+        offset = options.get('offset') or 0
+        limit = options.get('limit') or 0
+        if options.get('get') is True:
+            limit = 1
+        if offset or limit:
+            qs = qs[offset:offset + limit if limit else None]
+
+        # Fetch every relation needed by serialization upfront, one query per relation
+        prefetch = django_model_prefetch(model, prefix, options.get('select'))
+        if prefetch:
+            qs = qs.prefetch_related(*prefetch)
+
         result = []
         for i in self.__queryset_serialize(
             qs, options.get('extend'), options.get('extend_context'), options.get('prefix'), options.get('select'),
@@ -315,6 +326,24 @@ class DatastoreService(Service):
             model.objects.get(pk=id_or_filters).delete()
         return True
 
+    @accepts(List('operations', items=[List('operation')]))
+    def transaction(self, operations):
+        """
+        Run `operations`, a list of `insert`, `update` or `delete` calls, in a single transaction.
+
+        Every operation is the method name followed by its arguments, e.g.
+        ["update", "storage.disk", "{serial}1234", {"disk_name": "da0"}].
+
+        Returns the results of the operations.
+        """
+        results = []
+        with transaction.atomic():
+            for method, *args in operations:
+                if method not in ('insert', 'update', 'delete'):
+                    raise CallError(f'Invalid operation {method!r}')
+                results.append(getattr(self, method)(*args))
+        return results
+
     def sql(self, query, params=None):
         cursor = connection.cursor()
         try:
@@ -335,6 +364,26 @@ class DatastoreService(Service):
             cursor.close()
         return rv
 
+    @accepts(List('queries', items=[List('query')]))
+    def sql_batch(self, queries):
+        """
+        Run `queries`, a list of [query, params], in a single transaction.
+
+        This is how changes made on the active node are replicated to the standby node.
+        """
+        cursor = connection.cursor()
+        try:
+            with transaction.atomic():
+                for query, params in queries:
+                    if params is None:
+                        cursor.executelocal(query)
+                    else:
+                        cursor.executelocal(query, params)
+        except OperationalError as err:
+            raise CallError(err)
+        finally:
+            cursor.close()
+
     @accepts(List('queries'))
     def restore(self, queries):
         """
@@ -381,3 +430,12 @@ class DatastoreService(Service):
             })
 
         return models
+
+
+async def devd_carp_hook(middleware, data):
+    # Failover status may have changed, ask for it again before replicating the next write
+    sqlite3_ha_base.failover_status.invalidate()
+
+
+def setup(middleware):
+    middleware.register_hook('devd.carp', devd_carp_hook)
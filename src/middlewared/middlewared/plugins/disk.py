@@ -10,20 +10,24 @@ import signal
 import subprocess
 import sysctl
 import tempfile
-from xml.etree import ElementTree
+import time
 
 from bsd import geom, getswapinfo
-from lxml import etree
 
 from middlewared.common.camcontrol import camcontrol_list
 from middlewared.common.smart.smartctl import get_smartctl_args
 from middlewared.schema import accepts, Bool, Dict, Int, List, Str
 from middlewared.service import job, private, CallError, CRUDService
 from middlewared.utils import Popen, run
+from middlewared.utils import geom as geom_topology
 from middlewared.utils.asyncio_ import asyncio_map
 
 
 DISK_EXPIRECACHE_DAYS = 7
+# Disk hotplug events are synced once no new event arrived for this many seconds...
+DISK_HOTPLUG_DEBOUNCE = 2
+# ...or once the first of them has been waiting for this many seconds
+DISK_HOTPLUG_MAX_WAIT = 10
 GELI_KEY_SLOT = 0
 GELI_RECOVERY_SLOT = 1
 GELI_REKEY_FAILED = '/tmp/.rekey_failed'
@@ -49,11 +53,19 @@ RAWTYPE = {
 
 class DiskService(CRUDService):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__hotplug_created = set()
+        self.__hotplug_destroyed = set()
+        self.__hotplug_last_event = 0
+        self.__hotplug_task = None
+
     class Config:
         datastore = 'storage.disk'
         datastore_prefix = 'disk_'
         datastore_extend = 'disk.disk_extend'
         datastore_filters = [('expiretime', '=', None)]
+        datastore_raw_fields = ['identifier', 'name', 'serial', 'subsystem', 'number', 'multipath_name', 'expiretime']
 
     @private
     async def disk_extend(self, disk):
@@ -662,6 +674,9 @@ class DiskService(CRUDService):
 
     @private
     async def serial_from_device(self, name):
+        return await self.__serial_from_device(name)
+
+    async def __serial_from_device(self, name, topology=None):
         args = await self.__get_smartctl_args(name)
         if args:
             p1 = await Popen(['smartctl', '-i'] + args, stdout=subprocess.PIPE)
@@ -670,8 +685,9 @@ class DiskService(CRUDService):
             if search:
                 return search.group('serial')
 
-        await self.middleware.run_in_thread(geom.scan)
-        g = geom.geom_by_name('DISK', name)
+        if topology is None:
+            topology = await self.middleware.run_in_thread(geom_topology.scan)
+        g = topology.geom('DISK', name)
         if g and g.provider.config.get('ident'):
             return g.provider.config['ident']
 
@@ -694,9 +710,10 @@ class DiskService(CRUDService):
         Returns:
             str - identifier
         """
-        await self.middleware.run_in_thread(geom.scan)
+        return await self.__device_to_identifier(await self.middleware.run_in_thread(geom_topology.scan), name)
 
-        g = geom.geom_by_name('DISK', name)
+    async def __device_to_identifier(self, topology, name):
+        g = topology.geom('DISK', name)
         if g and g.provider.config.get('ident'):
             serial = g.provider.config['ident']
             lunid = g.provider.config.get('lunid')
@@ -704,23 +721,19 @@ class DiskService(CRUDService):
                 return f'{{serial_lunid}}{serial}_{lunid}'
             return f'{{serial}}{serial}'
 
-        serial = await self.serial_from_device(name)
+        serial = await self.__serial_from_device(name, topology)
         if serial:
             return f'{{serial}}{serial}'
 
-        klass = geom.class_by_name('PART')
-        if klass:
-            for g in klass.geoms:
-                for p in g.providers:
-                    if p.name == name:
-                        if p.config['rawtype'] == RAWTYPE['freebsd-zfs']:
-                            return f'{{uuid}}{p.config["rawuuid"]}'
+        p = topology.provider('PART', name)
+        if p and p.config.get('rawtype') == RAWTYPE['freebsd-zfs']:
+            return f'{{uuid}}{p.config["rawuuid"]}'
 
-        g = geom.geom_by_name('LABEL', name)
+        g = topology.geom('LABEL', name)
         if g:
             return f'{{label}}{g.provider.name}'
 
-        g = geom.geom_by_name('DEV', name)
+        g = topology.geom('DEV', name)
         if g:
             return f'{{devicename}}{name}'
 
@@ -729,7 +742,18 @@ class DiskService(CRUDService):
     @private
     @accepts(Str('identifier'))
     def identifier_to_device(self, ident):
+        return self.__identifier_to_device(geom_topology.scan(), ident)
+
+    @private
+    @accepts(List('identifiers', items=[Str('identifier')]))
+    def identifiers_to_devices(self, idents):
+        """
+        Map each of `idents` to its device name (or None) using a single GEOM scan.
+        """
+        topology = geom_topology.scan()
+        return {ident: self.__identifier_to_device(topology, ident) for ident in idents}
 
+    def __identifier_to_device(self, topology, ident):
         if not ident:
             return None
 
@@ -737,53 +761,28 @@ class DiskService(CRUDService):
         if not search:
             return None
 
-        geom.scan()
-
         tp = search.group('type')
         # We need to escape single quotes to html entity
         value = search.group('value').replace("'", '%27')
 
         if tp == 'uuid':
-            search = geom.class_by_name('PART').xml.find(
-                f'.//config[rawuuid = "{value}"]/../../name'
-            )
-            if search is not None and not search.text.startswith('label'):
-                return search.text
+            name = topology.part_by_rawuuid.get(value)
+            if name is not None and not name.startswith('label'):
+                return name
 
         elif tp == 'label':
-            search = geom.class_by_name('LABEL').xml.find(
-                f'.//provider[name = "{value}"]/../name'
-            )
-            if search is not None:
-                return search.text
+            return topology.provider_geom_name('LABEL', value)
 
         elif tp == 'serial':
-            search = geom.class_by_name('DISK').xml.find(
-                f'.//provider/config[ident = "{value}"]/../../name'
-            )
-            if search is not None:
-                return search.text
-            # Builtin xml xpath do not understand normalize-space
-            search = etree.fromstring(ElementTree.tostring(geom.class_by_name('DISK').xml))
-            search = search.xpath(
-                './/provider/config['
-                f'normalize-space(ident) = normalize-space("{value}")'
-                ']/../../name'
-            )
-            if len(search) > 0:
-                return search[0].text
+            name = topology.disk_by_ident(value)
+            if name is not None:
+                return name
             disks = self.middleware.call_sync('disk.query', [('serial', '=', value)])
             if disks:
                 return disks[0]['name']
 
         elif tp == 'serial_lunid':
-            # Builtin xml xpath do not understand concat
-            search = etree.fromstring(ElementTree.tostring(geom.class_by_name('DISK').xml))
-            search = search.xpath(
-                f'.//provider/config[concat(ident,"_",lunid) = "{value}"]/../../name'
-            )
-            if len(search) > 0:
-                return search[0].text
+            return topology.disk_by_serial_lunid.get(value)
 
         elif tp == 'devicename':
             if os.path.exists(f'/dev/{value}'):
@@ -798,29 +797,21 @@ class DiskService(CRUDService):
         elif label.endswith('.eli'):
             label = label[:-4]
 
-        if geom_scan:
-            geom.scan()
-        klass = geom.class_by_name('LABEL')
-        prov = klass.xml.find(f'.//provider[name="{label}"]/../name')
-        if prov is not None:
-            return prov.text
+        topology = geom_topology.scan() if geom_scan else geom_topology.topology()
+        return topology.provider_geom_name('LABEL', label)
 
     @private
     def label_to_disk(self, label, geom_scan=True):
-        if geom_scan:
-            geom.scan()
+        topology = geom_topology.scan() if geom_scan else geom_topology.topology()
         dev = self.label_to_dev(label, geom_scan=False) or label
-        part = geom.class_by_name('PART').xml.find(f'.//provider[name="{dev}"]/../name')
-        if part is not None:
-            return part.text
+        return topology.provider_geom_name('PART', dev)
 
     @private
     def check_clean(self, disk):
-        geom.scan()
-        return geom.class_by_name('PART').xml.find(f'.//geom[name="{disk}"]') is None
+        return geom_topology.scan().geom('PART', disk) is None
 
-    async def __disk_data(self, disk, name):
-        g = geom.geom_by_name('DISK', name)
+    async def __disk_data(self, topology, disk, name):
+        g = topology.geom('DISK', name)
         if g:
             if g.provider.config['ident']:
                 disk['disk_serial'] = g.provider.config['ident']
@@ -839,7 +830,7 @@ class DiskService(CRUDService):
             disk['disk_model'] = g.provider.config['descr'] or None
 
         if not disk.get('disk_serial'):
-            disk['disk_serial'] = await self.serial_from_device(name) or ''
+            disk['disk_serial'] = await self.__serial_from_device(name, topology) or ''
         reg = RE_DSKNAME.search(name)
         if reg:
             disk['disk_subsystem'] = reg.group(1)
@@ -852,6 +843,14 @@ class DiskService(CRUDService):
         """
         Syncs a disk `name` with the database cache.
         """
+        await self.sync_many([name])
+
+    @private
+    @accepts(List('names', items=[Str('name')]))
+    async def sync_many(self, names):
+        """
+        Syncs disks `names` with the database cache, against a single GEOM snapshot and in a single transaction.
+        """
         # Skip sync disks on backup node
         if (
             not await self.middleware.call('system.is_freenas') and
@@ -860,43 +859,138 @@ class DiskService(CRUDService):
         ):
             return
 
+        sys_disks = await self.middleware.call('device.get_info', 'DISK')
+
         # Do not sync geom classes like multipath/hast/etc
-        if name.find("/") != -1:
+        # Abort if the disk is not recognized as an available disk
+        names = [name for name in dict.fromkeys(names) if name.find('/') == -1 and name in sys_disks]
+        if not names:
             return
 
-        disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
+        topology = await self.middleware.run_in_thread(geom_topology.scan)
+        idents = {name: await self.__device_to_identifier(topology, name) for name in names}
+
+        qs = await self.middleware.call('datastore.query', 'storage.disk', [
+            ['OR', [
+                ['disk_identifier', 'in', [ident for ident in idents.values() if ident]],
+                ['disk_name', 'in', names],
+            ]],
+        ], {'order_by': ['disk_expiretime']})
+        by_identifier = {}
+        for row in qs:
+            by_identifier.setdefault(row['disk_identifier'], row)
+
+        updates = {}
+        inserts = []
+        for name in names:
+            ident = idents[name]
+            disk = by_identifier.get(ident) if ident else None
+            if disk is not None:
+                new = False
+                original_disk = disk.copy()
+            else:
+                new = True
+                for i in qs:
+                    # Rows claimed by another disk of this batch are not expired
+                    if i['disk_name'] == name and i['disk_identifier'] not in idents.values():
+                        i['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
+                        updates[i['disk_identifier']] = i
+                disk = {'disk_identifier': ident}
+            disk.update({'disk_name': name, 'disk_expiretime': None})
+
+            await self.__disk_data(topology, disk, name)
+
+            if new:
+                inserts.append(disk)
+            elif disk != original_disk:
+                updates[disk['disk_identifier']] = disk
+
+        operations = (
+            [['update', 'storage.disk', identifier, disk] for identifier, disk in updates.items()] +
+            [['insert', 'storage.disk', disk] for disk in inserts]
+        )
+        if operations:
+            await self.middleware.call('datastore.transaction', operations)
 
-        # Abort if the disk is not recognized as an available disk
-        if name not in disks:
-            return
-        ident = await self.device_to_identifier(name)
-        qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', ident)], {'order_by': ['disk_expiretime']})
-        if ident and qs:
-            disk = qs[0]
-            new = False
-        else:
-            new = True
-            qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_name', '=', name)])
-            for i in qs:
-                i['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-                await self.middleware.call('datastore.update', 'storage.disk', i['disk_identifier'], i)
-            disk = {'disk_identifier': ident}
-        disk.update({'disk_name': name, 'disk_expiretime': None})
+            if await self.middleware.call('service.started', 'collectd'):
+                await self.middleware.call('service.restart', 'collectd')
+            await self._service_change('smartd', 'restart')
 
-        await self.middleware.run_in_thread(geom.scan)
-        await self.__disk_data(disk, name)
+        if not await self.middleware.call('system.is_freenas'):
+            for name in names:
+                await self.middleware.call('enclosure.sync_disk', idents[name])
 
-        if not new:
-            await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
+    @private
+    async def hotplug_event(self, type, name):
+        """
+        Queue a disk attach (`CREATE`) or detach (`DESTROY`) event, to be synced in a batch with the events that
+        follow it shortly.
+        """
+        if type == 'CREATE':
+            self.__hotplug_created.add(name)
         else:
-            disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
+            self.__hotplug_destroyed.add(name)
+        self.__hotplug_last_event = time.monotonic()
 
-        if await self.middleware.call('service.started', 'collectd'):
-            await self.middleware.call('service.restart', 'collectd')
-        await self._service_change('smartd', 'restart')
+        if self.__hotplug_task is None:
+            self.__hotplug_task = asyncio.ensure_future(self.__hotplug_sync())
 
-        if not await self.middleware.call('system.is_freenas'):
-            await self.middleware.call('enclosure.sync_disk', disk['disk_identifier'])
+    async def __hotplug_sync(self):
+        try:
+            while self.__hotplug_created or self.__hotplug_destroyed:
+                first_event = time.monotonic()
+                while True:
+                    wait = min(
+                        self.__hotplug_last_event + DISK_HOTPLUG_DEBOUNCE, first_event + DISK_HOTPLUG_MAX_WAIT,
+                    ) - time.monotonic()
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+
+                created, self.__hotplug_created = self.__hotplug_created, set()
+                destroyed, self.__hotplug_destroyed = self.__hotplug_destroyed, set()
+                try:
+                    await self.__hotplug_sync_batch(created, destroyed)
+                except Exception:
+                    self.logger.error('Failed to sync disks %r', sorted(created | destroyed), exc_info=True)
+        finally:
+            self.__hotplug_task = None
+
+    async def __hotplug_sync_batch(self, created, destroyed):
+        self.logger.debug('Syncing hotplugged disks: created %r, destroyed %r', sorted(created), sorted(destroyed))
+
+        # Every step is attempted even if the previous ones failed, swaps must be reconfigured no matter what
+        try:
+            if destroyed:
+                # Detached disks can only be told apart by a full sync, which also picks up attached ones
+                await (await self.middleware.call('disk.sync_all')).wait()
+            else:
+                await self.sync_many(sorted(created))
+        except Exception:
+            self.logger.error('Failed to sync disks', exc_info=True)
+
+        # Disks that were also detached in this batch may be gone already
+        for name in sorted(created - destroyed):
+            try:
+                await self.middleware.call('disk.sed_unlock', name)
+            except Exception:
+                self.logger.error('Failed to unlock disk %r', name, exc_info=True)
+
+        try:
+            await self.middleware.call('disk.multipath_sync')
+        except Exception:
+            self.logger.error('Failed to sync multipaths', exc_info=True)
+
+        for name in sorted(created | destroyed):
+            try:
+                await self.middleware.call('alert.oneshot_delete', 'SMART', name)
+            except Exception:
+                self.logger.error('Failed to delete SMART alert of disk %r', name, exc_info=True)
+
+        if destroyed:
+            # If a disk dies we need to reconfigure swaps so we are not left
+            # with a single disk mirror swap, which may be a point of failure.
+            await self.middleware.call('disk.swaps_configure')
 
     @private
     @accepts()
@@ -918,33 +1012,45 @@ class DiskService(CRUDService):
         seen_disks = {}
         serials = []
         changed = False
-        await self.middleware.run_in_thread(geom.scan)
-        for disk in (await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})):
+        # Updates and inserts are written at once, in a single transaction
+        updates = {}
+        inserts = []
+        synced = []
+        # A single snapshot of the GEOM tree is used to identify all the disks
+        topology = await self.middleware.run_in_thread(geom_topology.scan)
+        qs = await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})
+        by_identifier = {}
+        for disk in qs:
+            by_identifier.setdefault(disk['disk_identifier'], disk)
+        for disk in qs:
 
             original_disk = disk.copy()
 
-            name = await self.middleware.call('disk.identifier_to_device', disk['disk_identifier'])
+            name = await self.middleware.run_in_thread(
+                self.__identifier_to_device, topology, disk['disk_identifier'],
+            )
             if not name or name in seen_disks:
                 # If we cant translate the identifier to a device, give up
                 # If name has already been seen once then we are probably
                 # dealing with with multipath here
                 if not disk['disk_expiretime']:
                     disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                    changed = True
+                    updates[disk['disk_identifier']] = disk
                 elif disk['disk_expiretime'] < datetime.utcnow():
                     # Disk expire time has surpassed, go ahead and remove it
                     for extent in await self.middleware.call(
                             'iscsi.extent.query', [['type', '=', 'DISK'], ['path', '=', disk['disk_identifier']]]):
                         await self.middleware.call('iscsi.extent.delete', extent['id'])
                     await self.middleware.call('datastore.delete', 'storage.disk', disk['disk_identifier'])
+                    if by_identifier.get(disk['disk_identifier']) is disk:
+                        del by_identifier[disk['disk_identifier']]
                     changed = True
                 continue
             else:
                 disk['disk_expiretime'] = None
                 disk['disk_name'] = name
 
-            g = await self.__disk_data(disk, name)
+            g = await self.__disk_data(topology, disk, name)
             serial = disk.get('disk_serial') or ''
             if g:
                 serial += g.provider.config.get('lunid') or ''
@@ -959,28 +1065,25 @@ class DiskService(CRUDService):
             # Do not issue unnecessary updates, they are slow on HA systems and cause severe boot delays
             # when lots of drives are present
             if disk != original_disk:
-                await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                changed = True
+                updates[disk['disk_identifier']] = disk
 
-            if not await self.middleware.call('system.is_freenas'):
-                await self.middleware.call('enclosure.sync_disk', disk['disk_identifier'])
+            synced.append(disk['disk_identifier'])
 
             seen_disks[name] = disk
 
         for name in sys_disks:
             if name not in seen_disks:
-                disk_identifier = await self.device_to_identifier(name)
-                qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', disk_identifier)])
-                if qs:
+                disk_identifier = await self.__device_to_identifier(topology, name)
+                if disk_identifier in by_identifier:
                     new = False
-                    disk = qs[0]
+                    disk = by_identifier[disk_identifier]
                 else:
                     new = True
                     disk = {'disk_identifier': disk_identifier}
                 original_disk = disk.copy()
                 disk['disk_name'] = name
                 serial = ''
-                g = geom.geom_by_name('DISK', name)
+                g = topology.geom('DISK', name)
                 if g:
                     if g.provider.config['ident']:
                         serial = disk['disk_serial'] = g.provider.config['ident']
@@ -988,7 +1091,7 @@ class DiskService(CRUDService):
                     if g.provider.mediasize:
                         disk['disk_size'] = g.provider.mediasize
                 if not disk.get('disk_serial'):
-                    serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
+                    serial = disk['disk_serial'] = await self.__serial_from_device(name, topology) or ''
                 if serial:
                     if serial in serials:
                         # Probably dealing with multipath here, do not add another
@@ -1004,14 +1107,23 @@ class DiskService(CRUDService):
                     # Do not issue unnecessary updates, they are slow on HA systems and cause severe boot delays
                     # when lots of drives are present
                     if disk != original_disk:
-                        await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                        changed = True
+                        updates[disk['disk_identifier']] = disk
                 else:
-                    disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
-                    changed = True
+                    inserts.append(disk)
+
+                synced.append(disk['disk_identifier'])
+
+        operations = (
+            [['update', 'storage.disk', identifier, disk] for identifier, disk in updates.items()] +
+            [['insert', 'storage.disk', disk] for disk in inserts]
+        )
+        if operations:
+            await self.middleware.call('datastore.transaction', operations)
+            changed = True
 
-                if not await self.middleware.call('system.is_freenas'):
-                    await self.middleware.call('enclosure.sync_disk', disk['disk_identifier'])
+        if not await self.middleware.call('system.is_freenas'):
+            for identifier in synced:
+                await self.middleware.call('enclosure.sync_disk', identifier)
 
         if changed:
             if await self.middleware.call('service.started', 'collectd'):
@@ -1172,10 +1284,10 @@ class DiskService(CRUDService):
         Returns:
             The string of the multipath name to be created
         """
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.run_in_thread(geom_topology.scan)
         numbers = sorted([
             int(RE_MPATH_NAME.search(g.name).group(1))
-            for g in geom.class_by_name('MULTIPATH').geoms if RE_MPATH_NAME.match(g.name)
+            for g in topology.geoms('MULTIPATH') if RE_MPATH_NAME.match(g.name)
         ])
         if not numbers:
             numbers = [0]
@@ -1200,18 +1312,18 @@ class DiskService(CRUDService):
         then a gmultipath is automatically created and will be available for use.
         """
 
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.run_in_thread(geom_topology.scan)
 
         mp_disks = []
-        for g in geom.class_by_name('MULTIPATH').geoms:
+        for g in topology.geoms('MULTIPATH'):
             for c in g.consumers:
                 p_geom = c.provider.geom
                 # For now just DISK is allowed
-                if p_geom.clazz.name != 'DISK':
+                if p_geom.clazz != 'DISK':
                     self.logger.warn(
                         "A consumer that is not a disk (%s) is part of a "
                         "MULTIPATH, currently unsupported by middleware",
-                        p_geom.clazz.name
+                        p_geom.clazz
                     )
                     continue
                 mp_disks.append(p_geom.name)
@@ -1222,7 +1334,7 @@ class DiskService(CRUDService):
 
         serials = defaultdict(list)
         active_active = []
-        for g in geom.class_by_name('DISK').geoms:
+        for g in topology.geoms('DISK'):
             if not RE_DA.match(g.name) or g.name in reserved or g.name in mp_disks:
                 continue
             if not is_freenas:
@@ -1258,14 +1370,14 @@ class DiskService(CRUDService):
             await self.__multipath_create(name, disks, 'A' if disks[0] in active_active else mode)
 
         # Scan again to take new multipaths into account
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.run_in_thread(geom_topology.scan)
         mp_ids = []
-        for g in geom.class_by_name('MULTIPATH').geoms:
+        for g in topology.geoms('MULTIPATH'):
             _disks = []
             for c in g.consumers:
                 p_geom = c.provider.geom
                 # For now just DISK is allowed
-                if p_geom.clazz.name != 'DISK':
+                if p_geom.clazz != 'DISK':
                     continue
                 _disks.append(p_geom.name)
 
@@ -1777,20 +1889,12 @@ async def devd_devfs_hook(middleware, data):
         # Device notified about is not a disk
         if data['cdev'] not in disks:
             return
-        await middleware.call('disk.sync', data['cdev'])
-        await middleware.call('disk.sed_unlock', data['cdev'])
-        await middleware.call('disk.multipath_sync')
-        await middleware.call('alert.oneshot_delete', 'SMART', data['cdev'])
+        await middleware.call('disk.hotplug_event', 'CREATE', data['cdev'])
     elif data['type'] == 'DESTROY':
         # Device notified about is not a disk
         if not RE_ISDISK.match(data['cdev']):
             return
-        await (await middleware.call('disk.sync_all')).wait()
-        await middleware.call('disk.multipath_sync')
-        await middleware.call('alert.oneshot_delete', 'SMART', data['cdev'])
-        # If a disk dies we need to reconfigure swaps so we are not left
-        # with a single disk mirror swap, which may be a point of failure.
-        await middleware.call('disk.swaps_configure')
+        await middleware.call('disk.hotplug_event', 'DESTROY', data['cdev'])
 
 
 async def devd_zfs_hook(middleware, data):
@@ -4,18 +4,170 @@ from middlewared.service import Service
 from middlewared.utils.io import write_if_changed
 
 import asyncio
+from collections import defaultdict
+import copy
 import grp
 import imp
+import json
 import os
 import pwd
+import threading
+
+# How many groups are generated at the same time by `etc.generate_all`
+GENERATE_ALL_CONCURRENCY = 8
+
+# Read only calls other than `*.config` and `*.query` whose results can be kept for a generation pass
+CACHED_CALLS = {'system.is_freenas', 'notifier.is_freenas', 'failover.licensed'}
+
+
+class FrozenDict(dict):
+    """
+    Read only dict for cached call results, `copy.copy` and `copy.deepcopy` give a regular dict.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Cached call results are read only, copy them to modify them')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+
+class FrozenList(list):
+    """
+    Read only list for cached call results, `copy.copy` and `copy.deepcopy` give a regular list.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Cached call results are read only, copy them to modify them')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = clear = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in self]
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
+
+class CallCache(object):
+    """
+    Stands in for the middleware in renderers during the render pass of a group.
+
+    Results of read only calls (`*.config`, `*.query` and `CACHED_CALLS`) are kept so that every file
+    generated in the pass sees the same configuration and repeated calls do not go through the event loop
+    and the thread pool again. They are shared, so they are handed out read only (see `freeze`).
+
+    Passes of groups generated together start from the results of a `shared` cache (see `scope`). Calls
+    that may change the configuration throw away the results of the pass that made them only, which stops
+    using the shared ones.
+    """
+
+    def __init__(self, middleware, shared=None):
+        self.middleware = middleware
+        self.shared = shared
+        self.results = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.middleware, name)
+
+    def scope(self):
+        """
+        Cache for the render pass of one group, sharing the results kept by this one.
+        """
+        return CallCache(self.middleware, self)
+
+    def _cache(self):
+        shared = self.shared
+        return self if shared is None else shared
+
+    def _key(self, name, params, kwargs):
+        if kwargs:
+            return None
+
+        if not (name.endswith(('.config', '.query')) or name in CACHED_CALLS):
+            if name.startswith('datastore.') or name.endswith(('.create', '.update', '.delete')):
+                self.invalidate()
+            return None
+
+        try:
+            return name, json.dumps(params, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+    def _get(self, key):
+        cache = self._cache()
+        with cache.lock:
+            if key in cache.results:
+                cache.hits += 1
+                return True, cache.results[key]
+            cache.misses += 1
+            return False, None
+
+    def _set(self, key, result):
+        result = freeze(result)
+        cache = self._cache()
+        with cache.lock:
+            return cache.results.setdefault(key, result)
+
+    def invalidate(self):
+        with self.lock:
+            self.shared = None
+            self.results.clear()
+
+    async def call(self, name, *params, **kwargs):
+        key = self._key(name, params, kwargs)
+        if key is None:
+            return await self.middleware.call(name, *params, **kwargs)
+
+        found, result = self._get(key)
+        if found:
+            return result
+        return self._set(key, await self.middleware.call(name, *params))
+
+    def call_sync(self, name, *params, **kwargs):
+        key = self._key(name, params, kwargs)
+        if key is None:
+            return self.middleware.call_sync(name, *params, **kwargs)
+
+        found, result = self._get(key)
+        if found:
+            return result
+        return self._set(key, self.middleware.call_sync(name, *params))
 
 
 class MakoRenderer(object):
 
     def __init__(self, service):
         self.service = service
+        # One lookup per directory, they keep compiled templates around (and recompile them if they change)
+        self.lookups = {}
+        self.lock = threading.Lock()
 
-    async def render(self, path):
+    def get_lookup(self, dir):
+        with self.lock:
+            lookup = self.lookups.get(dir)
+            if lookup is None:
+                lookup = self.lookups[dir] = TemplateLookup(directories=[dir], module_directory="/tmp/mako/%s" % dir)
+            return lookup
+
+    async def render(self, path, context):
         try:
             # Mako is not asyncio friendly so run it within a thread
             def do():
@@ -24,13 +176,13 @@ class MakoRenderer(object):
                 dir = os.path.dirname(path)
 
                 # This will be where we search for templates
-                lookup = TemplateLookup(directories=[dir], module_directory="/tmp/mako/%s" % dir)
+                lookup = self.get_lookup(dir)
 
                 # Get the template by its relative path
                 tmpl = lookup.get_template(name)
 
                 # Render the template
-                return tmpl.render(middleware=self.service.middleware)
+                return tmpl.render(middleware=context)
 
             return await self.service.middleware.run_in_thread(do)
         except Exception:
@@ -44,16 +196,28 @@ class PyRenderer(object):
 
     def __init__(self, service):
         self.service = service
+        # Renderer modules are only loaded once
+        self.modules = {}
+
+    def get_module(self, path):
+        mod = self.modules.get(path)
+        if mod is None:
+            name = os.path.basename(path)
+            find = imp.find_module(name, [os.path.dirname(path)])
+            try:
+                mod = self.modules[path] = imp.load_module(name, *find)
+            finally:
+                if find[0]:
+                    find[0].close()
+        return mod
 
-    async def render(self, path):
-        name = os.path.basename(path)
-        find = imp.find_module(name, [os.path.dirname(path)])
-        mod = imp.load_module(name, *find)
+    async def render(self, path, context):
+        mod = self.get_module(path)
         if asyncio.iscoroutinefunction(mod.render):
-            return await mod.render(self.service, self.service.middleware)
+            return await mod.render(self.service, context)
         else:
             return await self.service.middleware.run_in_thread(
-                mod.render, self.service, self.service.middleware,
+                mod.render, self.service, context,
             )
 
 
@@ -217,6 +381,19 @@ class EtcService(Service):
 
     SKIP_LIST = ['system_dataset', 'collectd', 'syslogd']
 
+    # Groups that `etc.generate_all` must have generated before a given group
+    DEPENDS = {
+        # These chown files to users and groups of their services
+        'nss': ['user'],
+        'ups': ['user'],
+        'ftp': ['user', 'ssl'],
+        'smb_configure': ['user', 'smb'],
+        'smb_share': ['smb'],
+        'nginx': ['ssl'],
+        'webdav': ['ssl'],
+        's3': ['ssl'],
+    }
+
     class Config:
         private = True
 
@@ -225,16 +402,26 @@ class EtcService(Service):
         self.files_dir = os.path.realpath(
             os.path.join(os.path.dirname(__file__), '..', 'etc_files')
         )
+        self.etc_dir = '/etc'
         self._renderers = {
             'mako': MakoRenderer(self),
             'py': PyRenderer(self),
         }
+        # Renderer modules are shared, the same group can not be generated twice at the same time
+        self._locks = defaultdict(asyncio.Lock)
 
     async def generate(self, name):
+        await self.__generate_group(name, CallCache(self.middleware))
+
+    async def __generate_group(self, name, context):
         group = self.GROUPS.get(name)
         if group is None:
             raise ValueError('{0} group not found'.format(name))
 
+        async with self._locks[name]:
+            await self.__generate(group, context)
+
+    async def __generate(self, group, context):
         for entry in group:
 
             renderer = self._renderers.get(entry['type'])
@@ -243,7 +430,7 @@ class EtcService(Service):
 
             path = os.path.join(self.files_dir, entry['path'])
             try:
-                rendered = await renderer.render(path)
+                rendered = await renderer.render(path, context)
             except Exception:
                 self.logger.error(f'Failed to render {entry["type"]}:{entry["path"]}', exc_info=True)
                 continue
@@ -251,8 +438,8 @@ class EtcService(Service):
             if rendered is None:
                 continue
 
-            outfile = '/etc/{0}'.format(entry['path'])
-            changes = write_if_changed(outfile, rendered)
+            outfile = os.path.join(self.etc_dir, entry['path'])
+            changes = await self.middleware.run_in_thread(write_if_changed, outfile, rendered)
 
             # If ownership or permissions are specified, see if
             # they need to be changed.
@@ -289,12 +476,30 @@ class EtcService(Service):
         Generate all configuration file groups
         `skip_list` tells whether to skip groups in SKIP_LIST. This defaults to true.
         """
+        semaphore = asyncio.Semaphore(GENERATE_ALL_CONCURRENCY)
+        # All groups see the same configuration
+        context = CallCache(self.middleware)
+        tasks = {}
+
+        async def generate(name):
+            for dependency in self.DEPENDS.get(name, []):
+                if dependency in tasks:
+                    await asyncio.wait([tasks[dependency]])
+
+            async with semaphore:
+                try:
+                    await self.__generate_group(name, context.scope())
+                except Exception:
+                    self.logger.error(f'Failed to generate {name} group', exc_info=True)
+
         for name in self.GROUPS.keys():
             if skip_list and name in self.SKIP_LIST:
                 self.logger.info(f'Skipping {name} group generation')
                 continue
 
-            try:
-                await self.generate(name)
-            except Exception:
-                self.logger.error(f'Failed to generate {name} group', exc_info=True)
+            tasks[name] = asyncio.ensure_future(generate(name))
+
+        if tasks:
+            await asyncio.wait(list(tasks.values()))
+
+        self.logger.debug(f'Generated all groups with {context.hits} cached and {context.misses} uncached calls')
@@ -178,7 +178,7 @@ class FilesystemService(Service):
             raise CallError(f'{path} is not a file')
 
         with open(path, 'rb') as f:
-            await self.middleware.run_in_thread(shutil.copyfileobj, f, job.pipes.output.w)
+            job.pipes.output.send_file(f)
 
     @accepts(
         Str('path'),
@@ -1,9 +1,6 @@
-import sysctl
-
-from lxml import etree
-
 from middlewared.service import CRUDService, filterable
 from middlewared.utils import filter_list
+from middlewared.utils import geom
 
 
 class MultipathService(CRUDService):
@@ -75,11 +72,7 @@ class MultipathService(CRUDService):
         return filter_list(items, filters=filters or [], options=options or {})
 
     def __get_multipaths(self):
-        doc = etree.fromstring(sysctl.filter("kern.geom.confxml")[0].value)
-        return [
-            Multipath(doc=doc, xmlnode=geom)
-            for geom in doc.xpath("//class[name = 'MULTIPATH']/geom")
-        ]
+        return [Multipath(g) for g in geom.scan().geoms("MULTIPATH")]
 
 
 class Multipath(object):
@@ -102,19 +95,15 @@ class Multipath(object):
             devs.append(consumer.devname)
         return devs
 
-    def __init__(self, doc, xmlnode):
-        self.name = xmlnode.xpath("./name")[0].text
+    def __init__(self, g):
+        self.name = g.name
         self.devname = f"multipath/{self.name}"
-        self._status = xmlnode.xpath("./config/State")[0].text
+        self._status = g.config["State"]
         self.consumers = []
-        for consumer in xmlnode.xpath("./consumer"):
-            status = consumer.xpath("./config/State")[0].text
-            provref = consumer.xpath("./provider/@ref")[0]
-            prov = doc.xpath(f"//provider[@id = '{provref}']")[0]
-            self.consumers.append(Consumer(status, prov))
+        for consumer in g.consumers:
+            self.consumers.append(Consumer(consumer.config["State"], consumer.provider))
 
-        self.__xml = xmlnode
-        self.__doc = doc
+        self.__geom = g
 
     def __repr__(self):
         return f"<Multipath:{self.name} [{','.join(self.devices)}]>"
@@ -122,11 +111,8 @@ class Multipath(object):
 
 class Consumer(object):
 
-    def __init__(self, status, xmlnode):
+    def __init__(self, status, provider):
         self.status = status
-        self.devname = xmlnode.xpath("./name")[0].text
-        try:
-            self.lunid = xmlnode.xpath("./config/lunid")[0].text
-        except Exception:
-            self.lunid = ""
-        self.__xml = xmlnode
+        self.devname = provider.name
+        self.lunid = provider.config.get("lunid", "")
+        self.__provider = provider
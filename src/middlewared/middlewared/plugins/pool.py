@@ -429,7 +429,7 @@ class PoolService(CRUDService):
         """
         pool['path'] = f'/mnt/{pool["name"]}'
         try:
-            zpool = self.middleware.call_sync('zfs.pool.query', [('id', '=', pool['name'])])[0]
+            zpool = self.middleware.call_sync('zfs.cache.query', 'POOL', [('id', '=', pool['name'])])[0]
         except Exception:
             zpool = None
 
@@ -2455,13 +2455,13 @@ class PoolDatasetService(CRUDService):
         """
         Query Pool Datasets with `query-filters` and `query-options`.
         """
-        # Optimization for cases in which they can be filtered at zfs.dataset.query
+        # Optimization for cases in which they can be filtered at zfs.cache.query
         zfsfilters = []
         for f in filters or []:
             if len(f) == 3:
                 if f[0] in ('id', 'name', 'pool', 'type'):
                     zfsfilters.append(f)
-        datasets = self.middleware.call_sync('zfs.dataset.query', zfsfilters, None)
+        datasets = self.middleware.call_sync('zfs.cache.query', 'DATASET', zfsfilters, None)
         return filter_list(self.__transform(datasets), filters, options)
 
     def __transform(self, datasets):
@@ -85,6 +85,9 @@ class StartNotify(threading.Thread):
 
 class ServiceService(CRUDService):
 
+    # Version of ctl.conf ctld was last started or reloaded with
+    _ctl_conf_loaded = None
+
     SERVICE_DEFS = {
         's3': ServiceDefinition('minio', '/var/run/minio.pid'),
         'ssh': ServiceDefinition('sshd', '/var/run/sshd.pid'),
@@ -440,25 +443,43 @@ class ServiceService(CRUDService):
             pass
         await self._system("ulimit -n 1024 && /usr/local/bin/python /usr/local/www/freenasUI/tools/webshell.py")
 
+    def _ctl_conf_version(self):
+        try:
+            st = os.stat('/etc/ctl.conf')
+        except FileNotFoundError:
+            return None
+        # ctl.conf is replaced (and gets a new inode) every time it changes
+        return st.st_ino, st.st_mtime_ns
+
     async def _restart_iscsitarget(self, **kwargs):
         await self.middleware.call("etc.generate", "ctld")
         await self._service("ctld", "stop", force=True, **kwargs)
         await self.middleware.call("etc.generate", "ctld")
         await self._service("ctld", "restart", **kwargs)
+        self._ctl_conf_loaded = self._ctl_conf_version()
 
     async def _start_iscsitarget(self, **kwargs):
         await self.middleware.call("etc.generate", "ctld")
         await self._service("ctld", "start", **kwargs)
+        self._ctl_conf_loaded = self._ctl_conf_version()
 
     async def _stop_iscsitarget(self, **kwargs):
         with contextlib.suppress(IndexError):
             sysctl.filter("kern.cam.ctl.ha_peer")[0].value = ""
 
         await self._service("ctld", "stop", force=True, **kwargs)
+        self._ctl_conf_loaded = None
 
     async def _reload_iscsitarget(self, **kwargs):
         await self.middleware.call("etc.generate", "ctld")
+        # ctld applies only the LUNs and targets that changed on reload, but there is nothing to apply at all
+        # if it already loaded this very file
+        version = self._ctl_conf_version()
+        if version is not None and version == self._ctl_conf_loaded:
+            self.logger.debug('ctl.conf has not changed, not reloading ctld')
+            return
         await self._service("ctld", "reload", **kwargs)
+        self._ctl_conf_loaded = version
 
     async def _start_collectd(self, **kwargs):
         if not await self.started('rrdcached'):
@@ -12,6 +12,7 @@ import grp
 import os
 import re
 import subprocess
+import tempfile
 import uuid
 from samba import param
 
@@ -44,6 +45,44 @@ class SMBCmd(enum.Enum):
     SMBPASSWD = '/usr/local/bin/smbpasswd'
 
 
+def passdb_account_flags(flags, disabled):
+    """
+    smbpasswd account flags field (e.g. `[U          ]`) with the "disabled" flag set or cleared.
+    """
+    flags = flags.strip('[]').replace(' ', '').replace('D', '') or 'U'
+    if disabled:
+        flags += 'D'
+    return f'[{flags.ljust(11)}]'
+
+
+def passdb_changes(pdb_entries, conf_users):
+    """
+    Changes needed for passdb to match the SMB users of the config file.
+
+    `pdb_entries` are passdb entries in smbpasswd format split into fields and `conf_users` are users, both
+    keyed by username.
+    """
+    changes = {'add': [], 'set_nt_hash': [], 'disable': [], 'enable': [], 'delete': []}
+    for username, user in conf_users.items():
+        smbhash = user['smbhash'].split(':')
+        entry = pdb_entries.get(username)
+        if entry is None:
+            smbhash[1] = str(user['uid'])
+            smbhash[4] = passdb_account_flags(smbhash[4], user['locked'])
+            changes['add'].append(':'.join(smbhash))
+            continue
+
+        if smbhash[3] != entry[3]:
+            changes['set_nt_hash'].append((username, smbhash[3]))
+        if user['locked'] and 'D' not in entry[4]:
+            changes['disable'].append(username)
+        elif not user['locked'] and 'D' in entry[4]:
+            changes['enable'].append(username)
+
+    changes['delete'] = [username for username in pdb_entries if username not in conf_users]
+    return changes
+
+
 class SMBService(SystemServiceService):
 
     class Config:
@@ -407,6 +446,35 @@ class SMBService(SystemServiceService):
             if enableacct.returncode != 0:
                 raise CallError(f'Failed to enable {username}: {enableacct.stderr.decode()}')
 
+    @private
+    async def passdb_entries(self):
+        """
+        All passdb entries in smbpasswd format, split into fields and keyed by username.
+        """
+        pdb = await run([SMBCmd.PDBEDIT.value, '-d', '0', '-Lw'], check=False)
+        if pdb.returncode != 0:
+            raise CallError(f'Failed to list passdb output: {pdb.stderr.decode()}')
+
+        entries = {}
+        for line in pdb.stdout.decode().splitlines():
+            entry = line.split(':')
+            if len(entry) >= 5:
+                entries[entry[0]] = entry
+        return entries
+
+    @private
+    async def passdb_import(self, lines):
+        """
+        Add the accounts of `lines` (in smbpasswd format) to passdb with a single pdbedit run.
+        """
+        # Holds NT hashes, created readable by root only
+        with tempfile.NamedTemporaryFile('w', prefix='smbpasswd') as f:
+            f.write(''.join(f'{line}\n' for line in lines))
+            f.flush()
+            pdbimport = await run([SMBCmd.PDBEDIT.value, '-d', '0', '-i', f'smbpasswd:{f.name}'], check=False)
+        if pdbimport.returncode != 0:
+            raise CallError(f'Failed to import passdb entries: {pdbimport.stderr.decode()}')
+
     @private
     async def synchronize_passdb(self):
         """
@@ -414,27 +482,48 @@ class SMBService(SystemServiceService):
         Replace NT hashes of users if they do not match what is the the config file.
         Synchronize the "disabled" state of users
         Delete any entries in the passdb_tdb file that don't exist in the config file.
+
+        passdb is read once and compared with the config file in memory, so only accounts that differ
+        are acted upon. Missing accounts are all added with a single import.
         """
         if await self.middleware.call('smb.getparm', 'passdb backend', 'global') == 'ldapsam':
             return
 
-        conf_users = await self.middleware.call('user.query', [
-            ['OR', [
-                ('smbhash', '~', r'^.+:.+:[X]{32}:.+$'),
-                ('smbhash', '~', r'^.+:.+:[A-F0-9]{32}:.+$'),
-            ]]
-        ])
-        for u in conf_users:
-            await self.middleware.call('smb.update_passdb_user', u['username'])
-
-        pdb_users = await self.passdb_list()
-        if len(pdb_users) > len(conf_users):
-            for entry in pdb_users:
-                if not any(filter(lambda x: entry['username'] == x['username'], conf_users)):
-                    self.logger.debug('Synchronizing passdb with config file: deleting user [%s] from passdb.tdb', entry['username'])
-                    deluser = await run([SMBCmd.PDBEDIT.value, '-d', '0', '-x', entry['username']], check=False)
-                    if deluser.returncode != 0:
-                        raise CallError(f'Failed to delete user {entry["username"]}: {deluser.stderr.decode()}')
+        conf_users = {
+            u['username']: u
+            for u in await self.middleware.call('user.query', [
+                ['OR', [
+                    ('smbhash', '~', r'^.+:.+:[X]{32}:.+$'),
+                    ('smbhash', '~', r'^.+:.+:[A-F0-9]{32}:.+$'),
+                ]]
+            ])
+        }
+        changes = passdb_changes(await self.passdb_entries(), conf_users)
+
+        if changes['add']:
+            self.logger.debug('Synchronizing passdb with config file: adding %d users', len(changes['add']))
+            await self.passdb_import(changes['add'])
+
+        for username, nt_hash in changes['set_nt_hash']:
+            setntpass = await run([SMBCmd.PDBEDIT.value, '-d', '0', '--set-nt-hash', nt_hash, username], check=False)
+            if setntpass.returncode != 0:
+                raise CallError(f'Failed to set NT password for {username}: {setntpass.stderr.decode()}')
+
+        for username in changes['disable']:
+            disableacct = await run([SMBCmd.SMBPASSWD.value, '-d', username], check=False)
+            if disableacct.returncode != 0:
+                raise CallError(f'Failed to disable {username}: {disableacct.stderr.decode()}')
+
+        for username in changes['enable']:
+            enableacct = await run([SMBCmd.SMBPASSWD.value, '-e', username], check=False)
+            if enableacct.returncode != 0:
+                raise CallError(f'Failed to enable {username}: {enableacct.stderr.decode()}')
+
+        for username in changes['delete']:
+            self.logger.debug('Synchronizing passdb with config file: deleting user [%s] from passdb.tdb', username)
+            deluser = await run([SMBCmd.PDBEDIT.value, '-d', '0', '-x', username], check=False)
+            if deluser.returncode != 0:
+                raise CallError(f'Failed to delete user {username}: {deluser.stderr.decode()}')
 
     @private
     def getparm(self, parm, section):
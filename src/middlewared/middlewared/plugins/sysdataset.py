@@ -246,7 +246,12 @@ class SystemDatasetService(ConfigService):
         """
         createdds = False
         datasets = [i[0] for i in self.__get_datasets(pool, uuid)]
-        datasets_prop = {i['id']: i['properties'].get('mountpoint') for i in await self.middleware.call('zfs.dataset.query', [('id', 'in', datasets)])}
+        datasets_prop = {
+            i['id']: i['properties'].get('mountpoint')
+            for i in await self.middleware.call(
+                'zfs.dataset.query', [('id', 'in', datasets)], {'extra': {'properties': ['mountpoint']}},
+            )
+        }
         for dataset in datasets:
             mountpoint = datasets_prop.get(dataset)
             if mountpoint and mountpoint['value'] != 'legacy':
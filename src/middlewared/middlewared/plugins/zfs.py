@@ -1,20 +1,25 @@
+import asyncio
+import copy
 import errno
 import subprocess
+import tempfile
 import threading
 import time
 from collections import defaultdict
 
-from bsd import geom
 import libzfs
 
 from middlewared.alert.base import AlertCategory, AlertClass, AlertLevel, SimpleOneShotAlertClass
-from middlewared.schema import Dict, List, Str, Bool, accepts
+from middlewared.schema import Dict, List, Ref, Str, Bool, accepts
 from middlewared.service import (
-    CallError, CRUDService, ValidationError, ValidationErrors, filterable, job,
+    CallError, CRUDService, Service, ValidationError, ValidationErrors, filterable, job, private,
 )
 from middlewared.utils import filter_list, filter_getattrs, start_daemon_thread
+from middlewared.utils import geom
 
 SCAN_THREADS = {}
+# More stale names than this and it is cheaper to enumerate everything again
+ZFS_CACHE_MAX_STALE = 64
 
 
 def convert_topology(zfs, vdevs):
@@ -62,6 +67,115 @@ def find_vdev(pool, vname):
         children += list(child.children)
 
 
+ZFS_GET_SOURCES = {
+    '-': 'NONE', 'default': 'DEFAULT', 'local': 'LOCAL', 'temporary': 'TEMPORARY', 'received': 'RECEIVED',
+}
+
+
+def zfs_query_properties(filters, options, fields):
+    """
+    Map `select` and filter attributes of a zfs query to the properties that
+    need to be fetched, or None if they can only be answered by py-libzfs.
+
+    Properties may also be asked for explicitly with `options.extra.properties`.
+    Only `value`, `rawvalue` and `source` of each property are available this way.
+    """
+    if not options:
+        return None
+
+    properties = set((options.get('extra') or {}).get('properties') or [])
+    if not options.get('select') and not properties:
+        return None
+
+    for attr in filter_getattrs(filters) | set(options.get('select') or []):
+        if attr in fields or (attr == 'properties' and properties):
+            continue
+        path = attr.split('.')
+        if path[0] != 'properties' or len(path) not in (2, 3) or path[2:] not in (
+            [], ['value'], ['rawvalue'], ['source'],
+        ):
+            return None
+        properties.add(path[1])
+    return properties
+
+
+def zfs_query_names(filters):
+    """
+    Names a zfs query is limited to by a single `id` filter, if any.
+    """
+    if filters and len(filters) == 1 and filters[0][0] == 'id':
+        if filters[0][1] == '=':
+            return [filters[0][2]]
+        if filters[0][1] == 'in':
+            return list(filters[0][2])
+
+
+def zfs_get_lines(cmd, missing_ok=False):
+    """
+    Run a `zfs list`/`zfs get -H` command and yield its tab separated columns
+    line by line, without buffering the whole output.
+
+    `missing_ok` ignores the errors of the names given that do not exist.
+    """
+    # stderr goes to a file, zfs(8) would block on a full pipe nobody reads
+    with tempfile.TemporaryFile(mode='w+', encoding='utf8') as stderr:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, encoding='utf8') as proc:
+            for line in proc.stdout:
+                yield line.rstrip('\n').split('\t')
+        if proc.returncode != 0:
+            stderr.seek(0)
+            lines = stderr.read().splitlines()
+            errors = [line for line in lines if not (missing_ok and line.endswith('does not exist'))]
+            if errors or not lines:
+                raise CallError(f'Failed to run {" ".join(cmd[:2])}: {" ".join(errors).strip()}')
+
+
+def zfs_list_properties(types, properties, names=None):
+    """
+    Enumerate datasets or snapshots of `types` fetching only `properties` in
+    one parseable `zfs get` pass, `value` is the same as `rawvalue`.
+
+    `names` limits the listing to the given datasets/snapshots, the ones that
+    do not exist are skipped.
+    """
+    if names is not None and not names:
+        return []
+
+    with_type = 'type' in properties
+    properties = sorted(set(properties) - {'type'})
+    names = list(names or [])
+    cmd = ['zfs', 'get', '-H', '-p', '-o', 'name,property,value,source', '-t', types, ','.join(['type'] + properties)]
+
+    datasets = {}
+    # Names that do not exist make zfs(8) fail after listing the others
+    for name, prop, value, source in zfs_get_lines(cmd + names, missing_ok=bool(names)):
+        dataset = datasets.get(name)
+        if dataset is None:
+            dataset = datasets[name] = {
+                'id': name,
+                'name': name,
+                'pool': name.split('/', 1)[0].split('@', 1)[0],
+                'properties': {},
+            }
+        if prop == 'type':
+            dataset['type'] = value.upper()
+            if not with_type:
+                continue
+        if value == '-' and source == '-':
+            # Not applicable to this dataset type or unset user property
+            continue
+        dataset['properties'][prop] = {
+            'value': value,
+            'rawvalue': value,
+            'source': 'INHERITED' if source.startswith('inherited') else ZFS_GET_SOURCES.get(source, source.upper()),
+        }
+
+    for dataset in datasets.values():
+        if dataset['type'] == 'SNAPSHOT':
+            dataset['dataset'], dataset['snapshot_name'] = dataset['name'].split('@', 1)
+    return list(datasets.values())
+
+
 class ZFSPoolService(CRUDService):
 
     class Config:
@@ -73,13 +187,16 @@ class ZFSPoolService(CRUDService):
     def query(self, filters, options):
         # We should not get datasets, there is zfs.dataset.query for that
         state_kwargs = {'datasets_recursive': False}
+        names = zfs_query_names(filters)
         with libzfs.ZFS() as zfs:
             # Handle `id` filter specially to avoiding getting all pool
-            if filters and len(filters) == 1 and list(filters[0][:2]) == ['id', '=']:
-                try:
-                    pools = [zfs.get(filters[0][2]).__getstate__(**state_kwargs)]
-                except libzfs.ZFSException:
-                    pools = []
+            if names is not None:
+                pools = []
+                for name in names:
+                    try:
+                        pools.append(zfs.get(name).__getstate__(**state_kwargs))
+                    except libzfs.ZFSException:
+                        pass
             else:
                 pools = [i.__getstate__(**state_kwargs) for i in zfs.pools]
         return filter_list(pools, filters, options)
@@ -105,6 +222,7 @@ class ZFSPoolService(CRUDService):
             topology = convert_topology(zfs, data['vdevs'])
             zfs.create(data['name'], topology, data['options'], data['fsoptions'])
 
+        self.middleware.call_sync('zfs.cache.invalidate_new_pool', data['name'])
         return self.middleware.call_sync('zfs.pool._get_instance', data['name'])
 
     @accepts(Str('pool'), Dict(
@@ -123,6 +241,8 @@ class ZFSPoolService(CRUDService):
                         prop.parsed = v['parsed']
         except libzfs.ZFSException as e:
             raise CallError(str(e))
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate', 'POOL', name)
 
     @accepts(Str('pool'), Dict(
         'options',
@@ -134,6 +254,8 @@ class ZFSPoolService(CRUDService):
                 zfs.destroy(name, force=options['force'])
         except libzfs.ZFSException as e:
             raise CallError(str(e))
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate_pool', name)
 
     @accepts(Str('pool', required=True))
     def upgrade(self, pool):
@@ -142,6 +264,8 @@ class ZFSPoolService(CRUDService):
                 zfs.get(pool).upgrade()
         except libzfs.ZFSException as e:
             raise CallError(str(e))
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate', 'POOL', pool)
 
     @accepts(Str('pool'), Dict(
         'options',
@@ -155,6 +279,8 @@ class ZFSPoolService(CRUDService):
                 zfs.export_pool(pool)
         except libzfs.ZFSException as e:
             raise CallError(str(e))
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate_pool', name)
 
     @accepts(Str('pool'))
     def get_devices(self, name):
@@ -168,20 +294,20 @@ class ZFSPoolService(CRUDService):
     def get_disks(self, name):
         disks = self.get_devices(name)
 
-        geom.scan()
-        labelclass = geom.class_by_name('LABEL')
+        topology = geom.scan()
         for dev in disks:
             dev = dev.replace('.eli', '')
-            find = labelclass.xml.findall(f".//provider[name='{dev}']/../consumer/provider")
+            label = topology.provider('LABEL', dev)
             name = None
-            if find:
-                name = geom.provider_by_id(find[0].get('ref')).geom.name
+            if label is not None:
+                if label.geom.consumer and label.geom.consumer.provider:
+                    name = label.geom.consumer.provider.geom.name
             else:
-                g = geom.geom_by_name('DEV', dev)
-                if g:
+                g = topology.geom('DEV', dev)
+                if g and g.consumer and g.consumer.provider:
                     name = g.consumer.provider.geom.name
 
-            if name and (name.startswith('multipath/') or geom.geom_by_name('DISK', name)):
+            if name and (name.startswith('multipath/') or topology.geom('DISK', name)):
                 yield name
             else:
                 self.logger.debug(f'Could not find disk for {dev}')
@@ -382,6 +508,8 @@ class ZFSPoolService(CRUDService):
 
             zfs.import_pool(found, found.name, options, any_host=any_host)
 
+        self.middleware.call_sync('zfs.cache.invalidate_new_pool', found.name)
+
     @accepts(Str('pool'))
     async def find_not_online(self, pool):
         pool = await self.middleware.call('zfs.pool.query', [['id', '=', pool]], {'get': True})
@@ -422,32 +550,22 @@ class ZFSDatasetService(CRUDService):
 
     @filterable
     def query(self, filters=None, options=None):
-        # If we are only filtering by name, pool and type we can use
-        # zfs(8) which is much faster than py-libzfs
-        if (
-            options and set(options['select']).issubset({'name', 'pool', 'type'}) and
-            filter_getattrs(filters).issubset({'name', 'pool', 'type'})
-        ):
-            cp = subprocess.run([
-                'zfs', 'list', '-H', '-o', 'name,type', '-t', 'filesystem,volume',
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-            datasets = []
-            for i in cp.stdout.strip().split('\n'):
-                name, type_ = i.split('\t')
-                pool = name.split('/', 1)[0]
-                datasets.append({
-                    'name': name,
-                    'pool': pool,
-                    'type': type_.upper(),
-                })
+        # If we are only selecting/filtering by name, pool, type and a few properties
+        # we can use zfs(8) which is much faster than py-libzfs
+        properties = zfs_query_properties(filters, options, {'id', 'name', 'pool', 'type'})
+        if properties is not None:
+            datasets = zfs_list_properties('filesystem,volume', properties, zfs_query_names(filters))
         else:
+            names = zfs_query_names(filters)
             with libzfs.ZFS() as zfs:
                 # Handle `id` filter specially to avoiding getting all datasets
-                if filters and len(filters) == 1 and list(filters[0][:2]) == ['id', '=']:
-                    try:
-                        datasets = [zfs.get_dataset(filters[0][2]).__getstate__()]
-                    except libzfs.ZFSException:
-                        datasets = []
+                if names is not None:
+                    datasets = []
+                    for name in names:
+                        try:
+                            datasets.append(zfs.get_dataset(name).__getstate__())
+                        except libzfs.ZFSException:
+                            pass
                 else:
                     datasets = [i.__getstate__() for i in zfs.datasets]
         return filter_list(datasets, filters, options)
@@ -502,6 +620,8 @@ class ZFSDatasetService(CRUDService):
         except libzfs.ZFSException as e:
             self.logger.error('Failed to create dataset', exc_info=True)
             raise CallError(f'Failed to create dataset: {e}')
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate', 'DATASET', data['name'])
 
     @accepts(
         Str('id'),
@@ -553,6 +673,9 @@ class ZFSDatasetService(CRUDService):
         except libzfs.ZFSException as e:
             self.logger.error('Failed to update dataset', exc_info=True)
             raise CallError(f'Failed to update dataset: {e}')
+        finally:
+            # Inheritable properties may have changed for children as well
+            self.middleware.call_sync('zfs.cache.invalidate', 'DATASET', id, {'recursive': True})
 
     def do_delete(self, id, options=None):
         options = options or {}
@@ -574,6 +697,9 @@ class ZFSDatasetService(CRUDService):
         except subprocess.CalledProcessError as e:
             self.logger.error('Failed to delete dataset', exc_info=True)
             raise CallError(f'Failed to delete dataset: {e.stderr.strip()}')
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate', 'DATASET', id, {'recursive': True})
+            self.middleware.call_sync('zfs.cache.invalidate', 'SNAPSHOT', id, {'recursive': True})
 
     @accepts(Str('name'), Dict('options', Bool('recursive', default=False)))
     def mount(self, name, options):
@@ -587,6 +713,10 @@ class ZFSDatasetService(CRUDService):
         except libzfs.ZFSException as e:
             self.logger.error('Failed to mount dataset', exc_info=True)
             raise CallError(f'Failed to mount dataset: {e}')
+        finally:
+            self.middleware.call_sync(
+                'zfs.cache.invalidate', 'DATASET', name, {'recursive': options['recursive']},
+            )
 
     def promote(self, name):
         try:
@@ -596,6 +726,9 @@ class ZFSDatasetService(CRUDService):
         except libzfs.ZFSException as e:
             self.logger.error('Failed to promote dataset', exc_info=True)
             raise CallError(f'Failed to promote dataset: {e}')
+        finally:
+            # Promoting moves snapshots and origins between datasets of the pool
+            self.middleware.call_sync('zfs.cache.invalidate_pool', name.split('/', 1)[0])
 
     def inherit(self, name, prop, recursive=False):
         try:
@@ -607,6 +740,8 @@ class ZFSDatasetService(CRUDService):
                 zprop.inherit(recursive=recursive)
         except libzfs.ZFSException as e:
             raise CallError(str(e))
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate', 'DATASET', name, {'recursive': True})
 
 
 class ZFSSnapshot(CRUDService):
@@ -633,30 +768,29 @@ class ZFSSnapshot(CRUDService):
             # -s name makes it even faster
             if not order_by or order_by == ['name']:
                 cmd += ['-s', 'name']
-            cp = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            if cp.returncode != 0:
-                raise CallError(f'Failed to retrieve snapshots: {cp.stderr}')
             snaps = [
-                {'name': i, 'pool': i.split('/', 1)[0]}
-                for i in cp.stdout.strip().split('\n')
+                {'name': name, 'pool': name.split('/', 1)[0]}
+                for name, in zfs_get_lines(cmd)
             ]
-            if filters:
-                return filter_list(snaps, filters, options)
-            return snaps
+            return filter_list(snaps, filters, options)
+
+        properties = zfs_query_properties(
+            filters, options, {'id', 'name', 'pool', 'type', 'dataset', 'snapshot_name'},
+        )
+        if properties is not None:
+            snapshots = zfs_list_properties('snapshot', properties, zfs_query_names(filters))
+            return filter_list(snapshots, filters, options)
+        names = zfs_query_names(filters)
         with libzfs.ZFS() as zfs:
             # Handle `id` filter to avoid getting all snapshots first
             snapshots = []
-            if filters and len(filters) == 1 and list(filters[0][:2]) == ['id', '=']:
-                try:
-                    snapshots.append(zfs.get_snapshot(filters[0][2]).__getstate__())
-                except libzfs.ZFSException as e:
-                    if e.code != libzfs.Error.NOENT:
-                        raise
+            if names is not None:
+                for name in names:
+                    try:
+                        snapshots.append(zfs.get_snapshot(name).__getstate__())
+                    except libzfs.ZFSException as e:
+                        if e.code != libzfs.Error.NOENT:
+                            raise
             else:
                 for i in zfs.snapshots:
                     try:
@@ -710,6 +844,10 @@ class ZFSSnapshot(CRUDService):
             self.logger.error(f"{err}")
             return False
         finally:
+            # Names of recursively taken snapshots are not known in advance
+            self.middleware.call_sync(
+                'zfs.cache.invalidate', 'SNAPSHOT', None if recursive else f'{dataset}@{name}',
+            )
             if vmware_context:
                 self.middleware.call_sync('vmware.snapshot_end', vmware_context)
 
@@ -750,6 +888,8 @@ class ZFSSnapshot(CRUDService):
                 snap.delete(defer=options['defer'])
         except libzfs.ZFSException as e:
             raise CallError(str(e))
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate', 'SNAPSHOT', id)
 
     @accepts(Dict(
         'snapshot_clone',
@@ -782,6 +922,8 @@ class ZFSSnapshot(CRUDService):
         except libzfs.ZFSException as err:
             self.logger.error("{0}".format(err))
             return False
+        finally:
+            self.middleware.call_sync('zfs.cache.invalidate', 'DATASET', dataset_dst)
 
     @accepts(
         Str('id'),
@@ -817,6 +959,194 @@ class ZFSSnapshot(CRUDService):
             )
         except subprocess.CalledProcessError as e:
             raise CallError(f'Failed to rollback snapshot: {e.stderr.strip()}')
+        finally:
+            dataset = id.split('@', 1)[0]
+            self.middleware.call_sync('zfs.cache.invalidate', 'DATASET', dataset, {'recursive': True})
+            self.middleware.call_sync('zfs.cache.invalidate', 'SNAPSHOT', dataset, {'recursive': True})
+
+
+class ZFSObjectCache(object):
+    """
+    Objects of one ZFS type (pools, datasets or snapshots) keyed by name.
+
+    Names in `stale` are refreshed with a single query on the next lookup, everything
+    else is reloaded in full once `ttl` expires or too many names are stale.
+
+    Cached datasets embed their `children`, so invalidating a name also marks its
+    cached ancestors.
+    """
+
+    def __init__(self, ttl, max_stale=ZFS_CACHE_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.objects = {}
+        self.stale = set()
+        self.loaded_at = None
+        self.dirty = False
+        self.lock = asyncio.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'invalidations': 0}
+
+    def needs_reload(self):
+        return (
+            self.loaded_at is None or
+            time.monotonic() - self.loaded_at > self.ttl or
+            len(self.stale) > self.max_stale
+        )
+
+    def begin_reload(self):
+        # Invalidations arriving while we enumerate end up in `stale` again
+        self.stale = set()
+        self.dirty = False
+
+    def load(self, objects):
+        self.objects = {i['name']: i for i in objects}
+        self.loaded_at = None if self.dirty else time.monotonic()
+
+    def pop_stale(self):
+        stale, self.stale = self.stale, set()
+        return stale
+
+    def set(self, name, obj):
+        if obj is None:
+            self.objects.pop(name, None)
+        else:
+            self.objects[name] = obj
+
+    def invalidate(self, name=None, recursive=False):
+        self.stats['invalidations'] += 1
+        if name is None:
+            self.loaded_at = None
+            self.dirty = True
+            return
+
+        self.stale.add(name)
+        self.invalidate_ancestors(name)
+        if recursive:
+            self.invalidate_children(name)
+
+    def invalidate_ancestors(self, name):
+        while '/' in name or '@' in name:
+            name = name.split('@', 1)[0] if '@' in name else name.rsplit('/', 1)[0]
+            if name in self.objects:
+                self.stale.add(name)
+
+    def invalidate_children(self, name):
+        self.stale.update(
+            i for i in self.objects if i.startswith((f'{name}/', f'{name}@'))
+        )
+
+
+class ZFSCacheService(Service):
+
+    TYPES = {
+        'POOL': ('zfs.pool', 10),
+        'DATASET': ('zfs.dataset', 30),
+        'SNAPSHOT': ('zfs.snapshot', 60),
+    }
+
+    class Config:
+        namespace = 'zfs.cache'
+        private = True
+
+    def __init__(self, *args, **kwargs):
+        super(ZFSCacheService, self).__init__(*args, **kwargs)
+        self.caches = {type: ZFSObjectCache(ttl) for type, (namespace, ttl) in self.TYPES.items()}
+
+    @accepts(
+        Str('type', enum=list(TYPES)),
+        Ref('query-filters'),
+        Ref('query-options'),
+    )
+    async def query(self, type, filters, options):
+        """
+        Query cached ZFS objects of `type` with `query-filters` and `query-options`.
+
+        Objects are reloaded from `zfs.<type>.query` when the cache expires and
+        refreshed individually after being invalidated, so results may lag behind
+        properties that change on their own (e.g. space usage) for up to the TTL.
+        """
+        namespace = self.TYPES[type][0]
+        cache = self.caches[type]
+        async with cache.lock:
+            if cache.needs_reload():
+                cache.stats['misses'] += 1
+                cache.begin_reload()
+                cache.load(await self.middleware.call(f'{namespace}.query'))
+            elif cache.stale:
+                cache.stats['refreshes'] += 1
+                names = cache.pop_stale()
+                try:
+                    objects = await self.middleware.call(f'{namespace}.query', [['id', 'in', list(names)]])
+                except Exception:
+                    # Try again on the next lookup
+                    cache.stale |= names
+                    raise
+                objects = {i['name']: i for i in objects}
+                for name in names:
+                    cache.set(name, objects.get(name))
+            else:
+                cache.stats['hits'] += 1
+
+            # Fast path for lookups by name
+            if filters and len(filters) == 1 and list(filters[0][:2]) in (['id', '='], ['name', '=']):
+                obj = cache.objects.get(filters[0][2])
+                objects = [obj] if obj is not None else []
+            else:
+                objects = list(cache.objects.values())
+
+        # Callers are free to modify what they get back
+        return copy.deepcopy(filter_list(objects, filters, options))
+
+    @accepts(
+        Str('type', enum=list(TYPES)),
+        Str('name', null=True, default=None),
+        Dict('options', Bool('recursive', default=False)),
+    )
+    async def invalidate(self, type, name, options):
+        """
+        Mark `name` of `type` as changed, or the whole cache of `type` if `name` is null.
+
+        `options.recursive` also marks child datasets and snapshots of `name`.
+        A dataset `name` of type SNAPSHOT only marks its snapshots.
+        """
+        if type == 'SNAPSHOT' and name is not None and '@' not in name:
+            self.caches[type].invalidate_children(name)
+        else:
+            self.caches[type].invalidate(name, options['recursive'])
+        if type == 'DATASET' and name is not None:
+            # Pools embed their root dataset
+            self.caches['POOL'].invalidate(name.split('/', 1)[0])
+
+    @private
+    async def invalidate_pool(self, pool):
+        self.caches['POOL'].invalidate(pool)
+        self.caches['DATASET'].invalidate(pool, recursive=True)
+        self.caches['SNAPSHOT'].invalidate_children(pool)
+
+    @private
+    async def invalidate_new_pool(self, pool):
+        """
+        Datasets and snapshots of a created or imported pool are not cached yet, reload them in full.
+        """
+        self.caches['POOL'].invalidate(pool)
+        for type in ('DATASET', 'SNAPSHOT'):
+            self.caches[type].invalidate()
+
+    @accepts()
+    async def stats(self):
+        """
+        Returns hit/miss counters and the number of entries for each cached type.
+        """
+        now = time.monotonic()
+        return {
+            type: dict(
+                cache.stats,
+                entries=len(cache.objects),
+                stale=len(cache.stale),
+                age=None if cache.loaded_at is None else now - cache.loaded_at,
+            )
+            for type, cache in self.caches.items()
+        }
 
 
 class ScanWatch(object):
@@ -887,6 +1217,33 @@ async def devd_zfs_hook(middleware, data):
         await middleware.call('alert.oneshot_delete', 'ScrubFinished', data.get('pool_name'))
         await middleware.call('alert.oneshot_create', 'ScrubFinished', data.get('pool_name'))
 
+    await devd_zfs_cache_hook(middleware, data)
+
+
+async def devd_zfs_cache_hook(middleware, data):
+    pool = data.get('pool_name')
+    if not pool:
+        return
+
+    if data.get('type') in ('misc.fs.zfs.pool_create', 'misc.fs.zfs.pool_import'):
+        await middleware.call('zfs.cache.invalidate_new_pool', pool)
+        return
+
+    if data.get('type') == 'misc.fs.zfs.pool_destroy':
+        await middleware.call('zfs.cache.invalidate_pool', pool)
+        return
+
+    # Any other pool event (vdev state, scrub, config sync...) may change its status
+    await middleware.call('zfs.cache.invalidate', 'POOL', pool)
+
+    # History events are also sent for changes made outside of middlewared
+    dsname = data.get('history_dsname')
+    if dsname:
+        if '@' in dsname:
+            await middleware.call('zfs.cache.invalidate', 'SNAPSHOT', dsname)
+        else:
+            await middleware.call('zfs.cache.invalidate', 'DATASET', dsname, {'recursive': True})
+
 
 def setup(middleware):
     middleware.event_register('zfs.pool.scan', 'Progress of pool resilver/scrub.')
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Benchmark of the ctl.conf generator (`etc_files/ctld.py`) on a synthetic
+configuration served by an in-memory datastore. Every middleware call costs
+`--latency` milliseconds, roughly what a round-trip through the event loop
+and a thread costs in middlewared.
+
+An older version of the generator can be compared with `--legacy`:
+
+    git show <rev>:src/middlewared/middlewared/etc_files/ctld.py > /tmp/ctld_legacy.py
+    python ctld_generate.py --extents 2000 --legacy /tmp/ctld_legacy.py
+"""
+import argparse
+import imp
+import os
+import tempfile
+import time
+
+from middlewared.etc_files import ctld
+
+
+def synthetic_config(extents, portals):
+    portal_rows = [{
+        'id': i,
+        'iscsi_target_portal_tag': i,
+        'iscsi_target_portal_discoveryauthgroup': 1 if i % 2 else None,
+        'iscsi_target_portal_discoveryauthmethod': 'CHAP' if i % 2 else 'None',
+    } for i in range(1, portals + 1)]
+    extent_rows = [{
+        'id': i,
+        'iscsi_target_extent_name': f'extent{i}',
+        'iscsi_target_extent_type': 'Disk' if i % 10 == 0 else 'ZVOL',
+        'iscsi_target_extent_path': f'{{serial}}SERIAL{i}' if i % 10 == 0 else f'zvol/tank/zvol{i}',
+        'iscsi_target_extent_filesize': '0',
+        'iscsi_target_extent_blocksize': 512,
+        'iscsi_target_extent_pblocksize': False,
+        'iscsi_target_extent_serial': f'{i:015d}',
+        'iscsi_target_extent_xen': False,
+        'iscsi_target_extent_legacy': False,
+        'iscsi_target_extent_naa': f'0x6589cfc{i:09x}',
+        'iscsi_target_extent_insecure_tpc': True,
+        'iscsi_target_extent_avail_threshold': None,
+        'iscsi_target_extent_rpm': 'SSD',
+        'iscsi_target_extent_ro': False,
+    } for i in range(1, extents + 1)]
+    target_rows = [{
+        'id': i,
+        'iscsi_target_name': f'target{i}',
+        'iscsi_target_alias': None,
+    } for i in range(1, extents + 1)]
+    return {
+        'services.iSCSITargetGlobalConfiguration': [{
+            'id': 1,
+            'iscsi_basename': 'iqn.2005-10.org.freenas.ctl',
+            'iscsi_isns_servers': '',
+            'iscsi_pool_avail_threshold': 80,
+            'iscsi_alua': False,
+        }],
+        'services.iSCSITargetAuthCredential': [{
+            'id': i,
+            'iscsi_target_auth_tag': 1,
+            'iscsi_target_auth_user': f'user{i}',
+            'iscsi_target_auth_secret': f'secret{i:08d}',
+            'iscsi_target_auth_peeruser': '',
+            'iscsi_target_auth_peersecret': '',
+        } for i in range(1, 3)],
+        'services.iSCSITargetPortal': portal_rows,
+        'services.iSCSITargetPortalIP': [{
+            'id': i,
+            'iscsi_target_portalip_portal': portal,
+            'iscsi_target_portalip_ip': f'10.0.{i}.1',
+            'iscsi_target_portalip_port': 3260,
+        } for i, portal in enumerate(portal_rows, 1)],
+        'services.iSCSITargetExtent': extent_rows,
+        'storage.Disk': [{
+            'id': i,
+            'disk_identifier': f'{{serial}}SERIAL{i}',
+            'disk_multipath_name': '',
+            'disk_expiretime': None,
+        } for i in range(10, extents + 1, 10)],
+        'services.iSCSITarget': target_rows,
+        'services.iscsitargetgroups': [{
+            'id': target['id'],
+            'iscsi_target': target,
+            'iscsi_target_portalgroup': portal_rows[target['id'] % portals],
+            'iscsi_target_authgroup': None,
+            'iscsi_target_authtype': 'None',
+            'iscsi_target_initiatorgroup': None,
+        } for target in target_rows],
+        'services.fibrechanneltotarget': [],
+        'services.iscsitargettoextent': [{
+            'id': target['id'],
+            'iscsi_target': target,
+            'iscsi_extent': extent,
+            'iscsi_lunid': 0 if target['id'] % 2 else None,
+        } for target, extent in zip(target_rows, extent_rows)],
+        'network.Interfaces': [],
+        'network.Alias': [],
+    }
+
+
+def match(row, filters):
+    for name, op, value in filters or []:
+        field = row[name]
+        if isinstance(field, dict):
+            field = field['id']
+        if op == '=' and field != value:
+            return False
+        if op == '!=' and field == value:
+            return False
+        if op == 'in' and field not in value:
+            return False
+    return True
+
+
+class FakeMiddleware:
+    def __init__(self, tables, latency):
+        self.tables = tables
+        self.latency = latency
+        self.calls = 0
+
+    def call_sync(self, name, *args):
+        self.calls += 1
+        time.sleep(self.latency)
+        if name == 'datastore.query':
+            table, filters, options = (list(args) + [None, None])[:3]
+            options = options or {}
+            rows = [row for row in self.tables[table] if match(row, filters)]
+            if 'null_first' in str(options.get('extra')):
+                rows.sort(key=lambda row: (row['iscsi_lunid'] is None, row['iscsi_lunid'] or 0))
+            if options.get('get'):
+                return rows[0]
+            return rows
+        if name == 'disk.identifier_to_device':
+            return 'da' + args[0][len('{serial}SERIAL'):]
+        if name == 'disk.identifiers_to_devices':
+            return {ident: 'da' + ident[len('{serial}SERIAL'):] for ident in args[0]}
+        if name == 'notifier.zpool_list':
+            return {'tank': {'size': 10 * 1024 ** 4}}
+        if name == 'notifier.is_freenas':
+            return True
+        raise ValueError(name)
+
+
+def run(module, tables, latency, directory):
+    module.ctl_config = os.path.join(directory, 'ctl.conf')
+    module.ctl_config_shadow = os.path.join(directory, 'ctl.conf.shadow')
+    middleware = FakeMiddleware(tables, latency)
+    start = time.monotonic()
+    result = module.main(middleware)
+    elapsed = time.monotonic() - start
+    with open(module.ctl_config) as f:
+        return elapsed, middleware.calls, f.read(), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--extents', type=int, default=2000)
+    parser.add_argument('--portals', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.2, help='milliseconds per middleware call')
+    parser.add_argument('--legacy', help='path of an older ctld.py to compare with')
+    args = parser.parse_args()
+
+    tables = synthetic_config(args.extents, args.portals)
+    latency = args.latency / 1000
+    print(f'{args.extents} extents and targets, {args.portals} portals')
+    print(f'{"":<14}{"time (s)":>10}{"calls":>8}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.legacy:
+            legacy = imp.load_source('ctld_legacy', args.legacy)
+            elapsed, calls, legacy_text, _ = run(legacy, tables, latency, directory)
+            print(f'{"legacy":<14}{elapsed:>10.3f}{calls:>8}')
+            os.unlink(legacy.ctl_config)
+
+        elapsed, calls, text, diff = run(ctld, tables, latency, directory)
+        print(f'{"bulk":<14}{elapsed:>10.3f}{calls:>8}')
+        if args.legacy:
+            print('output identical to legacy' if text == legacy_text else 'OUTPUT DIFFERS FROM LEGACY')
+
+        tables['services.iSCSITargetExtent'][0]['iscsi_target_extent_ro'] = True
+        elapsed, calls, text, diff = run(ctld, tables, latency, directory)
+        print(f'{"one change":<14}{elapsed:>10.3f}{calls:>8}')
+        print(', '.join(f'{change}: {len(keys)}' for change, keys in diff.items()),
+              [f'{kind} "{name}"' for kind, name in diff['changed']])
+
+
+if __name__ == '__main__':
+    main()
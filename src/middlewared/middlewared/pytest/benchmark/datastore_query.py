@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Benchmark of `datastore.query` serialization on a synthetic iSCSI configuration.
+
+A copy of the config database is filled with `--rows` targets, extents and their
+associations, then serialized with the previous row by row relation lookups and with
+`datastore.query`, reporting the number of SQL queries and time spent.
+
+    python datastore_query.py --database /data/freenas-v1.db --rows 10000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def setup_django(database):
+    sys.path.append('/usr/local/www')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+    from django.conf import settings
+    # Plain sqlite3 backend, we do not want anything replicated to a standby node
+    settings.DATABASES['default']['ENGINE'] = 'django.db.backends.sqlite3'
+    settings.DATABASES['default']['NAME'] = database
+    import django
+    django.setup()
+
+
+def populate(rows):
+    from django.db import transaction
+    from freenasUI.services import models
+
+    with transaction.atomic():
+        portal = models.iSCSITargetPortal.objects.create(iscsi_target_portal_tag=9999)
+        initiator = models.iSCSITargetAuthorizedInitiator.objects.create(iscsi_target_initiator_tag=9999)
+        models.iSCSITarget.objects.bulk_create([
+            models.iSCSITarget(iscsi_target_name=f'bench{i}') for i in range(rows)
+        ])
+        models.iSCSITargetExtent.objects.bulk_create([
+            models.iSCSITargetExtent(
+                iscsi_target_extent_name=f'bench{i}', iscsi_target_extent_path=f'zvol/tank/bench{i}',
+            ) for i in range(rows)
+        ])
+        targets = list(models.iSCSITarget.objects.filter(iscsi_target_name__startswith='bench'))
+        extents = list(models.iSCSITargetExtent.objects.filter(iscsi_target_extent_name__startswith='bench'))
+        models.iSCSITargetGroups.objects.bulk_create([
+            models.iSCSITargetGroups(
+                iscsi_target=target, iscsi_target_portalgroup=portal, iscsi_target_initiatorgroup=initiator,
+            ) for target in targets
+        ])
+        models.iSCSITargetToExtent.objects.bulk_create([
+            models.iSCSITargetToExtent(iscsi_target=target, iscsi_extent=extent, iscsi_lunid=0)
+            for target, extent in zip(targets, extents)
+        ])
+
+
+def measure(fn):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        start = time.monotonic()
+        count = len(fn())
+        elapsed = time.monotonic() - start
+    return count, len(queries), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='/data/freenas-v1.db')
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = os.path.join(tmpdir, 'freenas-v1.db')
+        shutil.copy(args.database, database)
+        setup_django(database)
+        populate(args.rows)
+
+        from django.apps import apps
+        from middlewared.plugins.datastore import DatastoreService
+        from middlewared.utils import django_modelobj_serialize
+
+        datastore = DatastoreService(None)
+        print(f'{"model":<32}{"rows":>8}{"queries before":>16}{"queries after":>15}{"before (s)":>12}{"after (s)":>11}')
+        for name in ('services.iscsitargetgroups', 'services.iscsitargettoextent', 'services.iscsitarget'):
+            model = apps.get_model(*name.split('.', 1))
+            count, before_queries, before = measure(
+                lambda: [django_modelobj_serialize(None, i) for i in model.objects.all()]
+            )
+            count, after_queries, after = measure(lambda: datastore.query(name))
+            print(f'{name:<32}{count:>8}{before_queries:>16}{after_queries:>15}{before:>12.2f}{after:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Benchmark of `etc.generate_all` on a synthetic set of groups, comparing the previous
+generation (a new mako `TemplateLookup` and a fresh import of every python renderer
+on each render, one group at a time, every file rewritten in place and fsynced) with
+`EtcService`, run twice like on boot and then on the first configuration change.
+
+    python etc_generate.py --groups 40 --files 4 --lines 500
+"""
+import argparse
+import asyncio
+import imp
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from mako.lookup import TemplateLookup
+
+from middlewared.plugins.etc import EtcService
+from middlewared.utils.threadpool import IoThreadPoolExecutor
+
+MAKO_TEMPLATE = """\
+<%
+    items = middleware.items
+%>\\
+% for i in items:
+option_${i} = "${'value-%d' % i}"
+% endfor
+"""
+
+PY_RENDERER = """\
+import hashlib
+
+
+def render(service, middleware):
+    return '\\n'.join(hashlib.sha1(str(i).encode()).hexdigest() for i in middleware.items) + '\\n'
+"""
+
+
+class FakeMiddleware:
+    def __init__(self, lines):
+        self.items = list(range(lines))
+        self.executor = IoThreadPoolExecutor(core_size=10)
+
+    async def run_in_thread(self, method, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, lambda: method(*args, **kwargs))
+
+
+def populate(files_dir, groups, files):
+    result = {}
+    for g in range(groups):
+        entries = []
+        os.makedirs(os.path.join(files_dir, f'group{g}'))
+        for f in range(files):
+            path = f'group{g}/file{f}'
+            if f % 2:
+                with open(os.path.join(files_dir, f'{path}.py'), 'w') as fd:
+                    fd.write(PY_RENDERER)
+                entries.append({'type': 'py', 'path': path})
+            else:
+                with open(os.path.join(files_dir, path), 'w') as fd:
+                    fd.write(MAKO_TEMPLATE)
+                entries.append({'type': 'mako', 'path': path})
+        result[f'group{g}'] = entries
+    return result
+
+
+def legacy_write_if_changed(path, data):
+    data = data.encode()
+    with open(os.open(path, os.O_CREAT | os.O_RDWR), 'wb+') as f:
+        current = f.read()
+        if current != data:
+            f.seek(0)
+            f.write(data)
+            f.truncate()
+        os.fsync(f)
+
+
+async def legacy_generate_all(middleware, groups, files_dir, etc_dir):
+    for entries in groups.values():
+        for entry in entries:
+            path = os.path.join(files_dir, entry['path'])
+            name, dir = os.path.basename(path), os.path.dirname(path)
+            if entry['type'] == 'mako':
+                def do():
+                    lookup = TemplateLookup(directories=[dir], module_directory=f'{tempfile.gettempdir()}/mako/{dir}')
+                    return lookup.get_template(name).render(middleware=middleware)
+                rendered = await middleware.run_in_thread(do)
+            else:
+                mod = imp.load_module(name, *imp.find_module(name, [dir]))
+                rendered = await middleware.run_in_thread(mod.render, None, middleware)
+            legacy_write_if_changed(os.path.join(etc_dir, entry['path']), rendered)
+
+
+def run(loop, coro_factory, etc_dir, groups):
+    shutil.rmtree(etc_dir, ignore_errors=True)
+    for name in groups:
+        os.makedirs(os.path.join(etc_dir, name))
+
+    times = []
+    for i in range(2):
+        start = time.monotonic()
+        loop.run_until_complete(coro_factory())
+        times.append(time.monotonic() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--groups', type=int, default=40)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--lines', type=int, default=500)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    root = tempfile.mkdtemp()
+    try:
+        files_dir = os.path.join(root, 'etc_files')
+        etc_dir = os.path.join(root, 'etc')
+        groups = populate(files_dir, args.groups, args.files)
+
+        loop = asyncio.get_event_loop()
+        middleware = FakeMiddleware(args.lines)
+
+        legacy = run(loop, lambda: legacy_generate_all(middleware, groups, files_dir, etc_dir), etc_dir, groups)
+
+        service = EtcService(middleware)
+        service.GROUPS = groups
+        service.SKIP_LIST = []
+        service.DEPENDS = {}
+        service.files_dir = files_dir
+        service.etc_dir = etc_dir
+        cached = run(loop, service.generate_all, etc_dir, groups)
+
+        print(f'{args.groups} groups of {args.files} files, {args.lines} lines each')
+        print(f'{"":<16}{"legacy (s)":>12}{"EtcService (s)":>16}{"speedup":>10}')
+        for label, before, after in zip(('first run', 'unchanged run'), legacy, cached):
+            print(f'{label:<16}{before:>12.3f}{after:>16.3f}{before / after:>9.1f}x')
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
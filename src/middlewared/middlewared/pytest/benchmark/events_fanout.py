@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Throughput of `Middleware.send_event` fanning out `core.get_jobs` progress of
+`--jobs` jobs, sent from a thread like job progress is, to `--clients` websocket
+clients subscribed to it and to `--subscriptions` other events each.
+
+Every client checking its subscriptions and encoding and sending each event
+itself (previous implementation) is compared with the subscription index, the
+events being encoded once and CHANGED events of the same job coalescing while
+clients are behind.
+
+    python events_fanout.py --clients 50 --jobs 10 --events 20000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from middlewared.main import Application, Middleware
+
+
+class FakeResponse:
+    def __init__(self, keep=False):
+        self.sent = 0
+        self.messages = [] if keep else None
+        self.done = asyncio.Event()
+
+    async def send_str(self, data):
+        self.sent += 1
+        if self.messages is not None:
+            self.messages.append(data)
+        if '"removed"' in data:
+            self.done.set()
+        # Like a websocket waiting for the transport to drain
+        await asyncio.sleep(0)
+
+
+class LegacyApplication(Application):
+
+    def send_event(self, name, event_type, **kwargs):
+        if (
+            not any(i == name or i == '*' for i in self._Application__subscribed.values()) and
+            not any(i['name'] == name for i in self._Application__event_sources.values())
+        ):
+            return
+        event = {
+            'msg': event_type.lower(),
+            'collection': name,
+        }
+        kwargs = kwargs.copy()
+        if 'id' in kwargs:
+            event['id'] = kwargs.pop('id')
+        if event_type in ('ADDED', 'CHANGED'):
+            if 'fields' in kwargs:
+                event['fields'] = kwargs.pop('fields')
+        if kwargs:
+            event['extra'] = kwargs
+        self._send(event)
+
+
+def legacy_send_event(middleware, clients, name, event_type, **kwargs):
+    for wsclient in clients:
+        wsclient.send_event(name, event_type, **kwargs)
+
+
+def send_events(send_event, jobs, events):
+    for i in range(events):
+        job_id = i % jobs
+        send_event('core.get_jobs', 'CHANGED', id=job_id, fields={
+            'id': job_id,
+            'method': 'pool.scrub',
+            'state': 'RUNNING',
+            'progress': {'percent': i * 100 // events, 'description': f'Scrubbing ({i})', 'extra': None},
+        })
+    send_event('core.get_jobs', 'REMOVED', id=-1)
+
+
+async def run(loop, middleware, cls, send_event, args):
+    clients = []
+    for i in range(args.clients):
+        client = cls(middleware, loop, None, FakeResponse(keep=i == 0))
+        client.on_open()
+        await client.subscribe('jobs', 'core.get_jobs')
+        for j in range(args.subscriptions):
+            await client.subscribe(f'sub{j}', f'bench.event{j}')
+        clients.append(client)
+
+    start = time.monotonic()
+    await loop.run_in_executor(
+        None, send_events, lambda *a, **kw: send_event(middleware, clients, *a, **kw), args.jobs, args.events,
+    )
+    for client in clients:
+        await client.response.done.wait()
+    elapsed = time.monotonic() - start
+
+    # Clients end up with the last progress of every job
+    progress = {}
+    for message in clients[0].response.messages:
+        message = json.loads(message)
+        if message['msg'] == 'changed':
+            progress[message['id']] = message['fields']['progress']['percent']
+    assert progress == {
+        job_id: max(i for i in range(args.events) if i % args.jobs == job_id) * 100 // args.events
+        for job_id in range(args.jobs)
+    }, progress
+
+    sent = sum(client.response.sent for client in clients)
+    for client in clients:
+        await client.on_close()
+    return elapsed, sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--subscriptions', type=int, default=10, help='other events each client subscribes to')
+    parser.add_argument('--jobs', type=int, default=10)
+    parser.add_argument('--events', type=int, default=20000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    middleware = Middleware()
+    middleware.loop = loop
+
+    print(f'{"":<10}{"events/s":>12}{"messages sent":>16}')
+    for label, cls, send_event in (
+        ('legacy', LegacyApplication, legacy_send_event),
+        ('index', Application, lambda middleware, clients, *a, **kw: middleware.send_event(*a, **kw)),
+    ):
+        elapsed, sent = loop.run_until_complete(run(loop, middleware, cls, send_event, args))
+        print(f'{label:<10}{(args.events + 1) / elapsed:>12.0f}{sent:>16}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Throughput of job output downloads through `FileApplication` over HTTP, with a
+synthetic job writing `--size` MB to its output pipe (`pipe`) or providing a
+regular file (`file`, sent with sendfile).
+
+Copying the pipe to the response in a thread with a blocking hop to the event
+loop per 1 MiB chunk (previous implementation) is compared with the pipe being
+read by the event loop. Downloads are made with curl. Resuming the file output
+from its second half with a `Range` request is checked too.
+
+    python file_transfer.py --size 512 --chunk 1048576
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import types
+
+from aiohttp import web
+
+from middlewared.main import FileApplication
+from middlewared.pipe import Pipe, Pipes
+from middlewared.utils.threadpool import IoThreadPoolExecutor
+
+BLOCK = os.urandom(65536)
+
+
+class FakeMiddleware:
+    def __init__(self, loop):
+        self.loop = loop
+        self.jobs = {}
+        self.executor = IoThreadPoolExecutor(core_size=10)
+
+    async def call(self, method, *args, **kwargs):
+        # auth.get_token, the token is the job id
+        job_id = int(args[0])
+        return {'attributes': {'job': job_id, 'filename': f'job{job_id}.bin'}}
+
+    async def run_in_thread(self, method, *args, **kwargs):
+        return await self.loop.run_in_executor(self.executor, lambda: method(*args, **kwargs))
+
+
+def produce(f, size):
+    for i in range(0, size, len(BLOCK)):
+        f.write(BLOCK[:size - i])
+
+
+def pipe_producer(pipe, size):
+    with pipe.w:
+        produce(pipe.w, size)
+
+
+def file_producer(pipe, size, directory):
+    with tempfile.TemporaryFile(dir=directory) as f:
+        produce(f, size)
+        f.flush()
+        pipe.send_file(f)
+
+
+def start_job(middleware, fileapp, producer, *args):
+    job_id = len(middleware.jobs) + 1
+    job = types.SimpleNamespace(id=job_id, pipes=Pipes(output=Pipe(middleware)))
+    middleware.jobs[job_id] = job
+    fileapp.register_job(job_id)
+    threading.Thread(target=producer, args=(job.pipes.output,) + args, daemon=True).start()
+    return job_id
+
+
+async def legacy_download(middleware, fileapp, request):
+    job_id = int(request.match_info['job_id'])
+    job = middleware.jobs[job_id]
+    resp = web.StreamResponse(status=200, reason='OK', headers={
+        'Content-Type': 'application/octet-stream',
+        'Transfer-Encoding': 'chunked',
+    })
+    await resp.prepare(request)
+
+    def do_copy():
+        while True:
+            read = job.pipes.output.r.read(1048576)
+            if read == b'':
+                break
+            asyncio.run_coroutine_threadsafe(resp.write(read), loop=middleware.loop).result()
+
+    try:
+        await middleware.run_in_thread(do_copy)
+    finally:
+        await fileapp._cleanup_job(job_id)
+
+    await resp.drain()
+    return resp
+
+
+async def fetch(url, http_range=None):
+    # curl in its own process, so that the client does not compete for the event loop
+    args = ['curl', '-s', '-o', '/dev/null', '-w', '%{http_code} %{size_download}']
+    if http_range:
+        args += ['-r', http_range]
+    proc = await asyncio.create_subprocess_exec(*args, url, stdout=asyncio.subprocess.PIPE)
+    stdout = (await proc.communicate())[0]
+    return tuple(map(int, stdout.split()))
+
+
+async def main(args):
+    loop = asyncio.get_event_loop()
+    middleware = FakeMiddleware(loop)
+    fileapp = FileApplication(middleware, loop, chunk_size=args.chunk)
+
+    app = web.Application()
+    app.router.add_route('GET', '/_download/{job_id}', fileapp.download)
+    app.router.add_route('GET', '/legacy/{job_id}', lambda request: legacy_download(middleware, fileapp, request))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base = f'http://127.0.0.1:{port}'
+
+    size = int(args.size * 1024 * 1024)
+    print(f'{"":<24}{"MB/s":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        for label, path, producer, extra in (
+            ('legacy pipe', 'legacy', pipe_producer, ()),
+            ('pipe', '_download', pipe_producer, ()),
+            ('file', '_download', file_producer, (directory,)),
+        ):
+            job_id = start_job(middleware, fileapp, producer, size, *extra)
+            start = time.monotonic()
+            status, received = await fetch(f'{base}/{path}/{job_id}?auth_token={job_id}')
+            elapsed = time.monotonic() - start
+            assert (status, received) == (200, size), (label, status, received)
+            print(f'{label:<24}{size / elapsed / 1024 / 1024:>10.2f}')
+
+        # Interrupted download is resumed from its second half
+        job_id = start_job(middleware, fileapp, file_producer, size, directory)
+        status, received = await fetch(f'{base}/_download/{job_id}?auth_token={job_id}', '0-99')
+        assert (status, received) == (206, 100), (status, received)
+        status, received = await fetch(f'{base}/_download/{job_id}?auth_token={job_id}', f'{size // 2}-')
+        assert (status, received) == (206, size - size // 2), (status, received)
+        print('range requests ok')
+
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=512, help='MB per download')
+    parser.add_argument('--chunk', type=int, default=1048576)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of `middlewared.utils.filter_list` against the previous
+interpreted implementation, using snapshot-like rows.
+
+    python filter_list.py --rows 50000 --repeat 5
+"""
+import argparse
+import re
+import timeit
+
+from middlewared.utils import filter_list, get
+
+
+def legacy_filter_list(_list, filters=None, options=None):
+    opmap = {
+        '=': lambda x, y: x == y,
+        '!=': lambda x, y: x != y,
+        '>': lambda x, y: x > y,
+        '>=': lambda x, y: x >= y,
+        '<': lambda x, y: x < y,
+        '<=': lambda x, y: x <= y,
+        '~': lambda x, y: re.match(y, x),
+        'in': lambda x, y: x in y,
+        'nin': lambda x, y: x not in y,
+        '^': lambda x, y: x.startswith(y),
+        '$': lambda x, y: x.endswith(y),
+    }
+
+    filters = filters or []
+    options = options or {}
+    select = options.get('select')
+
+    def filterop(i, f):
+        name, op, value = f
+        return opmap[op](get(i, name) if isinstance(i, dict) else getattr(i, name), value)
+
+    rv = []
+    for i in _list:
+        valid = True
+        for f in filters:
+            if len(f) == 2:
+                if not any(filterop(i, f) for f in f[1]):
+                    valid = False
+                    break
+            elif not filterop(i, f):
+                valid = False
+                break
+        if not valid:
+            continue
+        if select:
+            i = {s: i[s] for s in select if s in i}
+        rv.append(i)
+
+    if options.get('count') is True:
+        return len(rv)
+
+    for o in options.get('order_by') or []:
+        reverse = o.startswith('-')
+        o = o[1:] if reverse else o
+        rv = sorted(rv, key=lambda x: x[o], reverse=reverse)
+
+    offset = options.get('offset') or 0
+    limit = options.get('limit') or 0
+    if offset or limit:
+        rv = rv[offset:offset + limit if limit else None]
+
+    if options.get('get') is True:
+        return rv[0]
+    return rv
+
+
+def rows(count):
+    return [
+        {
+            'id': f'tank/ds{i % 500}@auto-{i}',
+            'name': f'tank/ds{i % 500}@auto-{i}',
+            'pool': 'tank',
+            'dataset': f'tank/ds{i % 500}',
+            'type': 'SNAPSHOT',
+            'properties': {'used': {'parsed': (i * 7919) % 1000003}},
+            'createtxg': i,
+        }
+        for i in range(count)
+    ]
+
+
+CASES = [
+    ('equal', [['dataset', '=', 'tank/ds42']], {}),
+    ('regex', [['name', '~', r'.*@auto-1\d+$']], {}),
+    ('in', [['dataset', 'in', [f'tank/ds{i}' for i in range(0, 500, 5)]]], {}),
+    ('or + nested', [['OR', [['properties.used.parsed', '>', 999000], ['dataset', '^', 'tank/ds49']]]], {}),
+    ('order_by 2 keys', [], {'order_by': ['dataset', '-createtxg']}),
+    ('top 10', [['pool', '=', 'tank']], {'order_by': ['-createtxg'], 'limit': 10}),
+    ('count', [['type', '=', 'SNAPSHOT']], {'count': True}),
+    ('get', [['name', '$', '-0']], {'order_by': ['createtxg'], 'get': True}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data = rows(args.rows)
+    print(f'{"case":<20}{"legacy (ms)":>14}{"compiled (ms)":>16}{"speedup":>10}')
+    for name, filters, options in CASES:
+        legacy = min(timeit.repeat(
+            lambda: legacy_filter_list(data, filters, options), number=1, repeat=args.repeat,
+        ))
+        compiled = min(timeit.repeat(
+            lambda: filter_list(data, filters, options), number=1, repeat=args.repeat,
+        ))
+        print(f'{name:<20}{legacy * 1000:>14.2f}{compiled * 1000:>16.2f}{legacy / compiled:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
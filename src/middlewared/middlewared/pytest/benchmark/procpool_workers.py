@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Startup time and RSS of `--workers` process pool workers, measured from the
+pool being created until every worker has loaded its plugins and run a no-op.
+
+Workers loading every plugin module (previous implementation) are compared with
+workers loading only the modules of `process_pool` services and the modules
+registering schemas they use.
+
+    python procpool_workers.py --workers 5 --rounds 3
+"""
+import argparse
+import concurrent.futures
+import functools
+import multiprocessing
+import time
+
+import psutil
+
+from middlewared.utils import LoadPluginsMixin
+from middlewared.worker import worker_init, worker_ready
+
+
+def start_workers(workers, modules):
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=functools.partial(worker_init, None, 'INFO', 'console', modules),
+    )
+    start = time.monotonic()
+    pids = {f.result() for f in [pool.submit(worker_ready) for i in range(workers)]}
+    elapsed = time.monotonic() - start
+    rss = [psutil.Process(pid).memory_info().rss for pid in pids]
+    pool.shutdown()
+    return elapsed, rss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('spawn')
+
+    plugins = LoadPluginsMixin(None)
+    plugins._load_plugins()
+    print(f'process pool modules: {", ".join(plugins._process_pool_modules)}')
+
+    print(f'{"":<16}{"startup s":>12}{"RSS MB":>10}{"max RSS MB":>12}')
+    for label, modules in (
+        ('all plugins', None),
+        ('process pool', plugins._process_pool_modules),
+    ):
+        elapsed = []
+        rss = []
+        for i in range(args.rounds):
+            round_elapsed, round_rss = start_workers(args.workers, modules)
+            elapsed.append(round_elapsed)
+            rss.extend(round_rss)
+        print(
+            f'{label:<16}{min(elapsed):>12.2f}{sum(rss) / len(rss) / 1024 / 1024:>10.1f}'
+            f'{max(rss) / 1024 / 1024:>12.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Benchmark of the sqlite3_ha config database replication against a local
+stand-in for the standby node: a second sqlite3 database that runs what
+would be sent with `failover.call_remote`, costing `--latency` milliseconds
+per call.
+
+`--transactions` transactions of `--statements` writes each are run on the
+active side, first replicating every statement with its own remote call and
+journal access (previous implementation), then through `Replicator`. The
+standby is then taken offline for a while to check that the journal is
+replayed in bulk, and both databases are compared.
+
+    python sqlite3_ha_replication.py --transactions 200 --statements 10
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+SCHEMA = [
+    'CREATE TABLE bench_item (id integer PRIMARY KEY, name varchar(120), value integer)',
+    'CREATE TABLE system_failover (id integer PRIMARY KEY, master bool, timeout integer)',
+]
+
+
+def setup_django(database):
+    sys.path.append('/usr/local/www')
+    from django.conf import settings
+    settings.configure(DATABASES={
+        'default': {'ENGINE': 'freenasUI.freeadmin.sqlite3_ha', 'NAME': database},
+    })
+    import django
+    django.setup()
+
+
+class StandbyNode:
+    def __init__(self, database, latency):
+        self.db = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+        self.latency = latency
+        self.online = True
+        self.calls = 0
+
+    def sql_batch(self, queries):
+        from freenasUI.middleware.client import ClientException
+        time.sleep(self.latency)
+        if not self.online:
+            raise ClientException('Standby node is offline')
+        self.calls += 1
+        self.db.execute('BEGIN')
+        for query, params in queries:
+            self.db.execute(query, params)
+        self.db.execute('COMMIT')
+
+
+def legacy_send(standby, journal, queries):
+    # One remote call per statement, loading and rewriting the journal every time
+    from freenasUI.middleware.client import ClientException
+    for query in queries:
+        try:
+            with journal() as j:
+                if j.queries:
+                    j.queries.append(query)
+                else:
+                    standby.sql_batch([query])
+        except ClientException:
+            with journal() as j:
+                j.queries.append(query)
+
+
+def workload(transactions, statements, offset=0):
+    from django.db import connection, transaction
+    for t in range(transactions):
+        with transaction.atomic():
+            cursor = connection.cursor()
+            for s in range(statements):
+                i = offset + t * statements + s
+                cursor.execute('INSERT INTO bench_item (id, name, value) VALUES (%s, %s, %s)', [i, f'item{i}', i])
+            cursor.execute('UPDATE system_failover SET master = %s, timeout = %s WHERE id = 1', [t % 2, t])
+
+
+def dump(db, table):
+    return db.execute(f'SELECT * FROM {table} ORDER BY id').fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=200)
+    parser.add_argument('--statements', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=2, help='milliseconds per remote call')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        active = os.path.join(directory, 'active.db')
+        standby_db = os.path.join(directory, 'standby.db')
+        for database in (active, standby_db):
+            db = sqlite3.connect(database)
+            for statement in SCHEMA:
+                db.execute(statement)
+            db.execute('INSERT INTO system_failover (id, master, timeout) VALUES (1, 1, 0)')
+            db.commit()
+            db.close()
+
+        setup_django(active)
+        from freenasUI.freeadmin.sqlite3_ha import base
+
+        class BenchJournal(base.Journal):
+            JOURNAL_FILE = os.path.join(directory, 'ha-journal')
+
+        base.failover_status.status = 'MASTER'
+        base.failover_status.expires = float('inf')
+        standby = StandbyNode(standby_db, args.latency / 1000)
+
+        total = args.transactions * (args.statements + 1)
+        print(f'{args.transactions} transactions of {args.statements + 1} statements')
+        print(f'{"":<12}{"time (s)":>10}{"calls":>8}')
+
+        base.replicator = base.Replicator(lambda queries: legacy_send(standby, BenchJournal, queries), BenchJournal)
+        start = time.monotonic()
+        workload(args.transactions, args.statements)
+        base.replicator.flush()
+        print(f'{"legacy":<12}{time.monotonic() - start:>10.3f}{standby.calls:>8}')
+
+        standby.calls = 0
+        base.replicator = base.Replicator(standby.sql_batch, BenchJournal)
+        start = time.monotonic()
+        workload(args.transactions, args.statements, offset=total)
+        base.replicator.flush()
+        print(f'{"batched":<12}{time.monotonic() - start:>10.3f}{standby.calls:>8}')
+
+        standby.calls = 0
+        standby.online = False
+        workload(args.transactions, args.statements, offset=2 * total)
+        base.replicator.flush()
+        with BenchJournal() as j:
+            journaled = len(j.queries)
+        standby.online = True
+        workload(1, args.statements, offset=3 * total)
+        base.replicator.flush()
+        print(f'{journaled} statements journaled while offline, replayed with {standby.calls} call(s)')
+
+        db = sqlite3.connect(active)
+        assert dump(db, 'bench_item') == dump(standby.db, 'bench_item'), 'standby is out of sync'
+        # `master` is not replicated
+        assert (
+            [row[2] for row in dump(db, 'system_failover')] == [row[2] for row in dump(standby.db, 'system_failover')]
+        )
+        assert dump(standby.db, 'system_failover')[0][1] == 1
+        assert BenchJournal.is_empty()
+        print('standby is in sync')
+
+
+if __name__ == '__main__':
+    main()
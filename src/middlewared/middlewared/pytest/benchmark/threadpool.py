@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Benchmark of `Middleware.run_in_thread` dispatching calls to a synthetic
+sync-method service, comparing a new ThreadPoolExecutor per call (previous
+implementation) with the shared `IoThreadPoolExecutor`.
+
+    python threadpool.py --calls 20000 --concurrency 50
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import time
+
+from middlewared.utils.threadpool import IoThreadPoolExecutor
+
+
+class Config:
+    namespace = 'bench'
+
+
+class BenchService:
+    _config = Config
+
+    def ping(self, value):
+        return value
+
+    def stat(self, value):
+        # A small blocking syscall, like most methods run in a thread
+        time.sleep(0)
+        return value
+
+
+async def legacy_run_in_thread(loop, method, *args, **kwargs):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run(calls, concurrency, method, executor=None):
+    loop = asyncio.new_event_loop()
+
+    if executor is None:
+        def call(i):
+            return legacy_run_in_thread(loop, method, i)
+    else:
+        async def call(i):
+            return await loop.run_in_executor(executor, functools.partial(method, i))
+
+    async def client(n):
+        for i in range(n):
+            await call(i)
+
+    async def bench():
+        await asyncio.gather(*[client(calls // concurrency) for i in range(concurrency)])
+
+    try:
+        start = time.monotonic()
+        loop.run_until_complete(bench())
+        return (calls // concurrency * concurrency) / (time.monotonic() - start)
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    service = BenchService()
+    print(f'{"method":<10}{"legacy (calls/s)":>18}{"pooled (calls/s)":>18}{"speedup":>10}')
+    for name in ('ping', 'stat'):
+        method = getattr(service, name)
+        legacy = run(args.calls, args.concurrency, method)
+        executor = IoThreadPoolExecutor(core_size=10)
+        try:
+            pooled = run(args.calls, args.concurrency, method, executor)
+            stats = executor.stats()
+        finally:
+            executor.shutdown()
+        print(f'{name:<10}{legacy:>18.0f}{pooled:>18.0f}{pooled / legacy:>9.1f}x')
+        print(f'{"":<10}threads started {stats["started"]}, peak {stats["peak"]}, '
+              f'{stats["tags"]["bench"]["calls"]} calls accounted to "bench"')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Throughput of the web shell `Terminal` replaying synthetic command output
+(`dmesg`, `zpool status -v` and a colored log tail), read in `--chunk` bytes
+like the pty is, with the screen dumped every `--poll` chunks.
+
+Every character going through the VT100 parser and the dumb terminal one at a
+time and the whole screen being dumped on each poll (previous implementation)
+is compared with the printable runs fast path and changed lines dumps.
+
+    python webshell_terminal.py --size 8 --chunk 4096 --poll 4
+"""
+import argparse
+import sys
+import time
+
+sys.path.append('/usr/local/www')
+
+from freenasUI.tools.webshell import Terminal  # noqa
+
+
+class LegacyTerminal(Terminal):
+
+    def write(self, d):
+        d = ''.join(self.utf8_decode_char(c) for c in d)
+        for c in d:
+            char = ord(c)
+            if self.vt100_write(char):
+                continue
+            if self.dumb_write(char):
+                continue
+            if char <= 0xffff:
+                self.dumb_echo(char)
+        return True
+
+    def dump(self, full=False):
+        return super().dump(True)
+
+
+def dmesg(i):
+    return (
+        f'[{i // 100:>5}.{i % 100:06d}] da{i % 24}: <ATA ST4000NM0033-9ZM SN04> Fixed Direct Access SPC-4 SCSI device\n'
+    )
+
+
+def zpool_status(i):
+    if i % 40 == 0:
+        return f'  pool: tank{i // 40}\n state: ONLINE\nconfig:\n\n\tNAME\t\tSTATE\tREAD WRITE CKSUM\n'
+    return f'\t  gptid/{i:08x}-7c3e-11e8-a1b2-0cc47a\tONLINE\t   0     0     0\n'
+
+
+def log_tail(i):
+    color = 31 + i % 7
+    return (
+        f'\x1b[1;{color}m{time.strftime("%b %d %H:%M:%S", time.gmtime(i))}\x1b[0m freenas '
+        f'middlewared[{1000 + i % 50}]: [plugins.pool] Scrub of pool tank finished in {i} seconds ✔\n'
+    )
+
+
+WORKLOADS = {
+    'dmesg': dmesg,
+    'zpool status -v': zpool_status,
+    'log tail': log_tail,
+}
+
+
+def generate(line, size):
+    data = []
+    total = 0
+    i = 0
+    while total < size:
+        # The tty translates newlines (onlcr)
+        chunk = line(i).replace('\n', '\r\n').encode()
+        data.append(chunk)
+        total += len(chunk)
+        i += 1
+    return b''.join(data)
+
+
+def replay(terminal, data, chunk, poll):
+    sent = 0
+    start = time.monotonic()
+    for n, i in enumerate(range(0, len(data), chunk)):
+        terminal.write(data[i:i + chunk])
+        if n % poll == 0:
+            sent += len(terminal.dump())
+    sent += len(terminal.dump())
+    return time.monotonic() - start, sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=8, help='MB of output per workload')
+    parser.add_argument('--chunk', type=int, default=4096)
+    parser.add_argument('--poll', type=int, default=4, help='chunks read between dumps')
+    parser.add_argument('--width', type=int, default=80)
+    parser.add_argument('--height', type=int, default=25)
+    args = parser.parse_args()
+
+    print(f'{"":<18}{"":<10}{"MB/s":>10}{"dumped MB":>12}')
+    for name, line in WORKLOADS.items():
+        data = generate(line, int(args.size * 1024 * 1024))
+        screens = []
+        for label, cls in (('legacy', LegacyTerminal), ('fast path', Terminal)):
+            terminal = cls(args.width, args.height)
+            elapsed, sent = replay(terminal, data, args.chunk, args.poll)
+            screens.append((terminal.screen, terminal.cx, terminal.cy))
+            print(f'{name:<18}{label:<10}{len(data) / elapsed / 1024 / 1024:>10.2f}{sent / 1024 / 1024:>12.2f}')
+        assert screens[0] == screens[1], 'screens differ'
+
+
+if __name__ == '__main__':
+    main()
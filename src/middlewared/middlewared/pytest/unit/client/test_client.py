@@ -0,0 +1,96 @@
+import queue
+import threading
+
+from middlewared.client.client import Client, Event, STREAM_WINDOW
+
+
+class FakeServer:
+    """
+    Replies to the messages sent by a client from a single thread, like the
+    websocket receive thread, sending streamed chunks as they are acknowledged.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.messages = queue.Queue()
+        self.client = Client.__new__(Client)
+        self.client._calls = {}
+        self.client._py_exceptions = False
+        self.client._closed = Event()
+        self.client._send = self.messages.put
+        self.received = []
+        self.sent_ahead = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        stream = None
+        while True:
+            message = self.messages.get()
+            if message['msg'] == 'method' and message['params'][1:] and message['params'][1].get('stream'):
+                stream = {'id': message['id'], 'credits': message['params'][1]['stream_window'], 'sent': 0}
+            elif message['msg'] == 'method':
+                self.client._recv({'id': message['id'], 'msg': 'result', 'result': message['method']})
+            elif message['msg'] == 'stream_ack' and stream:
+                if message.get('cancel'):
+                    stream = None
+                else:
+                    stream['credits'] += message['chunks']
+
+            while stream and stream['credits'] and stream['sent'] < self.chunks:
+                self.client._recv({'id': stream['id'], 'msg': 'result_chunk', 'result': [stream['sent']]})
+                stream['credits'] -= 1
+                stream['sent'] += 1
+                self.sent_ahead.append(stream['sent'] - len(self.received))
+            if stream and stream['sent'] == self.chunks:
+                self.client._recv({'id': stream['id'], 'msg': 'result', 'result': self.chunks})
+                stream = None
+
+
+def test__client_stream__call_while_streaming():
+    server = FakeServer(chunks=STREAM_WINDOW * 3)
+
+    for i in server.client.stream('pool.query'):
+        server.received.append(i)
+        # Replies to other calls are not held up by the chunks not consumed yet
+        assert server.client.call('core.ping', timeout=5) == 'core.ping'
+
+    assert server.received == list(range(STREAM_WINDOW * 3))
+    assert max(server.sent_ahead) <= STREAM_WINDOW
+
+
+def test__client_stream__stop_early():
+    server = FakeServer(chunks=STREAM_WINDOW * 3)
+
+    for i in server.client.stream('pool.query'):
+        server.received.append(i)
+        if i == 1:
+            break
+
+    assert server.client._calls == {}
+    assert server.client.call('core.ping', timeout=5) == 'core.ping'
+
+
+def test__client_send__one_message_at_a_time():
+    sending = threading.Event()
+    overlapped = []
+
+    class WS:
+        def send(self, data):
+            if sending.is_set():
+                overlapped.append(data)
+            sending.set()
+            threading.Event().wait(0.01)
+            sending.clear()
+
+    client = Client.__new__(Client)
+    client._send_lock = threading.Lock()
+    client._ws = WS()
+
+    threads = [threading.Thread(target=client._send, args=({'msg': 'ping', 'id': i},)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlapped == []
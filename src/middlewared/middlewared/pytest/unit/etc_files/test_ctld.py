@@ -0,0 +1,59 @@
+import textwrap
+
+from middlewared.etc_files.ctld import CtlConfig, diff_sections, parse_sections
+
+
+def test__ctl_config__sections():
+    config = CtlConfig()
+    config.section('auth-group', 'ag4pg1')
+    config.addline('auth-group "ag4pg1" {\n')
+    config.addline('\tchap "user" "secret"\n', plaintextonly=True)
+    config.addline('\tchap "REDACTED" "REDACTED"\n', shadowonly=True)
+    config.addline('}\n\n')
+    config.section('lun', 'extent1')
+    config.addline('lun "extent1" {\n')
+    config.addline('\tctl-lun "0"\n')
+    config.addline('}\n')
+    config.addline('\n')
+
+    assert config.contents() == textwrap.dedent('''\
+        auth-group "ag4pg1" {
+        \tchap "user" "secret"
+        }
+
+        lun "extent1" {
+        \tctl-lun "0"
+        }
+
+    ''')
+    assert 'secret' not in config.contents_shadow()
+    assert parse_sections(config.contents()) == config.section_texts()
+
+
+def test__diff_sections():
+    old = parse_sections(textwrap.dedent('''\
+        isns-server "isns.example.com"
+
+        lun "extent1" {
+        \tpath "/dev/zvol/tank/extent1"
+        }
+
+        lun "extent2" {
+        \tpath "/dev/zvol/tank/extent2"
+        }
+
+        target "iqn.2005-10.org.freenas.ctl:target1" {
+        \tlun "0" "extent1"
+        }
+    '''))
+    new = dict(old)
+    new[('lun', 'extent1')] = 'lun "extent1" {\n\tpath "/dev/zvol/tank/extent1"\n\toption "readonly" "on"\n}'
+    del new[('lun', 'extent2')]
+    new[('lun', 'extent3')] = 'lun "extent3" {\n\tpath "/dev/zvol/tank/extent3"\n}'
+
+    assert diff_sections(old, new) == {
+        'added': [('lun', 'extent3')],
+        'removed': [('lun', 'extent2')],
+        'changed': [('lun', 'extent1')],
+    }
+    assert diff_sections(old, old) == {'added': [], 'removed': [], 'changed': []}
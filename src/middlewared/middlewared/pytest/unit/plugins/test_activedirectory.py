@@ -0,0 +1,79 @@
+import threading
+import time
+from unittest.mock import Mock, patch
+
+from middlewared.plugins.activedirectory import ActiveDirectory_DNS, SRV, SRVCache
+from middlewared.service_exception import CallError
+from middlewared.utils.threadpool import IoThreadPoolExecutor
+
+
+def server(host, priority=0, weight=100, port=389):
+    return {'host': host, 'port': port, 'priority': priority, 'weight': weight}
+
+
+def test__srv_cache__order():
+    cache = SRVCache()
+    servers = [server('dc1'), server('dc2'), server('dc3'), server('dc4', priority=10)]
+
+    assert cache.order(servers) == servers
+
+    cache.probe_done('dc1', 389, None)
+    cache.probe_done('dc2', 389, 0.5)
+    cache.probe_done('dc3', 389, 0.1)
+    cache.probe_done('dc4', 389, 0.01)
+
+    assert [s['host'] for s in cache.order(servers)] == ['dc3', 'dc2', 'dc1', 'dc4']
+
+
+def test__srv_cache__ttl():
+    cache = SRVCache()
+    cache.put('_ldap._tcp.dc._msdcs.example.com', [server('dc1')], 600)
+    cache.put('_kerberos._tcp.example.com', [server('dc1', port=88)], -1)
+
+    assert cache.get('_ldap._tcp.dc._msdcs.example.com') == [server('dc1')]
+    assert cache.get('_kerberos._tcp.example.com') is None
+
+
+def test__get_n_working_servers__concurrent():
+    conf = {'domainname': 'example.com', 'site': None, 'dns_timeout': 10, 'ssl': 'off', 'verbose_logging': False}
+    servers = [server(f'dc{i}') for i in range(8)]
+    probes = {'started': 0, 'done': 0}
+    lock = threading.Lock()
+
+    def port_is_listening(host, port, timeout=1):
+        with lock:
+            probes['started'] += 1
+        try:
+            time.sleep(0.2)
+            if host in ('dc0', 'dc1', 'dc2', 'dc5'):
+                raise CallError('Connection refused')
+            return True
+        finally:
+            with lock:
+                probes['done'] += 1
+
+    executor = IoThreadPoolExecutor(core_size=2)
+    with patch('middlewared.plugins.activedirectory.srv_cache', SRVCache()) as cache:
+        ad_dns = ActiveDirectory_DNS(conf=conf, logger=Mock(), executor=executor)
+        with patch.object(ad_dns, '_get_servers', Mock(return_value=servers)):
+            with patch.object(ad_dns, 'port_is_listening', port_is_listening):
+                start = time.monotonic()
+                assert ad_dns.get_n_working_servers(SRV['DOMAINCONTROLLER'], 2) == [
+                    {'host': 'dc3', 'port': 389}, {'host': 'dc4', 'port': 389},
+                ]
+                # Unreachable servers were waited for at the same time
+                assert time.monotonic() - start < 0.6
+
+                # Probes still running when enough servers were found are not waited for, let them finish
+                while True:
+                    with lock:
+                        if probes['done'] == probes['started']:
+                            break
+                    time.sleep(0.01)
+
+        # Servers that failed are now tried last, whichever of them were probed
+        failed = {host for (host, port), (average, failed_at) in cache.probes.items() if failed_at is not None}
+        assert {'dc0', 'dc1', 'dc2'} <= failed <= {'dc0', 'dc1', 'dc2', 'dc5'}
+        assert set(s['host'] for s in cache.order(servers)[-len(failed):]) == failed
+
+    executor.shutdown()
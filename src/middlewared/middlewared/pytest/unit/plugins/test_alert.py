@@ -0,0 +1,155 @@
+import asyncio
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.alert.base import Alert, AlertSource
+from middlewared.plugins.alert import (
+    AlertService, AlertSourceRunFailedAlertClass, AlertStore, cancel_reraised_alerts,
+)
+from middlewared.pytest.unit.middleware import Middleware
+
+
+def alert(source, key, node="A", uuid=None):
+    return Alert(AlertSourceRunFailedAlertClass, args={"source_name": source, "traceback": ""}, key=key, node=node,
+                 _uuid=uuid or f"{node}-{source}-{key}", _source=source)
+
+
+def test__alert_store__replace_source():
+    store = AlertStore([alert("a", "1"), alert("a", "2"), alert("b", "1")])
+
+    a2 = alert("a", "2")
+    gone, new = store.replace_source("a", [a2, alert("a", "3")])
+
+    assert [a.uuid for a in gone] == ["A-a-1"]
+    assert [a.uuid for a in new] == ["A-a-3"]
+    assert store.get(a2) is a2
+    assert store.get_by_uuid("A-a-1") is None
+    assert sorted(a.uuid for a in store) == ["A-a-2", "A-a-3", "A-b-1"]
+    assert [a.uuid for a in store.source_alerts("b")] == ["A-b-1"]
+
+
+def test__cancel_reraised_alerts():
+    gone = [alert("a", "1"), alert("a", "2")]
+    new = [alert("b", "1", node="B"), alert("b", "1", node="B", uuid="other"), alert("b", "3")]
+
+    gone, new = cancel_reraised_alerts(gone, new)
+
+    assert [a.uuid for a in gone] == ["A-a-2"]
+    assert [a.uuid for a in new] == ["other", "A-b-3"]
+
+
+class AlertTable:
+    """
+    `system.alert` rows as datastore calls see them.
+    """
+
+    def __init__(self, middleware, rows=None):
+        self.rows = {row["id"]: row for row in rows or []}
+        self.next_id = max(self.rows, default=0) + 1
+        middleware["datastore.query"] = Mock(side_effect=self.query)
+        middleware["datastore.insert"] = Mock(side_effect=self.insert)
+        middleware["datastore.update"] = Mock(side_effect=self.update)
+        middleware["datastore.delete"] = Mock(side_effect=self.delete)
+
+    def query(self, name):
+        return [dict(row) for row in self.rows.values()]
+
+    def insert(self, name, data):
+        id = self.next_id
+        self.next_id += 1
+        self.rows[id] = dict(data, id=id)
+        return id
+
+    def update(self, name, id, data):
+        assert self.rows[id]["uuid"] == data["uuid"]
+        self.rows[id] = dict(data, id=id)
+
+    def delete(self, name, filters):
+        for id in filters[0][2]:
+            del self.rows[id]
+
+
+@pytest.mark.asyncio
+async def test__flush_alerts__writes_changed_rows():
+    m = Middleware()
+    table = AlertTable(m)
+    service = AlertService(m)
+    service.alerts = AlertStore([alert("a", "1"), alert("a", "2")])
+
+    await service.flush_alerts()
+    assert m["datastore.insert"].call_count == 2
+
+    m["datastore.insert"].reset_mock()
+    service.alerts.get_by_uuid("A-a-1").dismissed = True
+    service.alerts.replace_source("a", [service.alerts.get_by_uuid("A-a-1"), alert("a", "3")])
+    await service.flush_alerts()
+
+    m["datastore.delete"].assert_called_once_with("system.alert", [["id", "in", [2]]])
+    m["datastore.update"].assert_called_once()
+    assert m["datastore.update"].call_args[0][1] == 1
+    assert m["datastore.insert"].call_count == 1
+    assert sorted(row["uuid"] for row in table.rows.values()) == ["A-a-1", "A-a-3"]
+
+    m["datastore.update"].reset_mock()
+    await service.flush_alerts()
+    m["datastore.update"].assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test__flush_alerts__after_failover():
+    m = Middleware()
+    table = AlertTable(m)
+    service = AlertService(m)
+    service.alerts = AlertStore([alert("a", "1"), alert("a", "2")])
+    await service.flush_alerts()
+
+    # Table replicated from the other node while this one was BACKUP, with other row ids
+    rows = sorted(table.rows.values(), key=lambda row: row["uuid"], reverse=True)
+    AlertTable(m, [dict(row, id=id) for id, row in enumerate(rows, 10)])
+    service.alerts.get_by_uuid("A-a-1").dismissed = True
+    service.alerts.replace_source("a", [service.alerts.get_by_uuid("A-a-1")])
+    await service.flush_alerts()
+
+    m["datastore.delete"].assert_called_once_with("system.alert", [["id", "in", [10]]])
+    assert m["datastore.update"].call_args[0][1] == 11
+
+
+class HungAlertSource(AlertSource):
+    run_timeout = 0.1
+
+    def __init__(self, middleware):
+        super().__init__(middleware)
+        self.event = asyncio.Event()
+        self.runs = 0
+
+    async def check(self):
+        self.runs += 1
+        await self.event.wait()
+        return Alert(AlertSourceRunFailedAlertClass, args={"source_name": "Hung", "traceback": ""})
+
+
+@pytest.mark.asyncio
+async def test__run_source__timeout():
+    service = AlertService(Middleware())
+    source = HungAlertSource(service.middleware)
+    with patch("middlewared.plugins.alert.ALERT_SOURCES", {"Hung": source}):
+        alerts = await service.run_source("Hung")
+        assert alerts[0]["klass"] == "AlertSourceRunFailed"
+        assert "timeout is 0.1 seconds" in alerts[0]["args"]["traceback"]
+
+        # Still hung, the same alert is raised
+        again = await service.run_source("Hung")
+        assert again[0]["key"] == alerts[0]["key"] == json.dumps("Hung")
+
+        # Timed out check is waited for instead of being run again
+        source.event.set()
+        await service.run_source("Hung")
+        assert source.runs == 1
+
+        stats = (await service.sources_stats())[0]
+        assert stats["name"] == "Hung"
+        assert stats["running_for"] is None
+        assert stats["timeouts"] == 1
+        assert stats["last_run"]["result"] == "SUCCESS"
@@ -1,3 +1,4 @@
+import asyncio
 import textwrap
 from unittest.mock import patch
 
@@ -35,3 +36,78 @@ async def test__disk_service__sata_dom_lifetime_left():
 
     """)))):
         assert abs(await DiskService(m).sata_dom_lifetime_left("ada1") - 0.8926) < 1e-4
+
+
+@pytest.mark.asyncio
+async def test__disk_service__hotplug_events_are_batched():
+
+    m = Middleware()
+    for method in ("disk.sed_unlock", "disk.multipath_sync", "alert.oneshot_delete"):
+        m[method] = Mock()
+    service = DiskService(m)
+
+    with patch("middlewared.plugins.disk.DISK_HOTPLUG_DEBOUNCE", 0.05):
+        with patch.object(service, "sync_many", CoroutineMock()) as sync_many:
+            for name in ("da1", "da0", "da2"):
+                await service.hotplug_event("CREATE", name)
+            await asyncio.sleep(0.3)
+
+    sync_many.assert_called_once_with(["da0", "da1", "da2"])
+    m["disk.multipath_sync"].assert_called_once_with()
+    assert m["disk.sed_unlock"].call_count == 3
+
+
+@pytest.mark.asyncio
+async def test__disk_service__hotplug_failures_do_not_skip_swaps():
+
+    m = Middleware()
+    m["disk.sync_all"] = Mock(side_effect=Exception("sync failed"))
+    m["disk.sed_unlock"] = Mock(side_effect=Exception("unlock failed"))
+    m["disk.multipath_sync"] = Mock(side_effect=Exception("multipath failed"))
+    m["alert.oneshot_delete"] = Mock()
+    m["disk.swaps_configure"] = Mock()
+    service = DiskService(m)
+
+    with patch("middlewared.plugins.disk.DISK_HOTPLUG_DEBOUNCE", 0.05):
+        await service.hotplug_event("CREATE", "da0")
+        await service.hotplug_event("CREATE", "da1")
+        await service.hotplug_event("DESTROY", "da1")
+        await asyncio.sleep(0.3)
+
+    m["disk.sed_unlock"].assert_called_once_with("da0")
+    assert m["alert.oneshot_delete"].call_count == 2
+    m["disk.swaps_configure"].assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test__disk_service__sync_many():
+
+    m = Middleware()
+    m["device.get_info"] = Mock(return_value={"da0": {}, "da1": {}})
+    query = m._query_filter([
+        {"disk_identifier": "{serial}A", "disk_name": "da2", "disk_serial": "A", "disk_expiretime": None},
+        {"disk_identifier": "{serial}B", "disk_name": "da1", "disk_serial": "B", "disk_expiretime": None},
+    ])
+    m["datastore.query"] = Mock(side_effect=lambda name, filters, options: query(filters))
+    m["datastore.transaction"] = Mock()
+    m["service.started"] = Mock(return_value=False)
+
+    topology = Mock()
+    topology.geom.return_value = None
+    service = DiskService(m)
+    with patch("middlewared.plugins.disk.geom_topology.scan", Mock(return_value=topology)):
+        with patch.object(service, "_DiskService__device_to_identifier",
+                          CoroutineMock(side_effect=lambda t, name: {"da0": "{serial}A", "da1": "{serial}C"}[name])):
+            with patch.object(service, "_DiskService__serial_from_device", CoroutineMock(return_value=None)):
+                with patch.object(service, "_service_change", CoroutineMock()) as service_change:
+                    await service.sync_many(["da0", "da1", "da0"])
+
+    operations = m["datastore.transaction"].call_args[0][0]
+    assert [(op[0], op[2] if op[0] == "update" else op[2]["disk_identifier"]) for op in operations] == [
+        ("update", "{serial}A"),
+        ("update", "{serial}B"),
+        ("insert", "{serial}C"),
+    ]
+    assert operations[0][3]["disk_name"] == "da0"
+    assert operations[1][3]["disk_expiretime"] is not None
+    service_change.assert_called_once_with("smartd", "restart")
@@ -0,0 +1,100 @@
+import asyncio
+import copy
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.plugins.etc import CallCache, EtcService
+from middlewared.pytest.unit.middleware import Middleware
+
+
+@pytest.mark.asyncio
+async def test__etc_service__generate_all_dependencies():
+    service = EtcService(Middleware())
+    generated = []
+
+    async def generate(name, context):
+        # `user` is the slowest group, but `nss` still has to wait for it
+        await asyncio.sleep(0.05 if name == 'user' else 0)
+        generated.append(name)
+
+    with patch.object(EtcService, 'GROUPS', {'nss': [], 'user': [], 'motd': [], 'collectd': []}):
+        with patch.object(service, '_EtcService__generate_group', generate):
+            await service.generate_all()
+
+    assert generated == ['motd', 'user', 'nss']
+
+
+def test__call_cache__caches_read_calls():
+    m = Middleware()
+    m["smb.config"] = Mock(return_value={"workgroup": "WORKGROUP"})
+    m["datastore.query"] = Mock(return_value=[{"id": 1}])
+    m["smb.update"] = Mock()
+    m.call_sync = lambda name, *args: m[name](*args)
+    cache = CallCache(m)
+
+    config = cache.call_sync("smb.config")
+    assert cache.call_sync("smb.config") is config
+    assert m["smb.config"].call_count == 1
+
+    cache.call_sync("datastore.query", "services.services", [["srv_service", "=", "cifs"]])
+    cache.call_sync("datastore.query", "services.services", [["srv_service", "=", "nfs"]])
+    assert m["datastore.query"].call_count == 2
+
+    cache.call_sync("smb.update", {})
+    cache.call_sync("smb.config")
+    assert m["smb.config"].call_count == 2
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+@pytest.mark.asyncio
+async def test__call_cache__async_call():
+    m = Middleware()
+    m["certificate.query"] = Mock(return_value=[])
+    cache = CallCache(m)
+
+    await cache.call("certificate.query", [["cert_type_CSR", "=", False]])
+    await cache.call("certificate.query", [["cert_type_CSR", "=", False]])
+    assert m["certificate.query"].call_count == 1
+
+
+def test__call_cache__read_only_results():
+    m = Middleware()
+    m["sharing.smb.query"] = Mock(return_value=[{"path": "/mnt/tank", "hostsallow": ["10.0.0.0/8"]}])
+    m.call_sync = lambda name, *args: m[name](*args)
+    cache = CallCache(m)
+
+    shares = cache.call_sync("sharing.smb.query")
+    with pytest.raises(TypeError):
+        shares.append({})
+    with pytest.raises(TypeError):
+        shares[0]["path"] = "/mnt/other"
+    with pytest.raises(TypeError):
+        shares[0]["hostsallow"] += ["192.168.0.0/16"]
+
+    share = copy.deepcopy(shares[0])
+    share["hostsallow"].append("192.168.0.0/16")
+    assert type(share) is dict and json.dumps(shares[0]) == json.dumps(m["sharing.smb.query"]()[0])
+
+
+def test__call_cache__scope_invalidation():
+    m = Middleware()
+    m["smb.config"] = Mock(return_value={"workgroup": "WORKGROUP"})
+    m["smb.update"] = Mock()
+    m.call_sync = lambda name, *args: m[name](*args)
+    shared = CallCache(m)
+    smb, nfs = shared.scope(), shared.scope()
+
+    smb.call_sync("smb.config")
+    nfs.call_sync("smb.config")
+    assert m["smb.config"].call_count == 1
+
+    # Only the pass that may have changed the configuration throws its results away
+    smb.call_sync("smb.update", {})
+    nfs.call_sync("smb.config")
+    assert m["smb.config"].call_count == 1
+    smb.call_sync("smb.config")
+    smb.call_sync("smb.config")
+    assert m["smb.config"].call_count == 2
+    assert shared.results
@@ -0,0 +1,116 @@
+import enum
+import sys
+import textwrap
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.plugins.smb import SMBService, passdb_account_flags, passdb_changes
+from middlewared.pytest.unit.middleware import Middleware
+
+# Stand-in for pdbedit and smbpasswd keeping passdb in a smbpasswd file and logging their invocations
+PASSDB_TOOL = textwrap.dedent('''\
+    #!{python}
+    import sys
+
+    passdb = {passdb!r}
+    with open({log!r}, 'a') as f:
+        f.write(' '.join(sys.argv[1:]) + '\\n')
+    with open(passdb) as f:
+        entries = dict((line.split(':')[0], line.split(':')) for line in f.read().splitlines())
+    args = sys.argv[1:]
+    if args[:2] == ['-d', '0']:
+        args = args[2:]
+    if args == ['-Lw']:
+        for entry in entries.values():
+            print(':'.join(entry))
+    elif args[0] == '-i':
+        with open(args[1].split(':', 1)[1]) as f:
+            for line in f.read().splitlines():
+                entries.setdefault(line.split(':')[0], line.split(':'))
+    elif args[0] == '--set-nt-hash':
+        entries[args[2]][3] = args[1]
+    elif args[0] == '-x':
+        del entries[args[1]]
+    elif args[0] in ('-d', '-e'):
+        flags = entries[args[1]][4].strip('[]').replace(' ', '').replace('D', '')
+        entries[args[1]][4] = '[' + (flags + ('D' if args[0] == '-d' else '')).ljust(11) + ']'
+    with open(passdb, 'w') as f:
+        f.write(''.join(':'.join(entry) + '\\n' for entry in entries.values()))
+''')
+
+LM = 'X' * 32
+LCT = 'LCT-5C0E9A5B'
+
+
+def smbhash(username, uid, nt_hash, flags='[U          ]'):
+    return f'{username}:{uid}:{LM}:{nt_hash}:{flags}:{LCT}:'
+
+
+def user(username, uid, nt_hash, locked=False):
+    return {'username': username, 'uid': uid, 'smbhash': smbhash(username, uid, nt_hash), 'locked': locked}
+
+
+def test__passdb_account_flags():
+    assert passdb_account_flags('[U          ]', True) == '[UD         ]'
+    assert passdb_account_flags('[UD         ]', False) == '[U          ]'
+    assert passdb_account_flags('[DUX        ]', True) == '[UXD        ]'
+
+
+def test__passdb_changes():
+    pdb_entries = {
+        'same': smbhash('same', 1001, 'A' * 32).split(':'),
+        'password': smbhash('password', 1002, 'A' * 32).split(':'),
+        'locked': smbhash('locked', 1003, 'A' * 32).split(':'),
+        'unlocked': smbhash('unlocked', 1004, 'A' * 32, '[UD         ]').split(':'),
+        'stale': smbhash('stale', 1005, 'A' * 32).split(':'),
+    }
+    conf_users = {u['username']: u for u in [
+        user('same', 1001, 'A' * 32),
+        user('password', 1002, 'B' * 32),
+        user('locked', 1003, 'A' * 32, locked=True),
+        user('unlocked', 1004, 'A' * 32),
+        user('new', 1006, 'C' * 32, locked=True),
+    ]}
+
+    assert passdb_changes(pdb_entries, conf_users) == {
+        'add': [smbhash('new', 1006, 'C' * 32, '[UD         ]')],
+        'set_nt_hash': [('password', 'B' * 32)],
+        'disable': ['locked'],
+        'enable': ['unlocked'],
+        'delete': ['stale'],
+    }
+
+
+@pytest.mark.asyncio
+async def test__synchronize_passdb(tmp_path):
+    passdb = tmp_path / 'passdb'
+    passdb.write_text(
+        smbhash('password', 1002, 'A' * 32) + '\n' +
+        smbhash('stale', 1005, 'A' * 32) + '\n'
+    )
+    log = tmp_path / 'log'
+    tool = tmp_path / 'pdbedit'
+    tool.write_text(PASSDB_TOOL.format(python=sys.executable, passdb=str(passdb), log=str(log)))
+    tool.chmod(0o755)
+
+    conf_users = [user(f'user{i}', 2000 + i, 'C' * 32) for i in range(100)]
+    conf_users.append(user('password', 1002, 'B' * 32, locked=True))
+
+    m = Middleware()
+    m['smb.getparm'] = Mock(return_value='tdbsam')
+    m['user.query'] = Mock(return_value=conf_users)
+
+    cmd = enum.Enum('SMBCmd', {'PDBEDIT': str(tool), 'SMBPASSWD': str(tool)})
+    with patch('middlewared.plugins.smb.SMBCmd', cmd):
+        await SMBService(m).synchronize_passdb()
+
+    entries = dict((line.split(':')[0], line) for line in passdb.read_text().splitlines())
+    assert sorted(entries) == sorted(u['username'] for u in conf_users)
+    assert entries['password'] == smbhash('password', 1002, 'B' * 32, '[UD         ]')
+    assert entries['user0'] == smbhash('user0', 2000, 'C' * 32)
+
+    # One listing and one import however many users there are
+    calls = log.read_text().splitlines()
+    assert len(calls) == 5
+    assert len([c for c in calls if c.startswith('-d 0 -i smbpasswd:')]) == 1
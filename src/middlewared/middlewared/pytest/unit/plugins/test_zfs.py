@@ -0,0 +1,261 @@
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+
+from middlewared.plugins.zfs import (
+    ZFSCacheService, ZFSDatasetService, ZFSObjectCache, ZFSSnapshot, zfs_get_lines, zfs_list_properties,
+    zfs_query_properties,
+)
+from middlewared.pytest.unit.middleware import Middleware
+from middlewared.schema import Dict, List, Schemas, resolve_methods
+from middlewared.service_exception import CallError
+
+
+def resolve_query_schemas(service):
+    schemas = Schemas()
+    schemas.add(List('query-filters', default=None, null=True))
+    schemas.add(Dict('query-options', additional_attrs=True, default=None, null=True))
+    resolve_methods(schemas, [getattr(service, attr) for attr in dir(service)])
+    return service
+
+
+def zfs_cache_service(middleware):
+    return resolve_query_schemas(ZFSCacheService(middleware))
+
+
+class FakeZFSObject:
+    def __init__(self, name):
+        self.name = name
+
+    def __getstate__(self):
+        return {'id': self.name, 'name': self.name}
+
+
+def test__zfs_object_cache__invalidate_recursive():
+    cache = ZFSObjectCache(ttl=30)
+    cache.load([{'name': 'tank'}, {'name': 'tank/a'}, {'name': 'tank/a/b'}, {'name': 'tank/ab'}])
+
+    cache.invalidate('tank/a', recursive=True)
+
+    assert cache.stale == {'tank', 'tank/a', 'tank/a/b'}
+    assert not cache.needs_reload()
+
+
+def test__zfs_object_cache__invalidate_during_reload():
+    cache = ZFSObjectCache(ttl=30)
+    cache.invalidate('tank/a')
+
+    cache.begin_reload()
+    cache.invalidate('tank/b')
+    cache.load([{'name': 'tank/a'}, {'name': 'tank/b'}])
+
+    assert cache.stale == {'tank/b'}
+
+    cache.begin_reload()
+    cache.invalidate()
+    cache.load([{'name': 'tank/a'}])
+
+    assert cache.needs_reload()
+
+
+def test__zfs_object_cache__too_many_stale():
+    cache = ZFSObjectCache(ttl=30, max_stale=2)
+    cache.load([])
+
+    for name in ('tank/a', 'tank/b', 'tank/c'):
+        cache.invalidate(name)
+
+    assert cache.needs_reload()
+
+
+@pytest.mark.asyncio
+async def test__zfs_cache_service__invalidate_pool():
+    service = ZFSCacheService(Middleware())
+    for type in ('POOL', 'DATASET', 'SNAPSHOT'):
+        service.caches[type].load([{'name': 'tank'}, {'name': 'tank/a'}, {'name': 'tank/a@1'}, {'name': 'tankb'}])
+
+    await service.invalidate_pool('tank')
+
+    assert service.caches['POOL'].stale == {'tank'}
+    assert service.caches['DATASET'].stale == {'tank', 'tank/a', 'tank/a@1'}
+    assert service.caches['SNAPSHOT'].stale == {'tank/a', 'tank/a@1'}
+    assert (await service.stats())['DATASET']['stale'] == 3
+
+
+@pytest.mark.asyncio
+async def test__zfs_cache_service__import_pool():
+    datasets = [{'id': 'tank', 'name': 'tank'}]
+    middleware = Middleware()
+    middleware['zfs.dataset.query'] = middleware._query_filter(datasets)
+    service = zfs_cache_service(middleware)
+    assert await service.query('DATASET', [['id', '=', 'tank']], None) == [{'id': 'tank', 'name': 'tank'}]
+
+    datasets.extend([{'id': 'new', 'name': 'new'}, {'id': 'new/a', 'name': 'new/a'}])
+    await service.invalidate_new_pool('new')
+
+    assert await service.query('DATASET', [['id', '=', 'new/a']], None) == [{'id': 'new/a', 'name': 'new/a'}]
+
+
+@pytest.mark.asyncio
+async def test__zfs_cache_service__child_changed_under_cached_parent():
+    def dataset(name, quota, children=()):
+        return {'id': name, 'name': name, 'properties': {'quota': quota}, 'children': list(children)}
+
+    datasets = {
+        'tank': dataset('tank', 0, [dataset('tank/a', 0, [dataset('tank/a/b', 0)])]),
+        'tank/a': dataset('tank/a', 0, [dataset('tank/a/b', 0)]),
+        'tank/a/b': dataset('tank/a/b', 0),
+    }
+    middleware = Middleware()
+    middleware['zfs.dataset.query'] = Mock(side_effect=lambda filters=None: [
+        datasets[name] for name in (filters[0][2] if filters else datasets)
+    ])
+    middleware['zfs.pool.query'] = Mock(return_value=[])
+    service = zfs_cache_service(middleware)
+    await service.query('DATASET', [], None)
+
+    datasets['tank/a/b'] = dataset('tank/a/b', 1)
+    datasets['tank/a'] = dataset('tank/a', 0, [datasets['tank/a/b']])
+    datasets['tank'] = dataset('tank', 0, [datasets['tank/a']])
+    await service.invalidate('DATASET', 'tank/a/b', {'recursive': False})
+
+    tank = (await service.query('DATASET', [['id', '=', 'tank']], None))[0]
+    assert tank['children'][0]['children'][0]['properties']['quota'] == 1
+    assert service.caches['POOL'].stale == {'tank'}
+
+
+@pytest.mark.asyncio
+async def test__zfs_cache_service__refresh_failure():
+    middleware = Middleware()
+    middleware['zfs.snapshot.query'] = Mock(side_effect=[
+        [{'name': 'tank/a@1'}, {'name': 'tank/a@2'}],
+        CallError('Failed to run zfs get'),
+        [{'name': 'tank/a@1', 'used': 1}],
+    ])
+    service = zfs_cache_service(middleware)
+    await service.query('SNAPSHOT', [], None)
+
+    await service.invalidate('SNAPSHOT', 'tank/a', {'recursive': True})
+    assert service.caches['SNAPSHOT'].stale == {'tank/a@1', 'tank/a@2'}
+
+    with pytest.raises(CallError):
+        await service.query('SNAPSHOT', [], None)
+    assert service.caches['SNAPSHOT'].stale == {'tank/a@1', 'tank/a@2'}
+
+    assert await service.query('SNAPSHOT', [], None) == [{'name': 'tank/a@1', 'used': 1}]
+    filters = middleware['zfs.snapshot.query'].call_args[0][0]
+    assert filters[0][:2] == ['id', 'in'] and sorted(filters[0][2]) == ['tank/a@1', 'tank/a@2']
+
+
+@pytest.mark.parametrize('filters,options,properties', [
+    ([], None, None),
+    ([], {'select': []}, None),
+    ([], {'select': ['name', 'type']}, set()),
+    ([['pool', '=', 'tank']], {'select': ['name', 'properties']}, None),
+    ([['properties.used.rawvalue', '>', '0']], {'select': ['name']}, {'used'}),
+    ([['properties.used.parsed', '>', 0]], {'select': ['name']}, None),
+    ([], {'select': ['name', 'properties'], 'extra': {'properties': ['used', 'available']}}, {'used', 'available'}),
+    ([], {'extra': {'properties': ['used']}}, {'used'}),
+])
+def test__zfs_query_properties(filters, options, properties):
+    assert zfs_query_properties(filters, options, {'id', 'name', 'pool', 'type'}) == properties
+
+
+def test__zfs_get_lines__large_stderr():
+    # More stderr than a pipe holds before stdout is closed
+    cmd = ['sh', '-c', 'i=0; while [ $i -lt 10000 ]; do echo "warning $i" >&2; i=$((i+1)); done; echo tank']
+
+    assert list(zfs_get_lines(cmd)) == [['tank']]
+
+
+@pytest.mark.parametrize("stderr,missing_ok,error", [
+    ("echo \"cannot open 'tank/b': dataset does not exist\" >&2", False, True),
+    ("echo \"cannot open 'tank/b': dataset does not exist\" >&2", True, False),
+    ("echo \"cannot open 'tank/b': permission denied\" >&2", True, True),
+    ("true", True, True),
+])
+def test__zfs_get_lines__errors(stderr, missing_ok, error):
+    lines = zfs_get_lines(['sh', '-c', f'echo tank/a; {stderr}; exit 1'], missing_ok=missing_ok)
+
+    if error:
+        with pytest.raises(CallError):
+            list(lines)
+    else:
+        assert list(lines) == [['tank/a']]
+
+
+def test__zfs_dataset_service__query_id_in():
+    class ZFSException(Exception):
+        pass
+
+    def get_dataset(name):
+        if name != 'tank/a':
+            raise ZFSException(name)
+        return FakeZFSObject(name)
+
+    zfs = Mock()
+    zfs.get_dataset.side_effect = get_dataset
+    libzfs = Mock(ZFSException=ZFSException, ZFS=Mock(return_value=MagicMock(__enter__=Mock(return_value=zfs))))
+    service = resolve_query_schemas(ZFSDatasetService(Middleware()))
+
+    with patch('middlewared.plugins.zfs.libzfs', libzfs):
+        assert service.query([['id', 'in', ['tank/a', 'tank/b']]], None) == [{'id': 'tank/a', 'name': 'tank/a'}]
+
+    # Does not enumerate every dataset
+    assert sorted(call[0][0] for call in zfs.get_dataset.call_args_list) == ['tank/a', 'tank/b']
+
+
+def test__zfs_list_properties():
+    output = [
+        ['tank', 'type', 'filesystem', '-'],
+        ['tank', 'used', '1610612736', '-'],
+        ['tank', 'volsize', '-', '-'],
+        ['tank/vol', 'type', 'volume', '-'],
+        ['tank/vol', 'used', '10737418240', '-'],
+        ['tank/vol', 'volsize', '10737418240', 'local'],
+    ]
+    zfs_get_lines = Mock(return_value=iter(output))
+
+    with patch('middlewared.plugins.zfs.zfs_get_lines', zfs_get_lines):
+        datasets = zfs_list_properties('filesystem,volume', ['used', 'volsize'])
+
+    # A single pass
+    zfs_get_lines.assert_called_once_with(
+        ['zfs', 'get', '-H', '-p', '-o', 'name,property,value,source', '-t', 'filesystem,volume', 'type,used,volsize'],
+        missing_ok=False,
+    )
+    assert datasets == [
+        {
+            'id': 'tank', 'name': 'tank', 'pool': 'tank', 'type': 'FILESYSTEM',
+            'properties': {
+                'used': {'value': '1610612736', 'rawvalue': '1610612736', 'source': 'NONE'},
+            },
+        },
+        {
+            'id': 'tank/vol', 'name': 'tank/vol', 'pool': 'tank', 'type': 'VOLUME',
+            'properties': {
+                'used': {'value': '10737418240', 'rawvalue': '10737418240', 'source': 'NONE'},
+                'volsize': {'value': '10737418240', 'rawvalue': '10737418240', 'source': 'LOCAL'},
+            },
+        },
+    ]
+
+
+@pytest.mark.parametrize('service,options', [
+    (ZFSDatasetService, {'select': ['name', 'properties.used']}),
+    (ZFSDatasetService, {'extra': {'properties': ['used']}}),
+    (ZFSDatasetService, None),
+    (ZFSSnapshot, {'select': ['name', 'properties.used']}),
+    (ZFSSnapshot, None),
+])
+def test__zfs_query__id_in_empty(service, options):
+    zfs_get_lines = Mock()
+    # Does not enumerate every dataset/snapshot
+    zfs = Mock(spec=['get_dataset', 'get_snapshot'])
+    libzfs = Mock(ZFS=Mock(return_value=MagicMock(__enter__=Mock(return_value=zfs))))
+    service = resolve_query_schemas(service(Middleware()))
+
+    with patch('middlewared.plugins.zfs.zfs_get_lines', zfs_get_lines), patch('middlewared.plugins.zfs.libzfs', libzfs):
+        assert service.query([['id', 'in', []]], options) == []
+
+    zfs_get_lines.assert_not_called()
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from middlewared.event import EncodedEvent
+
+
+def test__encoded_event_message():
+    event = EncodedEvent('core.get_jobs', 'CHANGED', {'id': 1, 'fields': {'state': 'RUNNING'}, 'cleared': ['error']})
+
+    assert json.loads(event.message) == {
+        'msg': 'changed',
+        'collection': 'core.get_jobs',
+        'id': 1,
+        'fields': {'state': 'RUNNING'},
+        'cleared': ['error'],
+    }
+    assert event.key == ('core.get_jobs', 1)
+
+
+@pytest.mark.parametrize('event_type,kwargs,replaces', [
+    ('CHANGED', {'id': 1, 'fields': {'state': 'RUNNING', 'progress': 50}}, True),
+    ('CHANGED', {'id': 1, 'fields': {'progress': 50}}, False),
+    ('CHANGED', {'id': 1, 'fields': {'state': 'RUNNING'}, 'cleared': ['error']}, False),
+    ('REMOVED', {'id': 1}, False),
+])
+def test__encoded_event_replaces(event_type, kwargs, replaces):
+    queued = EncodedEvent('core.get_jobs', 'CHANGED', {'id': 1, 'fields': {'state': 'WAITING'}})
+
+    assert EncodedEvent('core.get_jobs', event_type, kwargs).replaces(queued) is replaces
@@ -0,0 +1,233 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.job import JOBS_LEDGER_RECORD_MAXLEN, JobsDeque, JobsLedger, JobsQueue
+
+
+def record(id, method='pool.scrub', state='SUCCESS', **kwargs):
+    return dict({
+        'id': id,
+        'method': method,
+        'arguments': [],
+        'logs_path': None,
+        'logs_excerpt': None,
+        'progress': {'percent': 100, 'description': None, 'extra': None},
+        'result': None,
+        'error': None,
+        'exception': None,
+        'exc_info': None,
+        'state': state,
+        'time_started': datetime(2018, 1, 1) + timedelta(seconds=id),
+        'time_finished': datetime(2018, 1, 1) + timedelta(seconds=id + 60),
+    }, **kwargs)
+
+
+def mock_job():
+    job = Mock()
+    job.set_id.side_effect = lambda id: setattr(job, 'id', id)
+    return job
+
+
+def test__jobs_deque__evicts_finished_in_order():
+    jobs = JobsDeque(finished_maxlen=1)
+    added = []
+    for i in range(3):
+        job = mock_job()
+        jobs.add(job)
+        added.append(job)
+
+    jobs.finish(2)
+    assert list(jobs.all()) == [1, 2, 3]
+    jobs.finish(1)
+
+    assert list(jobs.all()) == [1, 3]
+    added[1].cleanup.assert_called_once_with()
+
+
+def test__jobs_deque__keeps_running_jobs():
+    jobs = JobsDeque(finished_maxlen=0)
+    for i in range(5):
+        jobs.add(mock_job())
+
+    jobs.finish(3)
+
+    assert list(jobs.all()) == [1, 2, 4, 5]
+
+
+def test__jobs_deque__skips_removed_jobs():
+    jobs = JobsDeque(finished_maxlen=1, count=10)
+    for i in range(3):
+        jobs.add(mock_job())
+
+    jobs.finish(11)
+    jobs.remove(11)
+    jobs.finish(12)
+    jobs.finish(13)
+
+    assert list(jobs.all()) == [13]
+
+
+def test__jobs_ledger__persists(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    ledger = JobsLedger(path)
+    ledger.add(record(1, result={'time': datetime(2018, 1, 1, tzinfo=timezone.utc)}))
+    ledger.add(record(2))
+
+    ledger = JobsLedger(path)
+    assert ledger.last_id() == 2
+    assert ledger.query() == [
+        record(1, result={'time': datetime(2018, 1, 1, tzinfo=timezone.utc)}),
+        record(2),
+    ]
+
+
+def test__jobs_ledger__filters():
+    ledger = JobsLedger(':memory:')
+    ledger.add(record(1, method='pool.scrub'))
+    ledger.add(record(2, method='cloudsync.sync', state='FAILED'))
+    ledger.add(record(3, method='cloudsync.sync'))
+
+    assert [i['id'] for i in ledger.query([('method', '=', 'cloudsync.sync')])] == [2, 3]
+    assert [i['id'] for i in ledger.query([('state', 'in', ['FAILED', 'ABORTED'])])] == [2]
+    assert [i['id'] for i in ledger.query([('time_started', '>', datetime(2018, 1, 1, 0, 0, 1))])] == [2, 3]
+    assert [i['id'] for i in ledger.query([], desc=True, limit=2)] == [3, 2]
+    # Filters that can not be run in SQL are left to the caller, limit too
+    assert [i['id'] for i in ledger.query([('error', '=', None)], limit=1)] == [1, 2, 3]
+
+
+def test__jobs_ledger__prunes():
+    ledger = JobsLedger(':memory:', maxlen=50)
+    for i in range(1, 201):
+        ledger.add(record(i))
+
+    assert [i['id'] for i in ledger.query([('id', '<=', 151)])] == [151]
+
+
+def test__jobs_ledger__slim_record():
+    ledger = JobsLedger(':memory:')
+    ledger.add(record(1, logs_path='/tmp/middlewared/jobs/1.log', result='x' * JOBS_LEDGER_RECORD_MAXLEN))
+
+    data = ledger.conn.execute('SELECT record FROM jobs').fetchone()[0]
+    assert 'time_started' not in data and 'logs_path' not in data
+    assert ledger.query() == [record(1)]
+
+
+def test__jobs_queue__query_default_limit():
+    queue = JobsQueue(Mock(), ledger_path=':memory:')
+    for i in range(1, 6):
+        queue.ledger.add(record(i))
+
+    with patch('middlewared.job.JOBS_QUERY_DEFAULT_LIMIT', 2):
+        assert [i['id'] for i in queue.query()] == [4, 5]
+        assert [i['id'] for i in queue.query([('method', '=', 'pool.scrub')])] == [1, 2, 3, 4, 5]
+
+
+class FakeJob:
+    def __init__(self, method_name, lock=None, **options):
+        self.method_name = method_name
+        self.lock_name = lock
+        self.options = dict({'lock_queue_size': None, 'transient': True}, **options)
+        self.lock = None
+
+    def set_id(self, id):
+        self.id = id
+
+    def get_lock_name(self):
+        return self.lock_name
+
+    def get_lock(self):
+        return self.lock
+
+    async def set_lock(self, lock):
+        self.lock = lock
+        await lock.acquire()
+
+    def cleanup(self):
+        pass
+
+
+def jobs_queue():
+    return JobsQueue(Mock(), ledger_path=':memory:')
+
+
+async def next_jobs(queue):
+    jobs = []
+    while queue.queue_event.is_set():
+        try:
+            jobs.append(await asyncio.wait_for(queue.__next__(), 0.1))
+        except asyncio.TimeoutError:
+            break
+    return jobs
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__lock_fifo():
+    queue = jobs_queue()
+    a1, a2, b1 = FakeJob('a', lock='x'), FakeJob('a', lock='x'), FakeJob('b')
+    for job in (a1, a2, b1):
+        queue.add(job)
+
+    assert await next_jobs(queue) == [a1, b1]
+    assert queue.stats()['locks'] == {'x': {'queued': 1, 'locked': True}}
+
+    queue.release_lock(a1)
+    assert await next_jobs(queue) == [a2]
+
+    queue.release_lock(a2)
+    assert queue.job_locks == {}
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__lock_queue_size():
+    queue = jobs_queue()
+    a1 = queue.add(FakeJob('a', lock='x', lock_queue_size=1))
+
+    assert queue.add(FakeJob('a', lock='x', lock_queue_size=1)) is a1
+
+    # Running jobs do not count
+    assert await next_jobs(queue) == [a1]
+    a2 = FakeJob('a', lock='x', lock_queue_size=1)
+    assert queue.add(a2) is a2
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__lock_queue_size_new_lock():
+    queue = jobs_queue()
+    a1 = FakeJob('a', lock='x', lock_queue_size=0)
+
+    # No job is waiting for the lock yet
+    assert queue.add(a1) is a1
+    assert await next_jobs(queue) == [a1]
+    a2 = FakeJob('a', lock='x', lock_queue_size=0)
+    assert queue.add(a2) is a2
+
+    queue.release_lock(a1)
+    assert await next_jobs(queue) == [a2]
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__priority():
+    queue = jobs_queue()
+    low, high = FakeJob('a'), FakeJob('b', priority=10)
+    queue.add(low)
+    queue.add(high)
+
+    assert await next_jobs(queue) == [high, low]
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__max_concurrency():
+    queue = jobs_queue()
+    a1, a2, b1 = FakeJob('a', max_concurrency=1), FakeJob('a', max_concurrency=1), FakeJob('b')
+    for job in (a1, a2, b1):
+        queue.add(job)
+
+    assert await next_jobs(queue) == [a1, b1]
+    stats = queue.stats()['methods']['a']
+    assert (stats['queued'], stats['running'], stats['dispatched']) == (1, 1, 1)
+
+    queue.release_lock(a1)
+    assert await next_jobs(queue) == [a2]
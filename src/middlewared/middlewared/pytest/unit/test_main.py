@@ -0,0 +1,248 @@
+import asyncio
+from collections import defaultdict
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+import pytest
+
+from middlewared.event import EncodedEvent
+from middlewared import main
+from middlewared.main import Application, FileApplication, ShellWorker
+from middlewared.pytest.unit.middleware import Middleware
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+
+    async def send_str(self, data):
+        self.messages.append(json.loads(data))
+
+
+def wsclients_middleware():
+    """
+    Middleware with only what keeps track of the websocket clients and their subscriptions.
+    """
+    middleware = main.Middleware.__new__(main.Middleware)
+    middleware._Middleware__wsclients = {}
+    middleware._Middleware__wsclients_subscriptions = defaultdict(set)
+    middleware.get_event_source = lambda name: None
+    return middleware
+
+
+class FakeShellResponse:
+    def __init__(self):
+        self.messages = []
+
+    async def send_str(self, data):
+        self.messages.append(data)
+
+    async def close(self):
+        pass
+
+
+async def download_file(headers):
+    """
+    Serve a 10 bytes file, returning the response and the calls that put it on the wire.
+    """
+    app = FileApplication(Middleware(), asyncio.get_event_loop())
+    calls = []
+
+    async def drain(resp):
+        calls.append('headers')
+
+    async def sendfile(request, resp, f, offset, count):
+        calls.append((offset, count))
+
+    with tempfile.TemporaryFile() as f:
+        f.write(b'0123456789')
+        f.flush()
+        with patch.object(web.StreamResponse, 'drain', drain), patch.object(app, '_sendfile', sendfile):
+            resp = await app._download_file(make_mocked_request('GET', '/_download/1', headers), 1, f, 'file')
+
+    return resp, calls
+
+
+@pytest.mark.asyncio
+async def test__application_stream_result__window():
+    app = Application(Middleware(), asyncio.get_event_loop(), None, FakeResponse())
+
+    with patch('middlewared.main.QUERY_STREAM_CHUNK_SIZE', 2):
+        task = asyncio.ensure_future(app._stream_result({'id': 'call'}, iter(range(9)), 2))
+        await asyncio.sleep(0.01)
+        assert [m['result'] for m in app.response.messages] == [[0, 1], [2, 3]]
+
+        app._stream_ack({'msg': 'stream_ack', 'id': 'call', 'chunks': 1})
+        await asyncio.sleep(0.01)
+        assert len(app.response.messages) == 3
+
+        app._stream_ack({'msg': 'stream_ack', 'id': 'call', 'chunks': 2})
+        assert await asyncio.wait_for(task, 1) == 9
+
+    assert [m['result'] for m in app.response.messages] == [[0, 1], [2, 3], [4, 5], [6, 7], [8]]
+
+
+@pytest.mark.asyncio
+async def test__application_stream_result__cancel():
+    app = Application(Middleware(), asyncio.get_event_loop(), None, FakeResponse())
+
+    with patch('middlewared.main.QUERY_STREAM_CHUNK_SIZE', 2):
+        task = asyncio.ensure_future(app._stream_result({'id': 'call'}, iter(range(9)), 1))
+        await asyncio.sleep(0.01)
+        app._stream_ack({'msg': 'stream_ack', 'id': 'call', 'cancel': True})
+
+        assert await asyncio.wait_for(task, 1) == 2
+
+    assert len(app.response.messages) == 1
+
+
+@pytest.mark.asyncio
+async def test__shell_worker_relay__character_split_across_reads():
+    worker = ShellWorker(Middleware(), FakeShellResponse(), asyncio.get_event_loop())
+    read_fd, worker.master_fd = os.pipe()
+    os.close(read_fd)
+    # "é" is 0xc3 0xa9 in UTF-8
+    reads = iter([b'caf\xc3', b'\xa9!', b''])
+
+    async def read():
+        return next(reads)
+
+    with patch.object(worker, 'read', read):
+        await worker.relay()
+
+    assert ''.join(worker.ws.messages) == 'café!'
+    assert worker.ws.messages == ['caf', '\xe9!']
+
+
+@pytest.mark.asyncio
+async def test__application_queue_event__coalesces_in_order():
+    app = Application(Middleware(), asyncio.get_event_loop(), None, FakeResponse())
+
+    app._queue_event(EncodedEvent('pool.query', 'CHANGED', {'id': 1, 'fields': {'name': 'a'}}))
+    app._queue_event(EncodedEvent('pool.query', 'ADDED', {'id': 2, 'fields': {'name': 'b'}}))
+    # Replaces the queued event of the same id setting less fields
+    app._queue_event(EncodedEvent('pool.query', 'CHANGED', {'id': 1, 'fields': {'name': 'c', 'status': 'ONLINE'}}))
+    app._queue_event(EncodedEvent('pool.query', 'CHANGED', {'id': 1, 'fields': {'status': 'DEGRADED'}}))
+    app._queue_event(EncodedEvent('pool.query', 'REMOVED', {'id': 2}))
+    await asyncio.sleep(0.01)
+
+    assert [(m['msg'], m['id'], m.get('fields')) for m in app.response.messages] == [
+        ('changed', 1, {'name': 'c', 'status': 'ONLINE'}),
+        ('added', 2, {'name': 'b'}),
+        ('changed', 1, {'status': 'DEGRADED'}),
+        ('removed', 2, None),
+    ]
+
+
+@pytest.mark.asyncio
+async def test__application_queue_event__drops_oldest_keyless():
+    app = Application(Middleware(), asyncio.get_event_loop(), None, FakeResponse())
+
+    with patch('middlewared.main.EVENTS_QUEUE_KEYLESS_MAXLEN', 2):
+        for i in range(4):
+            app._queue_event(EncodedEvent('alert.list', 'ADDED', {'fields': {'i': i}}))
+        app._queue_event(EncodedEvent('pool.query', 'CHANGED', {'id': 1, 'fields': {'name': 'a'}}))
+        await asyncio.sleep(0.01)
+
+        assert [m.get('id', m['fields']) for m in app.response.messages] == [{'i': 2}, {'i': 3}, 1]
+
+        # Keyless events sent are not counted anymore
+        for i in range(2):
+            app._queue_event(EncodedEvent('alert.list', 'ADDED', {'fields': {'i': i}}))
+        await asyncio.sleep(0.01)
+
+        assert len(app.response.messages) == 5
+
+
+@pytest.mark.asyncio
+async def test__application_subscriptions__refcount():
+    middleware = wsclients_middleware()
+    subscriptions = middleware._Middleware__wsclients_subscriptions
+    app = Application(middleware, asyncio.get_event_loop(), None, FakeResponse())
+    app.on_open()
+
+    await app.subscribe('1', 'pool.query')
+    await app.subscribe('2', 'pool.query')
+    await app.subscribe('3', '*')
+    assert subscriptions == {'pool.query': {app}, '*': {app}}
+
+    await app.unsubscribe('1')
+    assert subscriptions == {'pool.query': {app}, '*': {app}}
+    await app.unsubscribe('2')
+    assert subscriptions == {'*': {app}}
+
+    # Subscribing an id again replaces its subscription
+    await app.subscribe('3', 'disk.query')
+    assert subscriptions == {'disk.query': {app}}
+
+
+@pytest.mark.asyncio
+async def test__application_on_close__unsubscribes():
+    middleware = wsclients_middleware()
+    subscriptions = middleware._Middleware__wsclients_subscriptions
+    app = Application(middleware, asyncio.get_event_loop(), None, FakeResponse())
+    other = Application(middleware, asyncio.get_event_loop(), None, FakeResponse())
+    app.on_open()
+    other.on_open()
+
+    await app.subscribe('1', 'pool.query')
+    await app.subscribe('2', 'disk.query')
+    await other.subscribe('1', 'pool.query')
+
+    await app.on_close()
+
+    assert subscriptions == {'pool.query': {other}}
+    assert middleware._Middleware__wsclients == {other.session_id: other}
+
+
+@pytest.mark.asyncio
+async def test__file_application_download_file__whole_file():
+    resp, calls = await download_file({})
+
+    assert resp.status == 200
+    assert resp.content_length == 10
+    assert 'Content-Range' not in resp.headers
+    assert calls == ['headers', (0, 10)]
+
+
+@pytest.mark.asyncio
+async def test__file_application_download_file__range():
+    resp, calls = await download_file({'Range': 'bytes=2-5'})
+
+    assert resp.status == 206
+    assert resp.content_length == 4
+    assert resp.headers['Content-Range'] == 'bytes 2-5/10'
+    assert calls == ['headers', (2, 4)]
+
+
+@pytest.mark.asyncio
+async def test__file_application_download_file__open_range():
+    resp, calls = await download_file({'Range': 'bytes=7-'})
+
+    assert resp.status == 206
+    assert resp.headers['Content-Range'] == 'bytes 7-9/10'
+    assert calls == ['headers', (7, 3)]
+
+
+@pytest.mark.asyncio
+async def test__file_application_download_file__suffix_range():
+    resp, calls = await download_file({'Range': 'bytes=-3'})
+
+    assert resp.status == 206
+    assert resp.content_length == 3
+    assert resp.headers['Content-Range'] == 'bytes 7-9/10'
+    assert calls == ['headers', (7, 3)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('range', ['bytes=10-', 'bytes=20-30', 'bytes=5-2', 'lines=1-2'])
+async def test__file_application_download_file__unsatisfiable_range(range):
+    resp, calls = await download_file({'Range': range})
+
+    assert resp.status == 416
+    assert resp.headers['Content-Range'] == 'bytes */10'
+    assert calls == []
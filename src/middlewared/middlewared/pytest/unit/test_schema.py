@@ -4,7 +4,8 @@ from mock import Mock
 from middlewared.service import job
 from middlewared.service_exception import ValidationErrors
 from middlewared.schema import (
-    accepts, Bool, Cron, Dict, Dir, Error, File, Float, Int, IPAddr, List, Str, UnixPerm,
+    accepts, Bool, Cron, Dict, Dir, Error, File, Float, Int, IPAddr, List, Patch, Ref, Str, UnixPerm,
+    schema_names,
 )
 
 
@@ -570,3 +571,15 @@ def test__schema_str_job_default():
     jobm = Mock()
 
     assert strdef(self, jobm, 'foo') == 'BAR'
+
+
+def test__schema_names():
+
+    registered, referenced = schema_names([
+        Dict('foo', List('bar', items=[Ref('baz')]), register=True),
+        Patch('qux', 'qux-new', ('add', Dict('quux', Ref('corge'))), register=True),
+        Str('grault'),
+    ])
+
+    assert registered == {'foo', 'qux-new'}
+    assert referenced == {'baz', 'qux', 'corge'}
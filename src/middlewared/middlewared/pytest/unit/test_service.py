@@ -0,0 +1,41 @@
+from middlewared.service import CRUDService
+from middlewared.pytest.unit.middleware import Middleware
+
+
+class ExtendedService(CRUDService):
+
+    class Config:
+        datastore = 'test.extended'
+        datastore_extend = 'extended.extend'
+        datastore_raw_fields = ['id', 'name']
+
+
+def test__crud_service__split_raw_filters():
+    raw, post = ExtendedService(Middleware())._split_raw_filters([
+        ['id', '=', 1],
+        ['name', 'in', ['foo', 'bar']],
+        ['type', '=', 'FILE'],
+        ['name', '~', '^foo'],
+    ])
+    assert raw == [['id', '=', 1], ['name', 'in', ['foo', 'bar']]]
+    assert post == [['type', '=', 'FILE'], ['name', '~', '^foo']]
+
+
+def test__crud_service__split_raw_filters_or():
+    raw, post = ExtendedService(Middleware())._split_raw_filters([
+        ['OR', [['id', '=', 1], ['name', '=', 'foo']]],
+        ['OR', [['id', '=', 1], ['type', '=', 'FILE']]],
+    ])
+    assert raw == [['OR', [['id', '=', 1], ['name', '=', 'foo']]]]
+    assert post == [['OR', [['id', '=', 1], ['type', '=', 'FILE']]]]
+
+
+def test__crud_service__split_raw_filters_default_id():
+    class Service(CRUDService):
+        class Config:
+            datastore = 'test.default'
+            datastore_extend = 'default.extend'
+
+    raw, post = Service(Middleware())._split_raw_filters([['id', '=', 1], ['name', '=', 'foo']])
+    assert raw == [['id', '=', 1]]
+    assert post == [['name', '=', 'foo']]
@@ -0,0 +1,115 @@
+from unittest.mock import Mock, patch
+
+from freenasUI.freeadmin.sqlite3_ha.base import DatabaseWrapper, FailoverStatus, replicated_statements
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+def failover_status(*results):
+    status = FailoverStatus(5, retry=0.5)
+    status.query = Mock(side_effect=list(results))
+    return status
+
+
+def test__failover_status__cached_for_ttl():
+    clock = Clock()
+    status = failover_status(('BACKUP', 5), ('MASTER', 5), ('MASTER', 5))
+
+    with patch('freenasUI.freeadmin.sqlite3_ha.base.time', clock):
+        assert status.get() == 'BACKUP'
+        clock.now += 4
+        assert status.get() == 'BACKUP'
+        assert status.query.call_count == 1
+
+        clock.now += 1
+        assert status.get() == 'MASTER'
+        assert status.query.call_count == 2
+
+        # Failover event
+        status.invalidate()
+        assert status.get() == 'MASTER'
+        assert status.query.call_count == 3
+
+
+def test__failover_status__failure_retries_rate_limited():
+    clock = Clock()
+    error = RuntimeError('middlewared is not running')
+    status = failover_status(error, error, error, ('MASTER', 5))
+
+    with patch('freenasUI.freeadmin.sqlite3_ha.base.time', clock):
+        assert status.get() is None
+        assert status.failed
+        clock.now += 0.4
+        assert status.get() is None
+        assert status.query.call_count == 1
+
+        clock.now += 0.1
+        assert status.get() is None
+        # Retry delay doubled
+        clock.now += 0.9
+        assert status.get() is None
+        assert status.query.call_count == 2
+
+        clock.now += 0.1
+        assert status.get() is None
+        clock.now += 2
+        assert status.get() == 'MASTER'
+        assert not status.failed
+        assert status.query.call_count == 4
+
+
+def test__failover_status__failure_keeps_last_known_status():
+    clock = Clock()
+    status = failover_status(('MASTER', 5), RuntimeError(), ('BACKUP', 5))
+
+    with patch('freenasUI.freeadmin.sqlite3_ha.base.time', clock):
+        assert status.get() == 'MASTER'
+        clock.now += 5
+        assert status.get() == 'MASTER'
+        assert not status.failed
+        clock.now += 0.5
+        assert status.get() == 'BACKUP'
+
+
+def test__replicated_statements():
+    assert replicated_statements('SELECT * FROM system_failover') == ()
+    assert replicated_statements('INSERT INTO system_failover VALUES (%s)') == ()
+    assert replicated_statements('DELETE FROM system_failover WHERE id = %s') == ()
+
+    query = 'UPDATE "system_settings" SET "stg_guiport" = %s WHERE "id" = %s'
+    assert replicated_statements(query) == (
+        ('UPDATE "system_settings" SET "stg_guiport" = ? WHERE "id" = ?', ()),
+    )
+    # Rules depend on the query only and are computed once
+    hits = replicated_statements.cache_info().hits
+    replicated_statements(query)
+    assert replicated_statements.cache_info().hits == hits + 1
+
+
+def test__ha_savepoint():
+    db = DatabaseWrapper.__new__(DatabaseWrapper)
+    db.ha_queries = [('q1', [])]
+    db.ha_journal = []
+    db.ha_savepoints = {}
+
+    db.ha_savepoint('SAVEPOINT "s1"')
+    db.ha_queries.append(('q2', []))
+    db.ha_savepoint('SAVEPOINT "s2"')
+    db.ha_queries.append(('q3', []))
+    db.ha_journal.append(('j1', []))
+
+    db.ha_savepoint('ROLLBACK TO SAVEPOINT "s2"')
+    assert db.ha_queries == [('q1', []), ('q2', [])]
+    assert db.ha_journal == []
+
+    db.ha_savepoint('RELEASE SAVEPOINT "s2"')
+    assert '"s2"' not in db.ha_savepoints
+
+    db.ha_savepoint('ROLLBACK TO SAVEPOINT "s1"')
+    assert db.ha_queries == [('q1', [])]
@@ -0,0 +1,60 @@
+import re
+
+from freenasUI.tools.webshell import Terminal
+
+
+def dumped(dump):
+    """
+    Header flags and `{line number: html}` of a `Terminal.dump`.
+    """
+    header = re.match(r'<c cy="(\d+)" f="(\d)" />', dump)
+    lines = {int(line[:3]): line[3:] for line in dump[header.end():].split('\n') if line}
+    return int(header.group(1)), header.group(2) == '1', lines
+
+
+def text(html):
+    return re.sub('<[^>]+>', '', html).rstrip()
+
+
+def test__terminal_dump__full_then_changed_lines():
+    term = Terminal(20, 4)
+
+    cy, full, lines = dumped(term.dump())
+    assert (cy, full, sorted(lines)) == (0, True, [0, 1, 2, 3])
+
+    term.write(b'\x1b[3;1Hhello')
+    cy, full, lines = dumped(term.dump())
+    # Cursor moved from the first line to the third one
+    assert (cy, full, sorted(lines)) == (2, False, [0, 2])
+    assert text(lines[2]) == 'hello'
+
+    assert term.dump() == ''
+
+
+def test__terminal_dump__unchanged_line_not_sent():
+    term = Terminal(20, 4)
+    term.write(b'\x1b[2;1Hsame\x1b[4;1H')
+    term.dump()
+
+    # Line 2 is dirty but renders the same
+    term.write(b'\x1b[2;1Hsame\x1b[4;1H')
+    assert term.dump() == ''
+
+
+def test__terminal_dump__full():
+    term = Terminal(20, 4)
+    term.write(b'hello')
+    term.dump()
+
+    cy, full, lines = dumped(term.dump(full=True))
+    assert (full, sorted(lines)) == (True, [0, 1, 2, 3])
+    assert text(lines[0]) == 'hello'
+
+
+def test__terminal_dump__resize_is_full():
+    term = Terminal(20, 4)
+    term.dump()
+
+    term.set_size(20, 6)
+    cy, full, lines = dumped(term.dump())
+    assert (full, sorted(lines)) == (True, list(range(6)))
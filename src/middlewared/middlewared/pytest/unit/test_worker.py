@@ -0,0 +1,45 @@
+import threading
+
+from middlewared.worker import FakeJob, JobProgressSender
+
+
+def test__fake_job__coalesces_progress():
+    calls = []
+    sending = threading.Event()
+    release = threading.Event()
+
+    class Client:
+        def call(self, method, id, data):
+            calls.append((id, data['progress']))
+            sending.set()
+            release.wait(5)
+
+    sender = JobProgressSender(Client)
+    job = FakeJob(1, sender)
+    job.set_progress(10, 'Starting')
+    sending.wait(5)
+    job.set_progress(50)
+    job.set_progress(90, 'Almost done')
+    release.set()
+    job.flush()
+
+    assert calls == [
+        (1, {'percent': 10, 'description': 'Starting', 'extra': None}),
+        (1, {'percent': 90, 'description': 'Almost done', 'extra': None}),
+    ]
+
+
+def test__job_progress_sender__one_thread_for_every_job():
+    threads = set()
+
+    class Client:
+        def call(self, method, id, data):
+            threads.add(threading.current_thread())
+
+    sender = JobProgressSender(Client)
+    for id in range(3):
+        job = FakeJob(id, sender)
+        job.set_progress(50)
+        job.flush()
+
+    assert len(threads) == 1
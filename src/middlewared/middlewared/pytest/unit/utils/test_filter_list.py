@@ -1,3 +1,5 @@
+import pytest
+
 from middlewared.utils import filter_list
 
 
@@ -84,3 +86,46 @@ def test__filter_list_OR_eq2():
         ['number', '=', 1],
         ['number', '=', 2],
     ]]])) == 2
+
+
+def test__filter_list_order_by():
+    assert [i['number'] for i in filter_list(DATA, [], {'order_by': ['-number']})] == [3, 2, 1]
+
+
+def test__filter_list_order_by_multiple_keys():
+    data = [
+        {'a': 1, 'b': 1},
+        {'a': 0, 'b': 2},
+        {'a': 1, 'b': 3},
+    ]
+    assert filter_list(data, [], {'order_by': ['a', '-b']}) == [data[1], data[2], data[0]]
+
+
+def test__filter_list_limit_offset():
+    assert [i['number'] for i in filter_list(DATA, [], {'offset': 1, 'limit': 1})] == [2]
+
+
+def test__filter_list_order_by_limit():
+    assert [i['number'] for i in filter_list(DATA, [], {'order_by': ['-number'], 'limit': 2})] == [3, 2]
+
+
+def test__filter_list_get_order_by():
+    assert filter_list(DATA, [['number', '<', 3]], {'order_by': ['-number'], 'get': True})['number'] == 2
+
+
+def test__filter_list_get_empty():
+    with pytest.raises(IndexError):
+        filter_list(DATA, [['number', '>', 3]], {'get': True})
+
+
+def test__filter_list_count():
+    assert filter_list(DATA, [['foo', '^', 'foo']], {'count': True}) == 2
+
+
+def test__filter_list_select():
+    assert filter_list(DATA, [['number', '=', 1]], {'select': ['foo']}) == [{'foo': 'foo1'}]
+
+
+def test__filter_list_invalid_operation():
+    with pytest.raises(ValueError):
+        filter_list(DATA, [['number', '===', 1]])
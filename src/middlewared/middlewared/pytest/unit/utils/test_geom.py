@@ -0,0 +1,214 @@
+import textwrap
+
+import pytest
+
+from middlewared.utils.geom import GeomTopology
+
+# Trimmed down `sysctl -n kern.geom.confxml` of a system with a multipathed SAS disk and a GPT partitioned SATA disk
+CONFXML = textwrap.dedent("""\
+    <mesh>
+      <class id="0xffffffff81e3b5a0">
+        <name>MULTIPATH</name>
+        <geom id="0xfffff8000d2b6a00">
+          <class ref="0xffffffff81e3b5a0"/>
+          <name>disk1</name>
+          <rank>2</rank>
+          <config>
+            <Mode>Active/Passive</Mode>
+            <UUID>8b1c2a46-4b09-11e9-a9d4-0cc47a3a5bc2</UUID>
+            <State>OPTIMAL</State>
+          </config>
+          <consumer id="0xfffff8000d2b6780">
+            <geom ref="0xfffff8000d2b6a00"/>
+            <provider ref="0xfffff8000d2a1c00"/>
+            <mode>r0w0e0</mode>
+            <config>
+              <State>ACTIVE</State>
+            </config>
+          </consumer>
+          <consumer id="0xfffff8000d2b6700">
+            <geom ref="0xfffff8000d2b6a00"/>
+            <provider ref="0xfffff8000d2a1a00"/>
+            <mode>r0w0e0</mode>
+            <config>
+              <State>PASSIVE</State>
+            </config>
+          </consumer>
+          <provider id="0xfffff8000d2b6600">
+            <geom ref="0xfffff8000d2b6a00"/>
+            <mode>r0w0e0</mode>
+            <name>multipath/disk1</name>
+            <mediasize>4000787029504</mediasize>
+            <sectorsize>512</sectorsize>
+          </provider>
+        </geom>
+      </class>
+      <class id="0xffffffff81e3a1e0">
+        <name>DISK</name>
+        <geom id="0xfffff8000d2a1d00">
+          <class ref="0xffffffff81e3a1e0"/>
+          <name>da0</name>
+          <rank>1</rank>
+          <config>
+          </config>
+          <provider id="0xfffff8000d2a1c00">
+            <geom ref="0xfffff8000d2a1d00"/>
+            <mode>r1w1e2</mode>
+            <name>da0</name>
+            <mediasize>4000787030016</mediasize>
+            <sectorsize>512</sectorsize>
+            <config>
+              <fwheads>255</fwheads>
+              <fwsectors>63</fwsectors>
+              <rotationrate>7200</rotationrate>
+              <ident>ZC1234AB</ident>
+              <lunid>5000c500a1b2c3d4</lunid>
+              <descr>SEAGATE ST4000NM0025</descr>
+            </config>
+          </provider>
+        </geom>
+        <geom id="0xfffff8000d2a1b00">
+          <class ref="0xffffffff81e3a1e0"/>
+          <name>da1</name>
+          <rank>1</rank>
+          <config>
+          </config>
+          <provider id="0xfffff8000d2a1a00">
+            <geom ref="0xfffff8000d2a1b00"/>
+            <mode>r1w1e2</mode>
+            <name>da1</name>
+            <mediasize>4000787030016</mediasize>
+            <sectorsize>512</sectorsize>
+            <config>
+              <fwheads>255</fwheads>
+              <fwsectors>63</fwsectors>
+              <rotationrate>7200</rotationrate>
+              <ident>ZC1234AB</ident>
+              <lunid>5000c500a1b2c3d4</lunid>
+              <descr>SEAGATE ST4000NM0025</descr>
+            </config>
+          </provider>
+        </geom>
+        <geom id="0xfffff8000d2a1900">
+          <class ref="0xffffffff81e3a1e0"/>
+          <name>ada0</name>
+          <rank>1</rank>
+          <config>
+          </config>
+          <provider id="0xfffff8000d2a1800">
+            <geom ref="0xfffff8000d2a1900"/>
+            <mode>r2w2e5</mode>
+            <name>ada0</name>
+            <mediasize>240057409536</mediasize>
+            <sectorsize>512</sectorsize>
+            <config>
+              <fwheads>16</fwheads>
+              <fwsectors>63</fwsectors>
+              <rotationrate>0</rotationrate>
+              <ident>  S3Z1NB0K  </ident>
+              <descr>Samsung SSD 860 EVO 250GB</descr>
+            </config>
+          </provider>
+        </geom>
+      </class>
+      <class id="0xffffffff81e3d2c0">
+        <name>PART</name>
+        <geom id="0xfffff8000d2c1100">
+          <class ref="0xffffffff81e3d2c0"/>
+          <name>ada0</name>
+          <rank>2</rank>
+          <config>
+            <scheme>GPT</scheme>
+            <entries>128</entries>
+          </config>
+          <consumer id="0xfffff8000d2c1080">
+            <geom ref="0xfffff8000d2c1100"/>
+            <provider ref="0xfffff8000d2a1800"/>
+            <mode>r2w2e5</mode>
+          </consumer>
+          <provider id="0xfffff8000d2c1000">
+            <geom ref="0xfffff8000d2c1100"/>
+            <mode>r1w1e1</mode>
+            <name>ada0p1</name>
+            <mediasize>2147483648</mediasize>
+            <sectorsize>512</sectorsize>
+            <config>
+              <index>1</index>
+              <type>freebsd-swap</type>
+              <rawtype>516e7cb5-6ecf-11d6-8ff8-00022d09712b</rawtype>
+              <rawuuid>2d3b1c8e-4b09-11e9-a9d4-0cc47a3a5bc2</rawuuid>
+            </config>
+          </provider>
+          <provider id="0xfffff8000d2c0f00">
+            <geom ref="0xfffff8000d2c1100"/>
+            <mode>r1w1e2</mode>
+            <name>ada0p2</name>
+            <mediasize>237909884928</mediasize>
+            <sectorsize>512</sectorsize>
+            <config>
+              <index>2</index>
+              <type>freebsd-zfs</type>
+              <rawtype>516e7cba-6ecf-11d6-8ff8-00022d09712b</rawtype>
+              <rawuuid>2d4f8a66-4b09-11e9-a9d4-0cc47a3a5bc2</rawuuid>
+            </config>
+          </provider>
+        </geom>
+      </class>
+      <class id="0xffffffff81e3c3a0">
+        <name>LABEL</name>
+        <geom id="0xfffff8000d2c0d00">
+          <class ref="0xffffffff81e3c3a0"/>
+          <name>ada0p2</name>
+          <rank>3</rank>
+          <config>
+          </config>
+          <consumer id="0xfffff8000d2c0c80">
+            <geom ref="0xfffff8000d2c0d00"/>
+            <provider ref="0xfffff8000d2c0f00"/>
+            <mode>r0w0e0</mode>
+          </consumer>
+          <provider id="0xfffff8000d2c0c00">
+            <geom ref="0xfffff8000d2c0d00"/>
+            <mode>r0w0e0</mode>
+            <name>gptid/2d4f8a66-4b09-11e9-a9d4-0cc47a3a5bc2</name>
+            <mediasize>237909884928</mediasize>
+            <sectorsize>512</sectorsize>
+            <config>
+              <length>237909884928</length>
+            </config>
+          </provider>
+        </geom>
+      </class>
+    </mesh>
+""")
+
+
+@pytest.fixture(scope="module")
+def topology():
+    return GeomTopology(CONFXML)
+
+
+def test__geom_topology__links(topology):
+    mp = topology.geom("MULTIPATH", "disk1")
+    assert mp.config["State"] == "OPTIMAL"
+    assert [(c.config["State"], c.provider.name, c.provider.geom.clazz) for c in mp.consumers] == [
+        ("ACTIVE", "da0", "DISK"),
+        ("PASSIVE", "da1", "DISK"),
+    ]
+    assert topology.geom("DISK", "ada0").provider.mediasize == 240057409536
+    assert topology.geom("LABEL", "ada0p2").consumer.provider.geom.name == "ada0"
+
+
+@pytest.mark.parametrize("lookup,result", [
+    (lambda t: t.disk_by_ident("ZC1234AB"), "da0"),
+    (lambda t: t.disk_by_ident("S3Z1NB0K"), "ada0"),
+    (lambda t: t.disk_by_ident("S3Z1NB0X"), None),
+    (lambda t: t.disk_by_serial_lunid.get("ZC1234AB_5000c500a1b2c3d4"), "da0"),
+    (lambda t: t.disk_by_serial_lunid.get("  S3Z1NB0K  _"), "ada0"),
+    (lambda t: t.part_by_rawuuid.get("2d4f8a66-4b09-11e9-a9d4-0cc47a3a5bc2"), "ada0"),
+    (lambda t: t.provider_geom_name("LABEL", "gptid/2d4f8a66-4b09-11e9-a9d4-0cc47a3a5bc2"), "ada0p2"),
+    (lambda t: t.provider_geom_name("PART", "ada0p2"), "ada0"),
+    (lambda t: t.provider_geom_name("PART", "ada1p2"), None),
+])
+def test__geom_topology__indexes(topology, lookup, result):
+    assert lookup(topology) == result
@@ -0,0 +1,42 @@
+import os
+
+from middlewared.utils.io import write_if_changed
+
+
+def test__write_if_changed(tmp_path):
+    path = str(tmp_path / 'file')
+
+    assert write_if_changed(path, 'a\n')
+    os.chmod(path, 0o640)
+    inode = os.stat(path).st_ino
+
+    assert not write_if_changed(path, b'a\n')
+    assert os.stat(path).st_ino == inode
+
+    assert write_if_changed(path, 'b\n')
+    with open(path) as f:
+        assert f.read() == 'b\n'
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmp_path)) == ['file']
+
+
+def test__write_if_changed__follows_symlinks(tmp_path):
+    path = str(tmp_path / 'file')
+    link = str(tmp_path / 'link')
+    with open(path, 'w') as f:
+        f.write('a\n')
+    os.symlink(path, link)
+
+    assert write_if_changed(link, 'b\n')
+
+    assert os.path.islink(link)
+    with open(path) as f:
+        assert f.read() == 'b\n'
+
+
+def test__write_if_changed__mode(tmp_path):
+    path = str(tmp_path / 'file')
+
+    assert write_if_changed(path, 'a\n', mode=0o600)
+
+    assert os.stat(path).st_mode & 0o777 == 0o600
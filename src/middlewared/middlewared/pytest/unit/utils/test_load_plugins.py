@@ -0,0 +1,9 @@
+from middlewared.utils import LoadPluginsMixin
+
+
+def test__load_plugins__process_pool_modules_exclude_datastore():
+    plugins = LoadPluginsMixin(None)
+    plugins._load_plugins(modules=['middlewared.plugins.datastore', 'middlewared.plugins.zfs'])
+
+    # query-filters/query-options of zfs queries do not need the datastore (and django)
+    assert plugins._process_pool_modules == ['middlewared.plugins.zfs']
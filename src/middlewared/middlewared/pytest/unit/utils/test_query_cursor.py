@@ -0,0 +1,19 @@
+import pytest
+
+from middlewared.utils import decode_query_cursor, encode_query_cursor, query_fingerprint
+
+
+def test__query_cursor_roundtrip():
+    fingerprint = query_fingerprint('zfs.snapshot.query', [['pool', '=', 'tank']], {'order_by': ['name']})
+    assert decode_query_cursor(fingerprint, encode_query_cursor(fingerprint, 500)) == 500
+
+
+def test__query_cursor_other_query():
+    cursor = encode_query_cursor(query_fingerprint('zfs.snapshot.query', [], {'order_by': ['name']}), 500)
+    with pytest.raises(ValueError):
+        decode_query_cursor(query_fingerprint('zfs.snapshot.query', [], {'order_by': ['-name']}), cursor)
+
+
+def test__query_cursor_invalid():
+    with pytest.raises(ValueError):
+        decode_query_cursor(query_fingerprint('zfs.snapshot.query', [], {}), 'garbage')
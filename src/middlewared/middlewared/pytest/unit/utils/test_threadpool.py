@@ -0,0 +1,68 @@
+import threading
+import time
+
+from middlewared.utils.threadpool import IoThreadPoolExecutor
+
+
+class Config:
+    namespace = 'disk'
+
+
+class FakeService:
+    _config = Config
+
+    def sync(self):
+        return threading.current_thread().name
+
+
+def test__io_thread_pool__reuses_threads():
+    executor = IoThreadPoolExecutor(core_size=2)
+    try:
+        first = executor.submit(FakeService().sync).result()
+        # Give the thread a moment to be accounted as idle again
+        time.sleep(0.05)
+        assert executor.submit(FakeService().sync).result() == first
+        stats = executor.stats()
+        assert stats['started'] == 1
+        assert stats['tags']['disk']['calls'] == 2
+    finally:
+        executor.shutdown()
+
+
+def test__io_thread_pool__nested_calls_do_not_deadlock():
+    executor = IoThreadPoolExecutor(core_size=1)
+
+    def outer():
+        return executor.submit(lambda: 'inner').result(timeout=5)
+
+    try:
+        assert executor.submit(outer).result(timeout=5) == 'inner'
+        assert executor.stats()['started'] == 2
+    finally:
+        executor.shutdown()
+
+
+def test__io_thread_pool__reaps_idle_threads():
+    executor = IoThreadPoolExecutor(core_size=1, idle_timeout=0.05)
+    event = threading.Event()
+    try:
+        futures = [executor.submit(event.wait) for i in range(3)]
+        event.set()
+        for future in futures:
+            future.result()
+
+        time.sleep(0.5)
+        stats = executor.stats()
+        assert stats['threads'] == 1
+        assert stats['reaped'] == 2
+    finally:
+        executor.shutdown()
+
+
+def test__io_thread_pool__exception():
+    executor = IoThreadPoolExecutor()
+    try:
+        future = executor.submit(int, 'x')
+        assert isinstance(future.exception(), ValueError)
+    finally:
+        executor.shutdown()
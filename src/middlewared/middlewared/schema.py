@@ -833,6 +833,33 @@ def resolver(schemas, f):
     f.accepts.extend(new_params)
 
 
+def schema_names(params):
+    """
+    Names of the schemas registered and of the schemas referenced by method params
+    that have not been resolved yet.
+    """
+    registered = set()
+    referenced = set()
+    params = list(params)
+    while params:
+        p = params.pop()
+        if isinstance(p, Ref):
+            referenced.add(p.name)
+        elif isinstance(p, Patch):
+            referenced.add(p.name)
+            if p.register:
+                registered.add(p.newname)
+            params.extend(patch for operation, patch in p.patches if operation == 'add' and not isinstance(patch, dict))
+        elif isinstance(p, Attribute):
+            if p.register:
+                registered.add(p.name)
+            if isinstance(p, Dict):
+                params.extend(p.attrs.values())
+            elif isinstance(p, List):
+                params.extend(p.items)
+    return registered, referenced
+
+
 def resolve_methods(schemas, to_resolve):
     while len(to_resolve) > 0:
         resolved = 0
@@ -23,6 +23,8 @@ from middlewared.pipe import Pipes
 
 PeriodicTaskDescriptor = namedtuple("PeriodicTaskDescriptor", ["interval", "run_on_start"])
 get_or_insert_lock = asyncio.Lock()
+# Filter operators which behave the same in `filter_list` and in the database
+RAW_FILTER_OPS = ('=', '!=', '>', '>=', '<', '<=', 'in', 'nin')
 
 
 def item_method(fn):
@@ -33,8 +35,14 @@ def item_method(fn):
     return fn
 
 
-def job(lock=None, lock_queue_size=None, logs=False, process=False, pipes=None, check_pipes=True, transient=False):
-    """Flag method as a long running job."""
+def job(lock=None, lock_queue_size=None, logs=False, process=False, pipes=None, check_pipes=True, transient=False,
+        priority=0, max_concurrency=None):
+    """
+    Flag method as a long running job.
+
+    Jobs with a higher `priority` are started first, `max_concurrency` limits how many
+    jobs of this method can run at the same time.
+    """
     def check_job(fn):
         fn._job = {
             'lock': lock,
@@ -44,6 +52,8 @@ def job(lock=None, lock_queue_size=None, logs=False, process=False, pipes=None,
             'pipes': pipes or [],
             'check_pipes': check_pipes,
             'transient': transient,
+            'priority': priority,
+            'max_concurrency': max_concurrency,
         }
         return fn
     return check_job
@@ -133,6 +143,31 @@ def private(fn):
     return fn
 
 
+# Schemas of `filterable` params, registered before any plugin so that process pool workers do not need
+# to load the datastore (and django) to resolve them
+QUERY_SCHEMAS = (
+    List('query-filters', default=None, null=True),
+    Dict(
+        'query-options',
+        Str('extend', default=None, null=True),
+        Str('extend_context', default=None, null=True),
+        Str('prefix', default=None, null=True),
+        Dict('extra', additional_attrs=True),
+        List('order_by', default=[]),
+        List('select', default=[]),
+        Bool('count', default=False),
+        Bool('get', default=False),
+        Int('offset', default=0),
+        Int('limit', default=0),
+        Str('cursor', null=True),
+        Bool('stream'),
+        Int('stream_window'),
+        default=None,
+        null=True,
+    ),
+)
+
+
 def filterable(fn):
     fn._filterable = True
     return accepts(Ref('query-filters'), Ref('query-options'))(fn)
@@ -156,6 +191,8 @@ class ServiceBase(type):
       - datastore_extend: datastore `extend` option used in common `query` method
       - datastore_prefix: datastore `prefix` option used in helper methods
       - datastore_filters: datastore default filters to be used in `query` method
+      - datastore_raw_fields: fields not changed by `datastore_extend` (defaults to `id`), filters on
+                              these fields are run in the database before extending
       - service: system service `name` option used by `SystemServiceService`
       - service_model: system service datastore model option used by `SystemServiceService` (`service` if used if not provided)
       - service_verb: verb to be used on update (default to `reload`)
@@ -188,6 +225,7 @@ class ServiceBase(type):
             'datastore_extend': None,
             'datastore_extend_context': None,
             'datastore_filters': None,
+            'datastore_raw_fields': None,
             'service': None,
             'service_model': None,
             'service_verb': 'reload',
@@ -334,22 +372,58 @@ class CRUDService(ServiceChangeMixin, Service):
         options['prefix'] = self._config.datastore_prefix
 
         # In case we are extending which may transform the result in numerous ways
-        # we can only filter the final result.
+        # we can only filter the final result, except for filters on fields known
+        # not to be changed by the extend method which are run in the database.
         if options['extend']:
+            datastore_filters, post_filters = self._split_raw_filters(filters)
             datastore_options = options.copy()
-            datastore_options.pop('count', None)
-            datastore_options.pop('get', None)
+            raw_fields = self._datastore_raw_fields()
+            order_by = {o[1:] if o.startswith('-') else o for o in options.get('order_by') or []}
+            if not post_filters and order_by.issubset(raw_fields):
+                # Nothing left to be done after extend, let the database count and
+                # paginate so we only extend the rows actually returned.
+                if options.get('count'):
+                    datastore_options['extend'] = None
+                    datastore_options['extend_context'] = None
+                return await self.middleware.call(
+                    'datastore.query', self._config.datastore, datastore_filters, datastore_options,
+                )
+
+            for i in ('count', 'get', 'limit', 'offset'):
+                datastore_options.pop(i, None)
             result = await self.middleware.call(
-                'datastore.query', self._config.datastore, [], datastore_options
+                'datastore.query', self._config.datastore, datastore_filters, datastore_options
             )
             return await self.middleware.run_in_thread(
-                filter_list, result, filters, options
+                filter_list, result, post_filters, options
             )
         else:
             return await self.middleware.call(
                 'datastore.query', self._config.datastore, filters, options,
             )
 
+    def _datastore_raw_fields(self):
+        if self._config.datastore_raw_fields is None:
+            return {'id'}
+        return set(self._config.datastore_raw_fields)
+
+    def _split_raw_filters(self, filters):
+        """
+        Split `filters` in filters that can be run in the database before `datastore_extend`
+        and the remaining ones which need to be evaluated on the extended result.
+        """
+        raw_fields = self._datastore_raw_fields()
+
+        def is_raw(f):
+            if len(f) == 2:
+                return f[0] == 'OR' and all(is_raw(i) for i in f[1])
+            return len(f) == 3 and f[0] in raw_fields and f[1] in RAW_FILTER_OPS
+
+        raw, post = [], []
+        for f in filters:
+            (raw if is_raw(f) else post).append(f)
+        return raw, post
+
     async def create(self, data):
         rv = await self.middleware._call(
             f'{self._config.namespace}.create', self, self.do_create, [data]
@@ -393,12 +467,28 @@ class CoreService(Service):
 
     @filterable
     def get_jobs(self, filters=None, options=None):
-        """Get the long running jobs."""
-        jobs = filter_list([
-            i.__encode__() for i in list(self.middleware.jobs.all().values())
-        ], filters, options)
+        """
+        Get the long running jobs.
+
+        Without filters nor limit only the most recent of the finished jobs are returned.
+        """
+        jobs = filter_list(self.middleware.jobs.query(filters, options), filters, options)
         return jobs
 
+    @accepts()
+    def threadpool_stats(self):
+        """
+        Get usage of the thread pools running blocking calls, per service for the I/O pool.
+        """
+        return self.middleware.threadpool_stats()
+
+    @accepts()
+    async def get_jobs_stats(self):
+        """
+        Get queue depth, running jobs and wait times of the jobs scheduler, per method and lock.
+        """
+        return self.middleware.jobs.stats()
+
     @accepts(Int('id'), Dict(
         'job-update',
         Dict('progress', additional_attrs=True),
@@ -1,8 +1,15 @@
 import asyncio
+import base64
 import ctypes
 import ctypes.util
+import functools
+import hashlib
+import heapq
 import imp
 import inspect
+import itertools
+import json
+import operator
 import os
 import pwd
 import queue
@@ -10,6 +17,7 @@ import re
 import sys
 import subprocess
 import threading
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timedelta
 from itertools import chain
 from functools import wraps
@@ -38,41 +46,81 @@ def bisect(condition, iterable):
     return a, b
 
 
-def django_modelobj_serialize(middleware, obj, extend=None, extend_context=None, extend_context_value=None,
-                              field_prefix=None, select=None):
+SERIALIZE_PLAIN, SERIALIZE_IPADDRESS, SERIALIZE_FOREIGN_KEY, SERIALIZE_MANY_TO_MANY = range(4)
+
+
+@functools.lru_cache(maxsize=None)
+def django_model_fields(model, field_prefix=None):
+    """
+    Precomputed table of (attribute name, serialized name, kind, field) for every
+    field of `model`, so serializing each row does not have to inspect field types.
+    """
     from django.db.models.fields.related import ForeignKey, ManyToManyField
     from freenasUI.contrib.IPAddressField import (
         IPAddressField, IP4AddressField, IP6AddressField
     )
-    data = {}
-    for field in chain(obj._meta.fields, obj._meta.many_to_many):
+    fields = []
+    for field in chain(model._meta.fields, model._meta.many_to_many):
         origname = field.name
         if field_prefix and origname.startswith(field_prefix):
             name = origname[len(field_prefix):]
         else:
             name = origname
+        if isinstance(field, (IPAddressField, IP4AddressField, IP6AddressField)):
+            kind = SERIALIZE_IPADDRESS
+        elif isinstance(field, ForeignKey):
+            kind = SERIALIZE_FOREIGN_KEY
+        elif isinstance(field, ManyToManyField):
+            kind = SERIALIZE_MANY_TO_MANY
+        else:
+            kind = SERIALIZE_PLAIN
+        fields.append((origname, name, kind, field))
+    return tuple(fields)
+
+
+def django_model_prefetch(model, field_prefix=None, select=None, _seen=()):
+    """
+    Returns the relation lookups to use with `prefetch_related` so that serializing a
+    queryset of `model` takes one query per relation instead of one per row.
+    """
+    lookups = []
+    for origname, name, kind, field in django_model_fields(model, None if _seen else field_prefix):
+        if kind not in (SERIALIZE_FOREIGN_KEY, SERIALIZE_MANY_TO_MANY):
+            continue
+        if select and not _seen and name not in select:
+            continue
+        related = field.rel.model
+        lookups.append(origname)
+        # Do not follow relations back to a model already being prefetched (e.g. self references)
+        if related is not model and related not in _seen:
+            lookups.extend(
+                f'{origname}__{i}' for i in django_model_prefetch(related, _seen=_seen + (model,))
+            )
+    return lookups
+
+
+def django_modelobj_serialize(middleware, obj, extend=None, extend_context=None, extend_context_value=None,
+                              field_prefix=None, select=None):
+    data = {}
+    for origname, name, kind, field in django_model_fields(type(obj), field_prefix):
         if select and name not in select:
             continue
         try:
             value = getattr(obj, origname)
         except Exception as e:
             # If foreign key does not exist set it to None
-            if isinstance(field, ForeignKey) and isinstance(e, field.rel.model.DoesNotExist):
+            if kind == SERIALIZE_FOREIGN_KEY and isinstance(e, field.rel.model.DoesNotExist):
                 data[name] = None
                 continue
             raise
-        if isinstance(field, (
-            IPAddressField, IP4AddressField, IP6AddressField
-        )):
+        if kind == SERIALIZE_PLAIN:
+            data[name] = value
+        elif kind == SERIALIZE_IPADDRESS:
             data[name] = str(value)
-        elif isinstance(field, ForeignKey):
+        elif kind == SERIALIZE_FOREIGN_KEY:
             data[name] = django_modelobj_serialize(middleware, value) if value is not None else value
-        elif isinstance(field, ManyToManyField):
-            data[name] = []
-            for o in value.all():
-                data[name].append(django_modelobj_serialize(middleware, o))
         else:
-            data[name] = value
+            data[name] = [django_modelobj_serialize(middleware, o) for o in value.all()]
     if extend:
         if extend_context:
             data = middleware.call_sync(extend, data, extend_context_value)
@@ -222,109 +270,264 @@ def get(obj, path):
     return cur
 
 
-def filter_list(_list, filters=None, options=None):
-
-    opmap = {
-        '=': lambda x, y: x == y,
-        '!=': lambda x, y: x != y,
-        '>': lambda x, y: x > y,
-        '>=': lambda x, y: x >= y,
-        '<': lambda x, y: x < y,
-        '<=': lambda x, y: x <= y,
-        '~': lambda x, y: re.match(y, x),
-        'in': lambda x, y: x in y,
-        'nin': lambda x, y: x not in y,
-        'rin': lambda x, y: x is not None and y in x,
-        'rnin': lambda x, y: x is not None and y not in x,
-        '^': lambda x, y: x.startswith(y),
-        '!^': lambda x, y: not x.startswith(y),
-        '$': lambda x, y: x.endswith(y),
-        '!$': lambda x, y: not x.endswith(y),
-    }
-
-    if filters is None:
-        filters = {}
-    if options is None:
-        options = {}
+FILTER_OPS = {
+    '=': lambda x, y: x == y,
+    '!=': lambda x, y: x != y,
+    '>': lambda x, y: x > y,
+    '>=': lambda x, y: x >= y,
+    '<': lambda x, y: x < y,
+    '<=': lambda x, y: x <= y,
+    '~': lambda x, y: y.match(x),
+    'in': lambda x, y: x in y,
+    'nin': lambda x, y: x not in y,
+    'rin': lambda x, y: x is not None and y in x,
+    'rnin': lambda x, y: x is not None and y not in x,
+    '^': lambda x, y: x.startswith(y),
+    '!^': lambda x, y: not x.startswith(y),
+    '$': lambda x, y: x.endswith(y),
+    '!$': lambda x, y: not x.endswith(y),
+}
+
+FILTERS_CACHE_SIZE = 256
+_filters_cache = OrderedDict()
+_filters_cache_lock = Lock()
+
+
+def _filters_cache_key(value):
+    """
+    Turn a filter (or any of its values) into something hashable.
 
-    select = options.get('select')
+    Types are part of the key so that e.g. `[1]` and `(1,)` do not share the
+    same compiled predicate.
+    """
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(_filters_cache_key(v) for v in value)
+    if isinstance(value, dict):
+        return dict, tuple(sorted((k, _filters_cache_key(v)) for k, v in value.items()))
+    hash(value)
+    return type(value), value
 
-    rv = []
-    if filters:
 
-        def filterop(f):
-            if len(f) != 3:
-                raise ValueError(f'Invalid filter {f}')
-            name, op, value = f
-            if op not in opmap:
-                raise ValueError('Invalid operation: {}'.format(op))
+def _compile_getter(name):
+    if '.' not in name:
+        def getter(i):
             if isinstance(i, dict):
-                source = get(i, name)
-            else:
-                source = getattr(i, name)
-            if opmap[op](source, value):
-                return True
+                return i.get(name)
+            return getattr(i, name)
+    else:
+        path = []
+        right = name
+        while right:
+            left, right = partition(right)
+            path.append(left)
+
+        def getter(i):
+            if not isinstance(i, dict):
+                return getattr(i, name)
+            cur = i
+            for left in path:
+                if isinstance(cur, dict):
+                    cur = cur.get(left)
+                elif isinstance(cur, (list, tuple)):
+                    left = int(left)
+                    cur = cur[left] if left < len(cur) else None
+            return cur
+    return getter
+
+
+def _compile_filter(f):
+    if len(f) == 2:
+        op, value = f
+        if op != 'OR':
+            raise ValueError(f'Invalid operation: {op}')
+        predicates = [_compile_filter(i) for i in value]
+
+        def or_predicate(i):
+            for p in predicates:
+                if p(i):
+                    return True
             return False
+        return or_predicate
 
-        for i in _list:
-            valid = True
-            for f in filters:
-                if len(f) == 2:
-                    op, value = f
-                    if op == 'OR':
-                        for f in value:
-                            if filterop(f):
-                                break
-                        else:
-                            valid = False
-                            break
-                    else:
-                        raise ValueError(f'Invalid operation: {op}')
-                elif not filterop(f):
-                    valid = False
-                    break
-
-            if not valid:
-                continue
-            if select:
-                entry = {}
-                for s in select:
-                    if s in i:
-                        entry[s] = i[s]
-            else:
-                entry = i
-            rv.append(entry)
-            if options.get('get') is True:
-                return entry
-    elif select:
-        rv = []
-        for i in _list:
-            entry = {}
-            for s in select:
-                if s in i:
-                    entry[s] = i[s]
-            rv.append(entry)
+    if len(f) != 3:
+        raise ValueError(f'Invalid filter {f}')
+
+    name, op, value = f
+    if op not in FILTER_OPS:
+        raise ValueError('Invalid operation: {}'.format(op))
+
+    getter = _compile_getter(name)
+    fn = FILTER_OPS[op]
+    if op == '~':
+        value = re.compile(value)
+    elif op in ('in', 'nin') and isinstance(value, (list, tuple)):
+        try:
+            values = frozenset(value)
+        except TypeError:
+            pass
+        else:
+            # Membership test against a set, falling back to the original
+            # sequence for unhashable attributes.
+            def fn(x, y, _fn=fn, _values=values):
+                try:
+                    return _fn(x, _values)
+                except TypeError:
+                    return _fn(x, y)
+
+    return lambda i: fn(getter(i), value)
+
+
+def compile_filters(filters):
+    """
+    Compile `query-filters` into a single predicate function.
+
+    Compiled predicates are kept in a LRU cache so queries using the same filters
+    (e.g. periodic alert checks) do not pay the compilation cost again.
+    """
+    try:
+        key = _filters_cache_key(filters)
+    except TypeError:
+        key = None
+
+    if key is not None:
+        with _filters_cache_lock:
+            predicate = _filters_cache.get(key)
+            if predicate is not None:
+                _filters_cache.move_to_end(key)
+                return predicate
+
+    predicates = [_compile_filter(f) for f in filters]
+    if len(predicates) == 1:
+        predicate = predicates[0]
     else:
-        rv = _list
+        def predicate(i):
+            for p in predicates:
+                if not p(i):
+                    return False
+            return True
+
+    if key is not None:
+        with _filters_cache_lock:
+            _filters_cache[key] = predicate
+            if len(_filters_cache) > FILTERS_CACHE_SIZE:
+                _filters_cache.popitem(last=False)
+
+    return predicate
+
+
+@functools.lru_cache(maxsize=FILTERS_CACHE_SIZE)
+def _compile_order_by(order_by):
+    keys = []
+    for o in order_by:
+        if o.startswith('-'):
+            keys.append((o[1:], True))
+        else:
+            keys.append((o, False))
+
+    # Group consecutive keys sharing the same direction so that each group is
+    # sorted in a single pass using a tuple key.
+    groups = []
+    for reverse, group in itertools.groupby(keys, key=lambda k: k[1]):
+        groups.append((operator.itemgetter(*[name for name, r in group]), reverse))
+
+    # Python sort is stable, least significant group goes first.
+    return tuple(reversed(groups))
+
+
+def compile_order_by(order_by):
+    """
+    Compile `order_by` option into a tuple of (key, reverse) sorting passes.
+
+    First entry of `order_by` is the primary sort key, entries prefixed with "-" are
+    sorted in descending order. Keys sharing the same direction are sorted in one
+    pass so the common case is a single `sorted` call.
+    """
+    return _compile_order_by(tuple(order_by))
+
+
+def filter_list(_list, filters=None, options=None):
+    if options is None:
+        options = {}
+
+    select = options.get('select')
+    order_by = options.get('order_by')
+    offset = options.get('offset') or 0
+    limit = options.get('limit') or 0
+    get_ = options.get('get') is True
+
+    if not filters and not select and not order_by and not offset and not limit:
+        if options.get('count') is True:
+            return len(_list)
+        if get_:
+            return _list[0]
+        return _list
+
+    rv = filter(compile_filters(filters), _list) if filters else _list
 
     if options.get('count') is True:
-        return len(rv)
-
-    if options.get('order_by'):
-        for o in options.get('order_by'):
-            if o.startswith('-'):
-                o = o[1:]
-                reverse = True
-            else:
-                reverse = False
-            rv = sorted(rv, key=lambda x: x[o], reverse=reverse)
-
-    if options.get('get') is True:
+        if rv is _list:
+            return len(rv)
+        return sum(1 for i in rv)
+
+    if get_:
+        limit = 1
+
+    if order_by:
+        passes = compile_order_by(order_by)
+        if limit and len(passes) == 1:
+            # Top-N using a heap, same result as sorted(...)[:n]
+            key, reverse = passes[0]
+            rv = (heapq.nlargest if reverse else heapq.nsmallest)(offset + limit, rv, key=key)
+        else:
+            for key, reverse in passes:
+                rv = sorted(rv, key=key, reverse=reverse)
+
+    if offset or limit:
+        rv = itertools.islice(rv, offset, offset + limit if limit else None)
+
+    if select:
+        rv = [{s: i[s] for s in select if s in i} for i in rv]
+    elif not isinstance(rv, list):
+        rv = list(rv)
+
+    if get_:
         return rv[0]
 
     return rv
 
 
+def query_fingerprint(method, filters, options):
+    """
+    Fingerprint of a query used to make sure a cursor is only used to page
+    through the same query it was generated for.
+    """
+    options = options or {}
+    data = json.dumps(
+        [method, filters or [], options.get('order_by') or [], options.get('select') or []],
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+
+def encode_query_cursor(fingerprint, offset):
+    return base64.urlsafe_b64encode(json.dumps([fingerprint, offset]).encode()).decode()
+
+
+def decode_query_cursor(fingerprint, cursor):
+    """
+    Returns the offset stored in `cursor`.
+
+    Raises ValueError if cursor is invalid or was generated for another query.
+    """
+    try:
+        cursor_fingerprint, offset = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if cursor_fingerprint != fingerprint or not isinstance(offset, int) or offset < 0:
+        raise ValueError('Cursor does not match query')
+    return offset
+
+
 def filter_getattrs(filters):
     """
     Get a set of attributes in a filter list.
@@ -438,7 +641,10 @@ class cache_with_autorefresh(object):
         return wrapper
 
 
-def load_modules(directory):
+def load_modules(directory, names=None):
+    """
+    Import every module in `directory`, or only those whose name is in `names` if given.
+    """
     for f in sorted(os.listdir(directory)):
         if not f.endswith('.py'):
             continue
@@ -448,6 +654,8 @@ def load_modules(directory):
             os.path.relpath(directory, os.path.dirname(os.path.dirname(__file__))).split('/') +
             [f]
         )
+        if names is not None and name not in names:
+            continue
         fp, pathname, description = imp.find_module(f, [directory])
         try:
             yield imp.load_module(name, fp, pathname, description)
@@ -473,10 +681,20 @@ class LoadPluginsMixin(object):
     def __init__(self, overlay_dirs):
         self.overlay_dirs = overlay_dirs or []
         self._schemas = Schemas()
+        from middlewared.service import QUERY_SCHEMAS  # Lazy import so namespace match
+        for schema in QUERY_SCHEMAS:
+            self._schemas.add(schema)
         self._services = {}
         self._services_aliases = {}
+        self._process_pool_modules = []
 
-    def _load_plugins(self, on_module_begin=None, on_module_end=None, on_modules_loaded=None):
+    def _load_plugins(self, on_module_begin=None, on_module_end=None, on_modules_loaded=None, modules=None):
+        """
+        Load the services of every plugin module, or only of the `modules` names if given.
+
+        Names of the modules process pool workers need to load (the ones with `process_pool`
+        services and the ones registering schemas they use) are left in `_process_pool_modules`.
+        """
         from middlewared.service import Service, CRUDService, ConfigService, SystemServiceService
 
         main_plugins_dir = os.path.realpath(os.path.join(
@@ -491,7 +709,7 @@ class LoadPluginsMixin(object):
             if not os.path.exists(plugins_dir):
                 raise ValueError(f'plugins dir not found: {plugins_dir}')
 
-            for mod in load_modules(plugins_dir):
+            for mod in load_modules(plugins_dir, modules):
                 if on_module_begin:
                     on_module_begin(mod)
 
@@ -508,13 +726,35 @@ class LoadPluginsMixin(object):
 
         # Now that all plugins have been loaded we can resolve all method params
         # to make sure every schema is patched and references match
-        from middlewared.schema import resolve_methods  # Lazy import so namespace match
+        from middlewared.schema import resolve_methods, schema_names  # Lazy import so namespace match
         to_resolve = []
+        # Schemas registered and referenced by each module, they are only known before being resolved
+        registered_by = {}
+        referenced_by = defaultdict(set)
         for service in list(self._services.values()):
+            module = type(service).__module__
             for attr in dir(service):
-                to_resolve.append(getattr(service, attr))
+                method = getattr(service, attr)
+                to_resolve.append(method)
+                if callable(method) and hasattr(method, 'accepts'):
+                    registered, referenced = schema_names(method.accepts)
+                    registered_by.update(dict.fromkeys(registered, module))
+                    referenced_by[module] |= referenced
         resolve_methods(self._schemas, to_resolve)
 
+        process_pool_modules = {
+            type(service).__module__
+            for service in self._services.values() if service._config.process_pool is True
+        }
+        pending = list(process_pool_modules)
+        while pending:
+            for name in referenced_by[pending.pop()]:
+                module = registered_by.get(name)
+                if module and module not in process_pool_modules:
+                    process_pool_modules.add(module)
+                    pending.append(module)
+        self._process_pool_modules = sorted(process_pool_modules)
+
     def add_service(self, service):
         self._services[service._config.namespace] = service
         if service._config.namespace_alias:
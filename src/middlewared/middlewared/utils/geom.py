@@ -0,0 +1,163 @@
+from collections import defaultdict
+import threading
+from xml.etree import ElementTree
+
+import sysctl
+
+__all__ = ['GeomTopology', 'scan', 'topology']
+
+
+class GeomProvider:
+    def __init__(self, id, name, mediasize, config):
+        self.id = id
+        self.name = name
+        self.mediasize = mediasize
+        self.config = config
+        self.geom = None
+
+
+class GeomConsumer:
+    def __init__(self, provider_ref, config):
+        self.provider_ref = provider_ref
+        self.config = config
+        self.provider = None
+
+
+class Geom:
+    def __init__(self, clazz, name, config):
+        self.clazz = clazz
+        self.name = name
+        self.config = config
+        self.providers = []
+        self.consumers = []
+
+    @property
+    def provider(self):
+        return self.providers[0] if self.providers else None
+
+    @property
+    def consumer(self):
+        return self.consumers[0] if self.consumers else None
+
+
+def _config(node):
+    config = {}
+    if node is not None:
+        for child in node:
+            config[child.tag] = child.text or ''
+    return config
+
+
+def _normalize_space(value):
+    return ' '.join(value.split())
+
+
+class GeomTopology:
+    """
+    Snapshot of the GEOM tree (as found in `kern.geom.confxml`) with hash indexes for the lookups used
+    to identify disks, so that many disks can be resolved against a single scan.
+    """
+
+    def __init__(self, confxml):
+        self.classes = defaultdict(dict)
+        self.providers = {}
+        self.providers_by_name = defaultdict(dict)
+
+        self.disk_by_serial = {}
+        self.disk_by_normalized_serial = {}
+        self.disk_by_serial_lunid = {}
+        self.part_by_rawuuid = {}
+
+        consumers = []
+        for class_node in ElementTree.fromstring(confxml).iterfind('class'):
+            clazz = class_node.findtext('name')
+            for geom_node in class_node.iterfind('geom'):
+                g = Geom(clazz, geom_node.findtext('name'), _config(geom_node.find('config')))
+                for provider_node in geom_node.iterfind('provider'):
+                    mediasize = provider_node.findtext('mediasize')
+                    p = GeomProvider(
+                        provider_node.get('id'),
+                        provider_node.findtext('name'),
+                        int(mediasize) if mediasize else None,
+                        _config(provider_node.find('config')),
+                    )
+                    p.geom = g
+                    g.providers.append(p)
+                    self.providers[p.id] = p
+                    self.providers_by_name[clazz].setdefault(p.name, p)
+                for consumer_node in geom_node.iterfind('consumer'):
+                    provider = consumer_node.find('provider')
+                    c = GeomConsumer(provider.get('ref') if provider is not None else None,
+                                     _config(consumer_node.find('config')))
+                    g.consumers.append(c)
+                    consumers.append(c)
+                # First geom wins, like a document order XPath search would
+                self.classes[clazz].setdefault(g.name, g)
+
+        for c in consumers:
+            c.provider = self.providers.get(c.provider_ref)
+
+        for g in self.geoms('DISK'):
+            for p in g.providers:
+                ident = p.config.get('ident')
+                if ident is None:
+                    continue
+                self.disk_by_serial.setdefault(ident, g.name)
+                self.disk_by_normalized_serial.setdefault(_normalize_space(ident), g.name)
+                self.disk_by_serial_lunid.setdefault(f'{ident}_{p.config.get("lunid", "")}', g.name)
+
+        for g in self.geoms('PART'):
+            for p in g.providers:
+                rawuuid = p.config.get('rawuuid')
+                if rawuuid:
+                    self.part_by_rawuuid.setdefault(rawuuid, g.name)
+
+    def has_class(self, clazz):
+        return clazz in self.classes
+
+    def geoms(self, clazz):
+        return list(self.classes.get(clazz, {}).values())
+
+    def geom(self, clazz, name):
+        return self.classes.get(clazz, {}).get(name)
+
+    def provider(self, clazz, name):
+        return self.providers_by_name.get(clazz, {}).get(name)
+
+    def provider_geom_name(self, clazz, name):
+        """
+        Name of the geom of class `clazz` that has a provider named `name`.
+        """
+        p = self.provider(clazz, name)
+        if p is not None:
+            return p.geom.name
+
+    def disk_by_ident(self, serial):
+        """
+        Name of the disk with the serial `serial`, ignoring differences in whitespace if there is no exact match.
+        """
+        return self.disk_by_serial.get(serial) or self.disk_by_normalized_serial.get(_normalize_space(serial))
+
+
+_lock = threading.Lock()
+_topology = None
+
+
+def scan():
+    """
+    Take a new snapshot of the GEOM tree and make it the current one.
+    """
+    global _topology
+    new = GeomTopology(sysctl.filter('kern.geom.confxml')[0].value)
+    with _lock:
+        _topology = new
+    return new
+
+
+def topology():
+    """
+    Current snapshot of the GEOM tree, taking one if there is none yet.
+    """
+    with _lock:
+        current = _topology
+    return current or scan()
@@ -1,21 +1,48 @@
 import os
+import stat
+import threading
 
 
-def write_if_changed(path, data):
+def write_if_changed(path, data, mode=0o666):
+    """
+    Write `data` to `path` unless it already has these contents.
+
+    The new contents are written to a temporary file that replaces `path`, so readers never see a partially
+    written file. Ownership and permissions of an existing file are kept, a new file is created with `mode`
+    (less the umask).
+
+    Returns whether the file was written.
+    """
 
     if isinstance(data, str):
         data = data.encode()
 
-    changed = False
+    # Write through symlinks instead of replacing them
+    path = os.path.realpath(path)
+
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+            st = os.fstat(f.fileno())
+    except FileNotFoundError:
+        st = None
 
-    with open(os.open(path, os.O_CREAT | os.O_RDWR), 'wb+') as f:
-        f.seek(0)
-        current = f.read()
-        if current != data:
-            changed = True
-            f.seek(0)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(os.open(tmp, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, mode), 'wb') as f:
             f.write(data)
-            f.truncate()
-        os.fsync(f)
+            f.flush()
+            if st is not None:
+                os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
 
-    return changed
+    return True
@@ -0,0 +1,141 @@
+from collections import defaultdict
+import concurrent.futures
+import functools
+import queue
+import threading
+import time
+
+
+def call_tag(fn):
+    """
+    Service namespace of a method (or module of any other callable) to account a call under.
+    """
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    config = getattr(getattr(fn, '__self__', None), '_config', None)
+    if config is not None:
+        return config.namespace
+    return getattr(fn, '__module__', None)
+
+
+class IoThreadPoolExecutor(concurrent.futures.Executor):
+    """
+    Elastic thread pool for blocking calls.
+
+    Up to `core_size` threads are kept around once started. A call never waits for
+    a busy thread: when no thread is idle a new one is started, so a method blocked
+    on another call made to the same pool can not deadlock it. Threads above
+    `core_size` exit after being idle for `idle_timeout` seconds.
+
+    `tag` maps a callable to the key its calls are accounted under, by default the
+    service it belongs to.
+    """
+
+    def __init__(self, name='io_thread', core_size=10, idle_timeout=60, initializer=None, tag=None):
+        self.name = name
+        self.core_size = core_size
+        self.idle_timeout = idle_timeout
+        self.initializer = initializer
+        self.tag = tag or call_tag
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = set()
+        # Idle threads not yet claimed by a submitted call
+        self._idle = 0
+        self._shutdown = False
+        self._counter = 0
+
+        self._stats = {'started': 0, 'reaped': 0, 'peak': 0}
+        self._tags = defaultdict(lambda: {'calls': 0, 'running': 0, 'time': 0.0})
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+
+            self._queue.put((future, fn, args, kwargs))
+            if self._idle > 0:
+                self._idle -= 1
+            else:
+                self._start_thread()
+        return future
+
+    def _start_thread(self):
+        self._counter += 1
+        thread = threading.Thread(target=self._worker, name=f'{self.name}_{self._counter}', daemon=True)
+        self._threads.add(thread)
+        self._stats['started'] += 1
+        self._stats['peak'] = max(self._stats['peak'], len(self._threads))
+        thread.start()
+
+    def _worker(self):
+        if self.initializer:
+            self.initializer()
+
+        thread = threading.current_thread()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # An idle thread being claimed means its work is on the way
+                    if self._idle > 0 and len(self._threads) > self.core_size:
+                        self._idle -= 1
+                        self._threads.discard(thread)
+                        self._stats['reaped'] += 1
+                        return
+                continue
+
+            if item is None:
+                with self._lock:
+                    self._threads.discard(thread)
+                return
+
+            self._run(*item)
+
+            with self._lock:
+                self._idle += 1
+
+    def _run(self, future, fn, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        tag = self.tag(fn)
+        with self._lock:
+            stats = self._tags[tag]
+            stats['calls'] += 1
+            stats['running'] += 1
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                stats['running'] -= 1
+                stats['time'] += time.monotonic() - start
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._stats,
+                threads=len(self._threads),
+                idle=self._idle,
+                core_size=self.core_size,
+                queued=self._queue.qsize(),
+                tags={k: dict(v) for k, v in self._tags.items()},
+            )
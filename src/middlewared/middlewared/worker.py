@@ -2,7 +2,6 @@
 from middlewared.client import Client
 
 import asyncio
-import concurrent.futures
 import functools
 import inspect
 import os
@@ -11,6 +10,7 @@ import setproctitle
 import threading
 from . import logger
 from .utils import LoadPluginsMixin
+from .utils.threadpool import IoThreadPoolExecutor
 
 MIDDLEWARE = None
 
@@ -23,34 +23,42 @@ class FakeMiddleware(LoadPluginsMixin):
     def __init__(self, overlay_dirs):
         super().__init__(overlay_dirs)
         self.client = None
+        self.client_lock = threading.Lock()
         self.logger = logger.Logger('worker')
         self.logger.getLogger()
         self.logger.configure_logging('console')
+        self.io_executor = IoThreadPoolExecutor(core_size=2)
+        self.job_progress = JobProgressSender(self.get_client)
 
     async def run_in_thread(self, method, *args, **kwargs):
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        try:
-            return await asyncio.get_event_loop().run_in_executor(
-                executor, functools.partial(method, *args, **kwargs)
-            )
-        finally:
-            # We need this because default behavior of PoolExecutor with
-            # context manager is to shutdown(wait=True) which would block
-            # the worker until thread finishes.
-            executor.shutdown(wait=False)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.io_executor, functools.partial(method, *args, **kwargs)
+        )
+
+    def get_client(self):
+        """
+        Connection to middlewared kept for the lifetime of the worker and shared
+        by every call it runs, reconnecting if it was closed.
+        """
+        with self.client_lock:
+            if self.client is None or self.client.closed:
+                self.client = Client(py_exceptions=True)
+            return self.client
 
     async def _call(self, name, serviceobj, methodobj, params=None, app=None, pipes=None, io_thread=False, job=None):
-        with Client(py_exceptions=True) as c:
-            self.client = c
-            job_options = getattr(methodobj, '_job', None)
-            if job and job_options:
-                params = list(params) if params else []
-                params.insert(0, FakeJob(job['id'], self.client))
+        fake_job = None
+        job_options = getattr(methodobj, '_job', None)
+        if job and job_options:
+            fake_job = FakeJob(job['id'], self.job_progress)
+            params = [fake_job] + (list(params) if params else [])
+        try:
             if asyncio.iscoroutinefunction(methodobj):
                 return await methodobj(*params)
             else:
                 return methodobj(*params)
-        self.client = None
+        finally:
+            if fake_job:
+                fake_job.flush()
 
     async def _run(self, name, args, job=None):
         service, method = name.rsplit('.', 1)
@@ -62,24 +70,76 @@ class FakeMiddleware(LoadPluginsMixin):
         """
         Calls a method using middleware client
         """
-        return self.client.call(method, *params, timeout=timeout, **kwargs)
+        return self.get_client().call(method, *params, timeout=timeout, **kwargs)
 
     def call_sync(self, method, *params, timeout=None, **kwargs):
         """
         Calls a method using middleware client
         """
-        return self.client.call(method, *params, timeout=timeout, **kwargs)
+        return self.get_client().call(method, *params, timeout=timeout, **kwargs)
 
     async def call_hook(self, name, *args, **kwargs):
-        with Client(py_exceptions=True) as c:
-            return c.call('core.call_hook', name, args, kwargs)
+        return self.get_client().call('core.call_hook', name, args, kwargs)
+
+
+class JobProgressSender(object):
+    """
+    Sends progress of the jobs run in the worker to middlewared from a single
+    background thread so jobs do not wait on it. Updates of a job made while
+    its previous one is being sent are coalesced.
+    """
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+        self._cond = threading.Condition()
+        # Job id -> latest progress not sent yet, in the order jobs were updated
+        self._pending = {}
+        self._sending = None
+        self._thread = None
+
+    def send(self, id, progress):
+        with self._cond:
+            self._pending[id] = progress
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='job_progress', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                id = next(iter(self._pending))
+                progress = self._pending.pop(id)
+                self._sending = id
+
+            try:
+                self.get_client().call('core.job_update', id, {'progress': progress})
+            except Exception:
+                MIDDLEWARE.logger.getLogger().debug('Failed to update job %d progress', id, exc_info=True)
+            finally:
+                with self._cond:
+                    self._sending = None
+                    self._cond.notify_all()
+
+    def flush(self, id):
+        """
+        Wait for pending progress of job `id` to be sent.
+        """
+        with self._cond:
+            while id in self._pending or self._sending == id:
+                self._cond.wait()
 
 
 class FakeJob(object):
+    """
+    Job passed to methods run in the worker, its progress is sent by `JobProgressSender`.
+    """
 
-    def __init__(self, id, client):
+    def __init__(self, id, progress_sender):
         self.id = id
-        self.client = client
+        self.progress_sender = progress_sender
         self.progress = {
             'percent': None,
             'description': None,
@@ -92,7 +152,14 @@ class FakeJob(object):
             self.progress['description'] = description
         if extra:
             self.progress['extra'] = extra
-        self.client.call('core.job_update', self.id, {'progress': self.progress})
+
+        self.progress_sender.send(self.id, dict(self.progress))
+
+    def flush(self):
+        """
+        Wait for pending progress to be sent, so it is not overwritten by the job result.
+        """
+        self.progress_sender.flush(self.id)
 
 
 def main_worker(*call_args):
@@ -139,11 +206,22 @@ def watch_parent():
     os._exit(1)
 
 
-def worker_init(overlay_dirs, debug_level, log_handler):
+def worker_ready():
+    """
+    No-op run by every worker of a new pool so they are spawned and have loaded
+    their plugins before the first call needs them.
+    """
+    return os.getpid()
+
+
+def worker_init(overlay_dirs, debug_level, log_handler, modules=None):
+    """
+    `modules` are the names of the plugin modules to load, every one if not given.
+    """
     global MIDDLEWARE
     MIDDLEWARE = FakeMiddleware(overlay_dirs)
     os.environ['MIDDLEWARED_LOADING'] = 'True'
-    MIDDLEWARE._load_plugins()
+    MIDDLEWARE._load_plugins(modules=modules)
     os.environ['MIDDLEWARED_LOADING'] = 'False'
     setproctitle.setproctitle('middlewared (worker)')
     threading.Thread(target=watch_parent, daemon=True).start()